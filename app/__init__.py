@@ -8,8 +8,9 @@ from flask_login import LoginManager
 from flask_migrate import Migrate
 import os
 
-# Inicializar extensiones
-db = SQLAlchemy()
+# Inicializar extensiones (la sesión envía a la réplica las vistas de solo lectura, ver app/replica.py)
+from app.replica import SesionEnrutada
+db = SQLAlchemy(session_options={'class_': SesionEnrutada})
 login_manager = LoginManager()
 migrate = Migrate()
 
@@ -36,6 +37,18 @@ def create_app(config_name='development'):
         f'sqlite:///{os.path.join(basedir, "clinic.db")}'
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     
+    # Pool, recycle, pre-ping y timeouts según workers/hilos y entorno (ver app/database.py)
+    from app.database import opciones_motor
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = opciones_motor(app.config['SQLALCHEMY_DATABASE_URI'])
+    
+    # Réplica de lectura opcional: añade su bind antes de crear los motores
+    from app.replica import replica
+    replica.init_app(app)
+    
+    # Tipo de IVA y redondeo de los importes (ver app/dinero.py)
+    from app import dinero
+    dinero.init_app(app)
+    
     # Inicializar extensiones con la app
     db.init_app(app)
     login_manager.init_app(app)
@@ -46,10 +59,12 @@ def create_app(config_name='development'):
     login_manager.login_message = 'Por favor, inicia sesión para acceder a esta página.'
     login_manager.login_message_category = 'info'
     
+    # Los usuarios con sesión se cargan desde una caché por proceso (ver app/sesiones.py)
+    from app.sesiones import cargar_usuario
+    
     @login_manager.user_loader
     def load_user(user_id):
-        from app.models import User
-        return User.query.get(int(user_id))
+        return cargar_usuario(int(user_id))
     
     # Registrar blueprints
     from app.routes_auth import bp as auth_bp
@@ -64,18 +79,43 @@ def create_app(config_name='development'):
     from app.routes_patient import bp as patient_bp
     app.register_blueprint(patient_bp, url_prefix='/paciente')
     
+    # Registrar los eventos que mantienen los resúmenes financieros mensuales
+    from app import reporting
+    
+    # Caché de vistas de lectura (backend según CACHE_TYPE)
+    from app.cache import cache
+    cache.init_app(app)
+    
+    # Métricas de SQL, plantillas y latencia por endpoint (ver /panel/debug/perf)
+    from app.perf import perf
+    perf.init_app(app)
+    
+    # Cola de trabajos en segundo plano y órdenes `flask jobs ...` (ver app/jobs.py)
+    from app import jobs
+    jobs.init_app(app)
+    
     from flask import redirect, url_for
     
+    # Crear la configuración de clínica por defecto al arrancar, no en una petición
+    from app.models import ClinicSettings
+    with app.app_context():
+        try:
+            ClinicSettings.crear_por_defecto()
+        except Exception:
+            db.session.rollback()
+    
     # Context processor para pasar configuración de clínica a todas las plantillas
     @app.context_processor
     def inject_clinic_settings():
-        from app.models import ClinicSettings
         try:
-            settings = ClinicSettings.get_settings()
-            return dict(clinic_settings=settings)
+            return dict(clinic_settings=ClinicSettings.cached())
         except:
             return dict(clinic_settings=None)
     
+    @app.context_processor
+    def inject_porcentaje_iva():
+        return dict(porcentaje_iva=dinero.porcentaje_iva())
+    
     # Ruta raíz - redirige directamente al login
     @app.route('/')
     def index():
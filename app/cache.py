@@ -0,0 +1,365 @@
+"""
+Caché de servidor para las vistas de lectura pesadas.
+
+Backends (CACHE_TYPE):
+- 'local': LRU en memoria del proceso. Para desarrollo y pruebas: con varios
+  workers, lo que guarda uno no invalida la caché de los demás.
+- 'sqlite': fichero SQLite compartido por todos los workers de la máquina
+  (CACHE_SQLITE_PATH; por defecto instance/cache/vistas.sqlite, en un
+  directorio 0700). Es el valor por defecto cuando WEB_CONCURRENCY > 1.
+- 'nula': desactiva la caché.
+
+Cada entrada tiene su TTL y una lista de etiquetas. Las etiquetas llevan un
+número de versión que se incrementa al hacer commit de cambios en los modelos
+asociados (ETIQUETAS_MODELO); una entrada guardada con versiones antiguas
+cuenta como fallo. Las versiones se leen antes de calcular el valor, así que
+un cambio que llegue mientras se calcula no deja datos viejos en la caché.
+"""
+from app import db
+from app.models import Appointment, Invoice, Payment, TimeClock, Patient
+from app.replica import replica
+from collections import OrderedDict
+from flask import current_app, request, session, make_response
+from flask_login import current_user
+from functools import wraps
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Etiquetas que se invalidan al guardar cada modelo
+ETIQUETAS_MODELO = {
+    Appointment: ('citas',),
+    Invoice: ('facturas',),
+    Payment: ('pagos', 'facturas'),  # los pagos cambian total_pagado y estado de la factura
+    TimeClock: ('fichajes',),
+    Patient: ('pacientes',),
+}
+
+
+class CacheLocal:
+    """LRU en memoria con TTL por clave."""
+
+    nombre = 'local'
+
+    def __init__(self, max_entradas=1000):
+        self.max_entradas = max_entradas
+        self._entradas = OrderedDict()  # clave -> (caduca, valor)
+        self._versiones = {}
+        self._lock = threading.Lock()
+
+    def obtener(self, clave):
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None:
+                return None
+            if time.monotonic() >= entrada[0]:
+                del self._entradas[clave]
+                return None
+            self._entradas.move_to_end(clave)
+            return entrada[1]
+
+    def guardar(self, clave, valor, ttl):
+        with self._lock:
+            self._entradas[clave] = (time.monotonic() + ttl, valor)
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def borrar(self, clave):
+        with self._lock:
+            self._entradas.pop(clave, None)
+
+    def limpiar(self):
+        with self._lock:
+            self._entradas.clear()
+
+    def versiones(self, etiquetas):
+        return [self._versiones.get(e, 0) for e in etiquetas]
+
+    def incrementar(self, etiqueta):
+        with self._lock:
+            self._versiones[etiqueta] = self._versiones.get(etiqueta, 0) + 1
+
+    def tamano(self):
+        return len(self._entradas)
+
+
+class CacheSQLite:
+    """
+    Caché en un fichero SQLite compartido entre procesos de la misma máquina.
+
+    No usa pickle (leer un fichero que otro pueda escribir no debe ejecutar
+    código): las respuestas de `vista` se guardan como cuerpo (BLOB) y
+    mimetype, y cualquier otro valor como JSON.
+    """
+
+    nombre = 'sqlite'
+    PURGAR_CADA = 200  # escrituras entre limpiezas de entradas caducadas
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._local = threading.local()
+        self._escrituras = 0
+
+    def _conexion(self):
+        conexion = getattr(self._local, 'conexion', None)
+        if conexion is None:
+            conexion = sqlite3.connect(self.ruta, timeout=5, isolation_level=None)
+            conexion.execute('PRAGMA journal_mode=WAL')
+            conexion.execute('PRAGMA synchronous=NORMAL')
+            conexion.execute(
+                'CREATE TABLE IF NOT EXISTS cache_entradas (clave TEXT PRIMARY KEY, caduca REAL NOT NULL, '
+                'versiones TEXT NOT NULL, cuerpo BLOB NOT NULL, mimetype TEXT)'
+            )
+            conexion.execute(
+                'CREATE TABLE IF NOT EXISTS cache_etiquetas (etiqueta TEXT PRIMARY KEY, version INTEGER NOT NULL)'
+            )
+            self._local.conexion = conexion
+        return conexion
+
+    def obtener(self, clave):
+        fila = self._conexion().execute(
+            'SELECT versiones, cuerpo, mimetype FROM cache_entradas WHERE clave = ? AND caduca > ?',
+            (clave, time.time())
+        ).fetchone()
+        if fila is None:
+            return None
+        versiones, cuerpo, mimetype = fila
+        valor = (bytes(cuerpo), mimetype) if mimetype is not None else json.loads(cuerpo)
+        return json.loads(versiones), valor
+
+    def guardar(self, clave, valor, ttl):
+        versiones, valor = valor
+        if isinstance(valor, tuple) and len(valor) == 2 and isinstance(valor[0], bytes) \
+                and isinstance(valor[1], str):
+            cuerpo, mimetype = valor
+        else:
+            cuerpo, mimetype = json.dumps(valor).encode(), None
+        conexion = self._conexion()
+        conexion.execute(
+            'INSERT OR REPLACE INTO cache_entradas (clave, caduca, versiones, cuerpo, mimetype) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (clave, time.time() + ttl, json.dumps(versiones), cuerpo, mimetype)
+        )
+        self._escrituras += 1
+        if self._escrituras % self.PURGAR_CADA == 0:
+            conexion.execute('DELETE FROM cache_entradas WHERE caduca <= ?', (time.time(),))
+
+    def borrar(self, clave):
+        self._conexion().execute('DELETE FROM cache_entradas WHERE clave = ?', (clave,))
+
+    def limpiar(self):
+        self._conexion().execute('DELETE FROM cache_entradas')
+
+    def versiones(self, etiquetas):
+        if not etiquetas:
+            return []
+        filas = dict(self._conexion().execute(
+            'SELECT etiqueta, version FROM cache_etiquetas WHERE etiqueta IN (%s)' % ','.join('?' * len(etiquetas)),
+            list(etiquetas)
+        ).fetchall())
+        return [filas.get(e, 0) for e in etiquetas]
+
+    def incrementar(self, etiqueta):
+        self._conexion().execute(
+            'INSERT INTO cache_etiquetas (etiqueta, version) VALUES (?, 1) '
+            'ON CONFLICT(etiqueta) DO UPDATE SET version = version + 1',
+            (etiqueta,)
+        )
+
+    def tamano(self):
+        return self._conexion().execute('SELECT COUNT(*) FROM cache_entradas').fetchone()[0]
+
+
+class CacheNula:
+    """Backend que no guarda nada (caché desactivada)."""
+
+    nombre = 'nula'
+
+    def obtener(self, clave):
+        return None
+
+    def guardar(self, clave, valor, ttl):
+        pass
+
+    def borrar(self, clave):
+        pass
+
+    def limpiar(self):
+        pass
+
+    def versiones(self, etiquetas):
+        return [0] * len(etiquetas)
+
+    def incrementar(self, etiqueta):
+        pass
+
+    def tamano(self):
+        return 0
+
+
+class Cache:
+    """Fachada de la caché: TTL, etiquetas, contadores y decorador de vistas."""
+
+    def __init__(self):
+        self.backend = CacheNula()
+        self.ttl_por_defecto = 60
+        self.aciertos = 0
+        self.fallos = 0
+        self.invalidaciones = 0
+
+    def init_app(self, app):
+        workers = int(os.environ.get('WEB_CONCURRENCY') or 1)
+        app.config.setdefault('CACHE_TYPE', os.environ.get('CACHE_TYPE', 'sqlite' if workers > 1 else 'local'))
+        app.config.setdefault('CACHE_DEFAULT_TTL', int(os.environ.get('CACHE_DEFAULT_TTL', 60)))
+        app.config.setdefault('CACHE_SQLITE_PATH', os.environ.get('CACHE_SQLITE_PATH'))
+
+        tipo = app.config['CACHE_TYPE']
+        if tipo == 'sqlite':
+            ruta = app.config['CACHE_SQLITE_PATH']
+            if not ruta:
+                # Directorio privado de la aplicación, no /tmp: solo este usuario puede escribir la caché
+                directorio = os.path.join(app.instance_path, 'cache')
+                os.makedirs(directorio, mode=0o700, exist_ok=True)
+                os.chmod(directorio, 0o700)
+                ruta = os.path.join(directorio, 'vistas.sqlite')
+            self.backend = CacheSQLite(ruta)
+        elif tipo == 'local':
+            if workers > 1:
+                logger.warning('CACHE_TYPE=local con %s workers: las invalidaciones de un worker no llegan '
+                               'a los demás. Usa CACHE_TYPE=sqlite.', workers)
+            self.backend = CacheLocal()
+        else:
+            self.backend = CacheNula()
+        self.ttl_por_defecto = app.config['CACHE_DEFAULT_TTL']
+        app.extensions['cache'] = self
+
+    def obtener(self, clave, etiquetas=()):
+        """Valor guardado para la clave, o None si no hay o sus etiquetas han cambiado."""
+        entrada = self.backend.obtener(clave)
+        if entrada is not None:
+            versiones, valor = entrada
+            if versiones == self.backend.versiones(etiquetas):
+                self.aciertos += 1
+                return valor
+        self.fallos += 1
+        return None
+
+    def guardar(self, clave, valor, ttl=None, etiquetas=(), versiones=None):
+        """
+        Guarda un valor. `versiones` son las de las etiquetas leídas antes de
+        calcularlo (ver versiones()); por defecto, las actuales.
+        """
+        if versiones is None:
+            versiones = self.backend.versiones(etiquetas)
+        self.backend.guardar(clave, (versiones, valor), ttl or self.ttl_por_defecto)
+
+    def versiones(self, etiquetas):
+        return self.backend.versiones(etiquetas)
+
+    def invalidar(self, *etiquetas):
+        """Invalida todas las entradas guardadas con alguna de las etiquetas."""
+        for etiqueta in etiquetas:
+            self.backend.incrementar(etiqueta)
+        self.invalidaciones += len(etiquetas)
+
+    def borrar(self, clave):
+        self.backend.borrar(clave)
+
+    def limpiar(self):
+        self.backend.limpiar()
+
+    def estadisticas(self):
+        """Contadores de este proceso y tamaño actual del backend."""
+        total = self.aciertos + self.fallos
+        return {
+            'backend': self.backend.nombre,
+            'aciertos': self.aciertos,
+            'fallos': self.fallos,
+            'ratio_aciertos': round(self.aciertos / total, 3) if total else 0.0,
+            'invalidaciones': self.invalidaciones,
+            'entradas': self.backend.tamano(),
+        }
+
+    def cacheado(self, ttl=None, etiquetas=(), clave=None):
+        """Decorador para funciones: cachea el resultado según sus argumentos."""
+        def decorador(f):
+            prefijo = clave or f'{f.__module__}.{f.__qualname__}'
+
+            @wraps(f)
+            def envoltura(*args, **kwargs):
+                clave_llamada = f'{prefijo}:{args!r}:{sorted(kwargs.items())!r}'
+                valor = self.obtener(clave_llamada, etiquetas)
+                if valor is None:
+                    versiones = self.versiones(etiquetas)
+                    valor = f(*args, **kwargs)
+                    self.guardar(clave_llamada, valor, ttl, etiquetas, versiones)
+                return valor
+            return envoltura
+        return decorador
+
+    def vista(self, ttl=None, etiquetas=()):
+        """
+        Decorador para vistas GET: guarda la respuesta por ruta, parámetros y usuario.
+
+        Va debajo de login_required/role_required para que los permisos se
+        comprueben siempre. No se cachean respuestas con mensajes flash ni las
+        que se han leído de la réplica (app/replica.py).
+        """
+        def decorador(f):
+            @wraps(f)
+            def envoltura(*args, **kwargs):
+                if request.method != 'GET' or session.get('_flashes'):
+                    return f(*args, **kwargs)
+
+                usuario = f'{current_user.get_id()}:{current_user.rol}' if current_user.is_authenticated else '-'
+                clave_vista = f'vista:{request.endpoint}:{usuario}:{request.full_path}'
+                guardada = self.obtener(clave_vista, etiquetas)
+                if guardada is not None:
+                    cuerpo, mimetype = guardada
+                    return current_app.response_class(cuerpo, mimetype=mimetype)
+
+                versiones = self.versiones(etiquetas)
+                respuesta = make_response(f(*args, **kwargs))
+                # Las versiones son las de la base principal: una respuesta leída de la
+                # réplica (que puede ir con retraso) no se guarda con ellas
+                if respuesta.status_code == 200 and not respuesta.direct_passthrough \
+                        and not session.get('_flashes') and not replica.en_uso():
+                    self.guardar(clave_vista, (respuesta.get_data(), respuesta.mimetype), ttl, etiquetas, versiones)
+                return respuesta
+            return envoltura
+        return decorador
+
+
+cache = Cache()
+
+
+def anotar_modelos_modificados(session, *modelos):
+    """Para escrituras masivas (INSERT/UPDATE sin objetos): invalida sus etiquetas al hacer commit."""
+    etiquetas = session.info.setdefault('cache_etiquetas', set())
+    for modelo in modelos:
+        etiquetas.update(ETIQUETAS_MODELO.get(modelo, ()))
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def _anotar_etiquetas_modificadas(session, flush_context):
+    etiquetas = session.info.setdefault('cache_etiquetas', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        etiquetas.update(ETIQUETAS_MODELO.get(type(obj), ()))
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def _invalidar_etiquetas_modificadas(session):
+    etiquetas = session.info.pop('cache_etiquetas', None)
+    if etiquetas:
+        cache.invalidar(*sorted(etiquetas))
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def _descartar_etiquetas_modificadas(session):
+    session.info.pop('cache_etiquetas', None)
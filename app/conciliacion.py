@@ -0,0 +1,334 @@
+"""
+Importación de extractos del banco y del TPV y conciliación de sus cobros
+con las facturas pendientes.
+
+Formatos:
+- Norma 43 (Cuaderno 43 de la AEB): registros 22 (movimiento) y 23
+  (conceptos complementarios). Solo se importan los abonos.
+- CSV con cabecera y columnas de fecha, importe y, opcionalmente,
+  referencia y concepto (se aceptan varios nombres, ver COLUMNAS_CSV).
+
+Cada cobro se asigna a una factura abierta (pendiente o parcial) con la
+primera regla que encaje:
+1. 'factura': la referencia o el concepto citan el número de factura
+   (FAC-123, Factura 123, F123...) y el importe no supera lo pendiente.
+2. 'paciente': el concepto incluye el DNI/NIE del paciente y una de sus
+   facturas tiene pendiente exactamente ese importe (o es la única abierta
+   y el importe cabe en ella).
+3. 'importe': una sola factura abierta, emitida antes del cobro, tiene
+   pendiente exactamente ese importe.
+
+Todo se hace en bloque: las facturas abiertas se leen en una consulta, los
+pagos se insertan con un único INSERT (executemany) y total_pagado y
+estado_pago de las facturas afectadas se recalculan con un UPDATE cada uno.
+La referencia del movimiento se guarda en el pago, así que importar dos veces
+el mismo extracto no duplica cobros. Se compone siempre con el contenido del
+movimiento (fecha, importe y las referencias del banco o, sin ellas, el
+concepto), nunca con su posición en el fichero ni solo con la referencia del
+banco, que puede venir a ceros o repetirse. Los movimientos idénticos de un
+mismo extracto se numeran (#2, #3...).
+
+La pantalla de conciliación primero comprueba el extracto sin guardar nada;
+los pagos se registran al confirmar, con el mismo fichero empaquetado en el
+formulario (empaquetar_extracto).
+"""
+from app import db
+from app.cache import anotar_modelos_modificados
+from app.dinero import CERO, importe
+from app.models import Invoice, Payment, Patient, normalizar_texto
+from app.replica import anotar_escritura
+from app.reporting import anotar_facturas_modificadas
+from collections import Counter, defaultdict, namedtuple
+from datetime import datetime
+import base64
+import binascii
+import csv
+import io
+import re
+import zlib
+
+Movimiento = namedtuple('Movimiento', 'linea fecha importe referencia concepto')
+
+BLOQUE_IN = 500  # elementos por cláusula IN (límite de parámetros de SQLite)
+
+COLUMNAS_CSV = {
+    'fecha': ('fecha', 'fecha operacion', 'fecha valor', 'fecha pago', 'date'),
+    'importe': ('importe', 'cantidad', 'importe eur', 'amount'),
+    'referencia': ('referencia', 'ref', 'n operacion', 'numero operacion', 'autorizacion', 'codigo autorizacion'),
+    'concepto': ('concepto', 'descripcion', 'observaciones', 'detalle'),
+}
+FORMATOS_FECHA = ('%d/%m/%Y', '%Y-%m-%d', '%d-%m-%Y', '%d/%m/%y', '%d/%m/%Y %H:%M', '%Y-%m-%d %H:%M:%S')
+
+RE_FACTURA = re.compile(r'\b(?:factura|fact|fac|fra|f)[\s.\-#:/nº°o]*0*(\d{1,9})\b', re.IGNORECASE)
+RE_DNI = re.compile(r'\b([XYZ]?\d{7,8}[\s-]?[A-Z])\b')
+RE_MILES = re.compile(r'^[-+]?[1-9]\d{0,2}(\.\d{3})+$')
+
+
+# ---------- Lectura de extractos ----------
+
+def _texto(contenido):
+    if isinstance(contenido, str):
+        return contenido
+    try:
+        return contenido.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return contenido.decode('latin-1')  # Norma 43 y exportaciones antiguas del banco
+
+
+def _importe_extracto(valor):
+    """
+    '1.234,56', '1,234.56', '1.234', '1234.56' o '-12,00' como Decimal.
+
+    Con los dos separadores, el último es el decimal. Un punto seguido de
+    exactamente tres cifras ('1.234', '12.345.678') es de miles, como
+    escriben los importes los bancos españoles.
+    """
+    valor = valor.strip().replace('€', '').replace(' ', '')
+    if ',' in valor and '.' in valor:
+        miles, decimal = ('.', ',') if valor.rfind(',') > valor.rfind('.') else (',', '.')
+        valor = valor.replace(miles, '').replace(decimal, '.')
+    elif RE_MILES.match(valor):
+        valor = valor.replace('.', '')
+    elif valor.count(',') > 1:
+        valor = valor.replace(',', '')
+    return importe(valor)
+
+
+def _fecha_extracto(valor):
+    valor = valor.strip()
+    for formato in FORMATOS_FECHA:
+        try:
+            return datetime.strptime(valor, formato)
+        except ValueError:
+            continue
+    raise ValueError(f'Fecha no válida: {valor!r}')
+
+
+def _referencia_banco(valor):
+    """Referencia del banco, o '' si viene en blanco o rellena de ceros."""
+    valor = valor.strip()
+    return valor if valor.strip('0') else ''
+
+
+def _numerar(clave, vistas):
+    """La clave compuesta con #2, #3... si ya ha salido en el mismo extracto (movimientos idénticos)."""
+    vistas[clave] += 1
+    return clave if vistas[clave] == 1 else f'{clave}#{vistas[clave]}'
+
+
+def leer_norma43(texto):
+    """Movimientos de abono de un fichero Norma 43 y los errores de lectura [(línea, mensaje)]."""
+    movimientos, errores = [], []
+    vistas = Counter()
+    actual = None
+    for n, linea in enumerate(texto.splitlines(), 1):
+        tipo = linea[:2]
+        if tipo == '22':
+            if actual:
+                movimientos.append(Movimiento(**actual))
+            actual = None
+            try:
+                if linea[27] != '2':  # 1 = cargo, 2 = abono
+                    continue
+                fecha = datetime.strptime(linea[10:16], '%y%m%d')
+                cantidad = importe(f'{int(linea[28:40])}.{linea[40:42]}')
+                documento = linea[42:52].strip()
+                ref1, ref2 = _referencia_banco(linea[52:64]), _referencia_banco(linea[64:80])
+            except (IndexError, ValueError):
+                errores.append((n, 'Registro 22 mal formado'))
+                continue
+            # Las referencias solas no bastan: muchos bancos las repiten o las dejan a ceros
+            referencia = _numerar(f'N43-{fecha:%Y%m%d}-{cantidad}-{documento}-{ref1}-{ref2}', vistas)
+            actual = dict(linea=n, fecha=fecha, importe=cantidad, referencia=referencia, concepto='')
+        elif tipo == '23' and actual:
+            actual['concepto'] = f"{actual['concepto']} {linea[4:42].strip()} {linea[42:80].strip()}".strip()
+    if actual:
+        movimientos.append(Movimiento(**actual))
+    return movimientos, errores
+
+
+def leer_csv(texto):
+    """Movimientos con importe positivo de un CSV y los errores de lectura [(línea, mensaje)]."""
+    muestra = texto[:4096]
+    delimitador = ';' if muestra.count(';') >= muestra.count(',') else ','
+    lector = csv.reader(io.StringIO(texto), delimiter=delimitador)
+    cabecera = [normalizar_texto(c).replace('.', '').replace('º', '') for c in next(lector, [])]
+
+    indices = {}
+    for campo, nombres in COLUMNAS_CSV.items():
+        for nombre in nombres:
+            if nombre in cabecera:
+                indices[campo] = cabecera.index(nombre)
+                break
+    if 'fecha' not in indices or 'importe' not in indices:
+        raise ValueError('El CSV debe tener columnas de fecha e importe.')
+
+    movimientos, errores = [], []
+    vistas = Counter()
+    for n, fila in enumerate(lector, 2):
+        if not any(c.strip() for c in fila):
+            continue
+        try:
+            cantidad = _importe_extracto(fila[indices['importe']])
+            fecha = _fecha_extracto(fila[indices['fecha']])
+        except (IndexError, ValueError) as e:
+            errores.append((n, str(e) if isinstance(e, ValueError) else 'Faltan columnas'))
+            continue
+        if cantidad <= 0:
+            continue  # cargos y devoluciones no son cobros
+        referencia = _referencia_banco(fila[indices['referencia']]) if 'referencia' in indices else ''
+        concepto = fila[indices['concepto']].strip() if 'concepto' in indices else ''
+        # Los códigos de autorización del TPV son cortos y se repiten con el
+        # tiempo: la clave lleva siempre la fecha y el importe
+        detalle = referencia[:40] or normalizar_texto(concepto)[:40]
+        referencia = _numerar(f'CSV-{fecha:%Y%m%d%H%M}-{cantidad}-{detalle}', vistas)
+        movimientos.append(Movimiento(n, fecha, cantidad, referencia, concepto))
+    return movimientos, errores
+
+
+def empaquetar_extracto(contenido):
+    """Fichero del extracto comprimido en texto, para reenviarlo al confirmar la importación."""
+    return base64.b64encode(zlib.compress(contenido, 9)).decode('ascii')
+
+
+def desempaquetar_extracto(texto):
+    """Inverso de empaquetar_extracto; lanza ValueError si el texto no es válido."""
+    try:
+        return zlib.decompress(base64.b64decode(texto, validate=True))
+    except (binascii.Error, zlib.error):
+        raise ValueError('El extracto a confirmar no es válido; vuelve a subir el fichero.')
+
+
+def leer_extracto(contenido, formato='auto'):
+    """Lee un extracto (bytes o texto) en formato 'norma43', 'csv' o detectándolo ('auto')."""
+    texto = _texto(contenido)
+    if formato == 'auto':
+        primera = next((l for l in texto.splitlines() if l.strip()), '')
+        formato = 'norma43' if primera[:2] == '11' and len(primera.rstrip()) >= 70 else 'csv'
+    return leer_norma43(texto) if formato == 'norma43' else leer_csv(texto)
+
+
+# ---------- Conciliación ----------
+
+def _referencias_existentes(referencias):
+    existentes = set()
+    referencias = list(referencias)
+    for i in range(0, len(referencias), BLOQUE_IN):
+        existentes.update(r for (r,) in db.session.query(Payment.referencia).filter(
+            Payment.referencia.in_(referencias[i:i + BLOQUE_IN])))
+    return existentes
+
+
+class _FacturasAbiertas:
+    """Facturas pendientes o parciales con lo que les queda por cobrar, indexadas para casar cobros."""
+
+    def __init__(self):
+        self.pendiente = {}
+        self.emision = {}
+        self.por_dni = defaultdict(list)
+        self.por_importe = defaultdict(list)
+        filas = db.session.query(
+            Invoice.id, Invoice.fecha_emision, Invoice.total, Invoice.total_pagado, Patient.dni
+        ).join(Patient, Invoice.patient_id == Patient.id).filter(
+            Invoice.estado_pago.in_(['pendiente', 'parcial'])
+        ).order_by(Invoice.fecha_emision, Invoice.id)
+        for factura_id, emision, total, pagado, dni in filas:
+            pendiente = importe(total) - importe(pagado)
+            if pendiente <= 0:
+                continue
+            self.pendiente[factura_id] = pendiente
+            self.emision[factura_id] = emision
+            self.por_importe[pendiente].append(factura_id)
+            if dni:
+                self.por_dni[re.sub(r'[\s-]', '', dni.upper())].append(factura_id)
+
+    def asignar(self, movimiento):
+        """(factura_id, regla) del cobro, o (None, motivo) si no se puede asignar."""
+        cantidad = movimiento.importe
+        texto = f'{movimiento.referencia} {movimiento.concepto}'
+
+        for numero in RE_FACTURA.findall(texto):
+            factura_id = int(numero)
+            if factura_id in self.pendiente:
+                if cantidad <= self.pendiente[factura_id]:
+                    return factura_id, 'factura'
+                return None, f'Supera lo pendiente de la factura {factura_id}'
+
+        for dni in (re.sub(r'[\s-]', '', d) for d in RE_DNI.findall(texto.upper())):
+            abiertas = [f for f in self.por_dni.get(dni, []) if self.pendiente.get(f, CERO) > 0]
+            exacta = next((f for f in abiertas if self.pendiente[f] == cantidad), None)
+            if exacta:
+                return exacta, 'paciente'
+            if len(abiertas) == 1 and cantidad <= self.pendiente[abiertas[0]]:
+                return abiertas[0], 'paciente'
+
+        candidatas = [f for f in self.por_importe.get(cantidad, [])
+                      if self.pendiente.get(f) == cantidad and self.emision[f] <= movimiento.fecha.replace(
+                          hour=23, minute=59, second=59)]
+        if len(candidatas) == 1:
+            return candidatas[0], 'importe'
+        if candidatas:
+            return None, f'{len(candidatas)} facturas pendientes de {cantidad} €'
+        return None, 'Sin factura que encaje'
+
+    def cobrar(self, factura_id, cantidad):
+        self.pendiente[factura_id] -= cantidad
+
+
+def conciliar(movimientos, metodo_pago='transferencia', guardar=True):
+    """
+    Asigna los movimientos a facturas y, con guardar, registra los pagos.
+
+    Devuelve un dict con 'conciliados' [(movimiento, factura_id, regla)],
+    'sin_conciliar' [(movimiento, motivo)], 'duplicados' [movimiento] (ya
+    importados antes) y 'total' (importe conciliado).
+    """
+    resultado = {'conciliados': [], 'sin_conciliar': [], 'duplicados': [], 'total': CERO}
+    if not movimientos:
+        return resultado
+
+    existentes = _referencias_existentes({m.referencia[:100] for m in movimientos})
+    vistas = set()
+    facturas = _FacturasAbiertas()
+    for movimiento in movimientos:
+        referencia = movimiento.referencia[:100]
+        if referencia in existentes or referencia in vistas:
+            resultado['duplicados'].append(movimiento)
+            continue
+        vistas.add(referencia)
+        factura_id, regla = facturas.asignar(movimiento)
+        if factura_id is None:
+            resultado['sin_conciliar'].append((movimiento, regla))
+            continue
+        facturas.cobrar(factura_id, movimiento.importe)
+        resultado['conciliados'].append((movimiento, factura_id, regla))
+        resultado['total'] += movimiento.importe
+
+    if guardar and resultado['conciliados']:
+        _registrar_pagos(resultado['conciliados'], metodo_pago)
+    return resultado
+
+
+def _registrar_pagos(conciliados, metodo_pago):
+    """Inserta los pagos con un solo INSERT y recalcula las facturas afectadas en bloque."""
+    db.session.execute(db.insert(Payment), [
+        {
+            'invoice_id': factura_id,
+            'fecha_pago': movimiento.fecha,
+            'cantidad': movimiento.importe,
+            'metodo_pago': metodo_pago,
+            'referencia': movimiento.referencia[:100],
+        }
+        for movimiento, factura_id, _ in conciliados
+    ])
+    # El INSERT masivo no pasa por los eventos de Payment: se recalcula aquí
+    # y se avisa a los resúmenes mensuales, a la caché y a la réplica
+    afectadas = sorted({factura_id for _, factura_id, _ in conciliados})
+    for i in range(0, len(afectadas), BLOQUE_IN):
+        bloque = afectadas[i:i + BLOQUE_IN]
+        Invoice.recalcular_total_pagado(bloque)
+        Invoice.recalcular_estado_pago(bloque)
+    anotar_facturas_modificadas(db.session, afectadas)
+    anotar_modelos_modificados(db.session, Payment, Invoice)
+    anotar_escritura(db.session)
+    db.session.commit()
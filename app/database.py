@@ -0,0 +1,161 @@
+"""
+Configuración del motor de base de datos y métricas del pool de conexiones.
+
+En Postgres el tamaño del pool sale de los hilos de cada worker de gunicorn:
+cada hilo atiende una petición y usa como mucho una conexión, así que el pool
+guarda una por hilo y admite unas pocas extra (overflow) para picos. El total
+(workers × (pool + overflow)) se limita a DB_MAX_CONNECTIONS, el máximo que
+el plan de Postgres deja a la aplicación.
+
+Variables de entorno (todas opcionales):
+- WEB_CONCURRENCY, GUNICORN_THREADS: workers e hilos (los fija gunicorn.conf.py).
+- DB_MAX_CONNECTIONS: conexiones totales disponibles (por defecto 20).
+- DB_POOL_SIZE, DB_MAX_OVERFLOW: fuerzan los valores calculados.
+- DB_POOL_TIMEOUT: segundos de espera por una conexión libre (por defecto 10).
+- DB_POOL_RECYCLE: segundos antes de renovar una conexión (por defecto 300,
+  por debajo del cierre de conexiones inactivas del proxy de Render).
+- DB_STATEMENT_TIMEOUT: milisegundos máximos por sentencia (por defecto 30000);
+  el doble es el máximo de una transacción abierta sin actividad. Solo se
+  aplican al proceso web (APP_PROCESO=web, lo fija gunicorn.conf.py): el
+  worker de la cola de trabajos y los scripts migrate_*.py mantienen su
+  transacción abierta mientras generan PDF o rellenan columnas.
+- DB_CONNECT_TIMEOUT: segundos para abrir una conexión (por defecto 5).
+
+SQLite no usa nada de esto: el motor conserva sus opciones por defecto.
+"""
+from sqlalchemy.pool import QueuePool
+from sqlalchemy import exc
+import os
+import threading
+import time
+
+
+def _entero(entorno, nombre, defecto):
+    valor = entorno.get(nombre)
+    return int(valor) if valor not in (None, '') else defecto
+
+
+def dimensionar_pool(entorno=os.environ):
+    """Devuelve (pool_size, max_overflow) por worker según workers, hilos y el límite de conexiones."""
+    workers = max(1, _entero(entorno, 'WEB_CONCURRENCY', 1))
+    hilos = max(1, _entero(entorno, 'GUNICORN_THREADS', 1))
+    max_conexiones = max(1, _entero(entorno, 'DB_MAX_CONNECTIONS', 20))
+
+    por_worker = max(1, max_conexiones // workers)
+    pool_size = _entero(entorno, 'DB_POOL_SIZE', min(hilos, por_worker))
+    max_overflow = _entero(entorno, 'DB_MAX_OVERFLOW', max(0, min(max(2, hilos // 2), por_worker - pool_size)))
+    return pool_size, max_overflow
+
+
+def opciones_motor(database_url, entorno=os.environ):
+    """SQLALCHEMY_ENGINE_OPTIONS adecuadas a la base de datos."""
+    if not database_url or database_url.startswith('sqlite'):
+        return {}
+
+    pool_size, max_overflow = dimensionar_pool(entorno)
+    opciones = {
+        'poolclass': PoolMedido,
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': _entero(entorno, 'DB_POOL_TIMEOUT', 10),
+        'pool_recycle': _entero(entorno, 'DB_POOL_RECYCLE', 300),
+        # Comprueba la conexión al sacarla del pool: tras un rato inactivo el
+        # servidor puede haberla cerrado y la petición fallaría
+        'pool_pre_ping': True,
+        # LIFO: las conexiones sobrantes quedan al fondo y caducan por recycle
+        'pool_use_lifo': True,
+    }
+    if database_url.startswith('postgresql'):
+        opciones['connect_args'] = {
+            'connect_timeout': _entero(entorno, 'DB_CONNECT_TIMEOUT', 5),
+            'application_name': 'clinica-dental',
+        }
+        if entorno.get('APP_PROCESO') == 'web':
+            statement_timeout = _entero(entorno, 'DB_STATEMENT_TIMEOUT', 30000)
+            opciones['connect_args']['options'] = (f'-c statement_timeout={statement_timeout} '
+                                                   f'-c idle_in_transaction_session_timeout={statement_timeout * 2}')
+    return opciones
+
+
+def sin_limites_de_tiempo(conexion):
+    """
+    Quita a la transacción en curso los límites de tiempo del proceso web (Postgres).
+
+    Para las respuestas en streaming con un cursor de servidor: entre bloque y
+    bloque la transacción espera a que el cliente lea lo enviado.
+    """
+    if conexion.dialect.name == 'postgresql':
+        conexion.exec_driver_sql('SET LOCAL statement_timeout = 0')
+        conexion.exec_driver_sql('SET LOCAL idle_in_transaction_session_timeout = 0')
+
+
+class MetricasPool:
+    """Esperas y ocupación del pool acumuladas en este proceso."""
+
+    ESPERA_LARGA = 0.1  # segundos
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reiniciar()
+
+    def reiniciar(self):
+        with self._lock:
+            self.checkouts = 0
+            self.espera_total = 0.0
+            self.espera_max = 0.0
+            self.esperas_largas = 0  # checkouts de más de ESPERA_LARGA segundos
+            self.timeouts = 0
+            self.ocupadas_max = 0
+
+    def registrar(self, espera, ocupadas, timeout=False):
+        with self._lock:
+            if timeout:
+                self.timeouts += 1
+                return
+            self.checkouts += 1
+            self.espera_total += espera
+            self.espera_max = max(self.espera_max, espera)
+            if espera >= self.ESPERA_LARGA:
+                self.esperas_largas += 1
+            self.ocupadas_max = max(self.ocupadas_max, ocupadas)
+
+    def estado(self, pool):
+        """Métricas acumuladas y estado actual del pool del motor."""
+        datos = {
+            'clase': type(pool).__name__,
+            'estado': pool.status(),
+            'checkouts': self.checkouts,
+            'espera_media_ms': self.espera_total / self.checkouts * 1000 if self.checkouts else 0.0,
+            'espera_max_ms': self.espera_max * 1000,
+            'esperas_largas': self.esperas_largas,
+            'timeouts': self.timeouts,
+            'ocupadas_max': self.ocupadas_max,
+            'capacidad': None,
+            'ocupadas': None,
+            'saturacion': None,
+        }
+        if isinstance(pool, QueuePool):
+            capacidad = pool.size() + max(pool._max_overflow, 0)
+            datos.update(
+                capacidad=capacidad,
+                ocupadas=pool.checkedout(),
+                saturacion=pool.checkedout() / capacidad if capacidad else 0.0,
+            )
+        return datos
+
+
+metricas_pool = MetricasPool()
+
+
+class PoolMedido(QueuePool):
+    """QueuePool que mide cuánto espera cada checkout por una conexión libre."""
+
+    def _do_get(self):
+        inicio = time.perf_counter()
+        try:
+            conexion = super()._do_get()
+        except exc.TimeoutError:
+            metricas_pool.registrar(time.perf_counter() - inicio, self.checkedout(), timeout=True)
+            raise
+        metricas_pool.registrar(time.perf_counter() - inicio, self.checkedout())
+        return conexion
@@ -0,0 +1,126 @@
+"""
+Importes en euros con Decimal: redondeo a céntimos, IVA incluido y sumas.
+
+Todo el código que toca dinero (facturas, pagos, informes, PDF y
+exportaciones) pasa por aquí en lugar de convertir a float y dividir por
+1.21: los importes son Decimal con dos decimales y el desglose de IVA se
+calcula factura a factura, así que la suma de bases más la suma de cuotas
+coincide siempre con el total facturado.
+
+Configuración (variables de entorno o app.config):
+- IVA_PORCENTAJE: tipo de IVA incluido en los precios (por defecto 21).
+- REDONDEO_IMPORTES: 'mitad_arriba' (por defecto, 0,005 -> 0,01) o
+  'mitad_par' (redondeo bancario).
+
+`base_sql` e `iva_sql` dan el mismo desglose como expresiones SQL para
+agregarlo en la base de datos. Redondean con ROUND(), que en Postgres es
+mitad hacia arriba; con 'mitad_par' pueden diferir en un céntimo de
+`desglosar_iva` en los importes que caen justo en medio.
+"""
+from decimal import Decimal, InvalidOperation, ROUND_HALF_EVEN, ROUND_HALF_UP
+from sqlalchemy import Numeric, func, literal_column
+import os
+
+CERO = Decimal('0.00')
+CENTIMO = Decimal('0.01')
+CIEN = Decimal('100')
+
+REDONDEOS = {
+    'mitad_arriba': ROUND_HALF_UP,
+    'mitad_par': ROUND_HALF_EVEN,
+}
+
+# Valores en uso (init_app los toma de la configuración de la app)
+_iva = Decimal(os.environ.get('IVA_PORCENTAJE', '21'))
+_redondeo = REDONDEOS[os.environ.get('REDONDEO_IMPORTES', 'mitad_arriba')]
+
+
+def init_app(app):
+    """Lee IVA_PORCENTAJE y REDONDEO_IMPORTES de la configuración."""
+    global _iva, _redondeo
+    app.config.setdefault('IVA_PORCENTAJE', os.environ.get('IVA_PORCENTAJE', '21'))
+    app.config.setdefault('REDONDEO_IMPORTES', os.environ.get('REDONDEO_IMPORTES', 'mitad_arriba'))
+    if app.config['REDONDEO_IMPORTES'] not in REDONDEOS:
+        raise ValueError(f"REDONDEO_IMPORTES debe ser uno de: {', '.join(REDONDEOS)}")
+    _iva = Decimal(str(app.config['IVA_PORCENTAJE']))
+    _redondeo = REDONDEOS[app.config['REDONDEO_IMPORTES']]
+
+
+def porcentaje_iva():
+    """Tipo de IVA en uso, en porcentaje (Decimal)."""
+    return _iva
+
+
+def redondear(valor):
+    """Redondea un Decimal a céntimos con la política configurada."""
+    return valor.quantize(CENTIMO, rounding=_redondeo)
+
+
+def importe(valor):
+    """
+    Convierte a importe (Decimal con dos decimales) un número, un Decimal o
+    un texto de formulario ('12.5', '12,50'). None y '' son cero.
+    Lanza ValueError si el texto no es un número.
+    """
+    if valor is None or valor == '':
+        return CERO
+    if isinstance(valor, float):
+        valor = repr(valor)  # el float tal como se escribió, no su valor binario exacto
+    if isinstance(valor, str):
+        valor = valor.strip().replace(',', '.')
+    try:
+        resultado = Decimal(valor)
+    except InvalidOperation:
+        raise ValueError(f'Importe no válido: {valor!r}')
+    if not resultado.is_finite():
+        raise ValueError(f'Importe no válido: {valor!r}')
+    return redondear(resultado)
+
+
+def sumar(valores):
+    """Suma exacta de importes (ignora los None)."""
+    return sum((v if isinstance(v, Decimal) else importe(v) for v in valores if v is not None), CERO)
+
+
+def desglosar_iva(total):
+    """Devuelve (base imponible, IVA) de un total con IVA incluido; base + IVA == total."""
+    total = importe(total) if not isinstance(total, Decimal) else total
+    base = redondear(total * CIEN / (CIEN + _iva))
+    return base, total - base
+
+
+def desglosar_totales(totales):
+    """(base, IVA, total) de un conjunto de facturas, sumando el desglose de cada una."""
+    base = iva = CERO
+    for total in totales:
+        b, i = desglosar_iva(total)
+        base += b
+        iva += i
+    return base, iva, base + iva
+
+
+def saldo_pendiente(total, pagado):
+    """Lo que falta por cobrar de una factura (negativo si se ha cobrado de más)."""
+    return importe(total) - importe(pagado)
+
+
+def estado_pago(total, pagado):
+    """'pendiente', 'parcial' o 'pagado' según lo cobrado."""
+    pagado = importe(pagado)
+    if pagado <= 0:
+        return 'pendiente'
+    return 'pagado' if pagado >= importe(total) else 'parcial'
+
+
+# ---------- Expresiones SQL ----------
+
+def base_sql(columna):
+    """Base imponible de una columna de totales con IVA incluido, redondeada a céntimos en SQL."""
+    # Literales decimales: en Postgres la división es numeric (exacta), no de coma flotante
+    divisor = literal_column(str(CIEN + _iva))
+    return func.round(columna * literal_column('100.0') / divisor, 2, type_=Numeric(12, 2))
+
+
+def iva_sql(columna):
+    """Cuota de IVA de una columna de totales con IVA incluido (total - base)."""
+    return columna - base_sql(columna)
@@ -0,0 +1,213 @@
+"""
+Exportación de facturas y pagos para gestoría en CSV y XLSX, en streaming.
+
+Las filas salen de una consulta de columnas (sin objetos en la sesión) con
+yield_per: en Postgres es un cursor de servidor y se leen BLOQUE filas cada
+vez. La respuesta es un generador que escribe cada bloque según llega, así
+que la memoria no depende del número de filas del periodo. La transacción
+del cursor no tiene los límites de tiempo del proceso web: un cliente lento
+la deja esperando entre bloque y bloque.
+
+El XLSX se escribe a mano (un zip con el XML mínimo de una hoja) para poder
+generarlo en streaming sin dependencias. Los importes van como números y las
+fechas como fechas de Excel.
+"""
+from app import db
+from app.models import Invoice, Payment, Patient
+from app.database import sin_limites_de_tiempo
+from app.dinero import desglosar_iva
+from datetime import date, datetime, timedelta
+from xml.sax.saxutils import escape
+import csv
+import io
+import zipfile
+
+BLOQUE = 1000  # filas por lectura del cursor y por trozo de la respuesta
+
+COLUMNAS_FACTURAS = ['Número', 'Fecha', 'Paciente', 'DNI', 'Base imponible', 'IVA', 'Total',
+                     'Pagado', 'Pendiente', 'Estado', 'Método de pago']
+COLUMNAS_PAGOS = ['Factura', 'Fecha factura', 'Paciente', 'DNI', 'Fecha pago', 'Importe', 'Método de pago',
+                  'Referencia']
+
+
+def _rango(consulta, columna, fecha_inicio, fecha_fin):
+    return consulta.where(columna >= fecha_inicio, columna < fecha_fin + timedelta(days=1))
+
+
+def filas_facturas(fecha_inicio, fecha_fin, estado=None):
+    """Una fila por factura emitida en el periodo, con su desglose de IVA."""
+    consulta = _rango(
+        db.select(Invoice.id, Invoice.fecha_emision, Patient.nombre, Patient.apellidos, Patient.dni,
+                  Invoice.total, Invoice.total_pagado, Invoice.estado_pago, Invoice.metodo_pago)
+        .join(Patient, Invoice.patient_id == Patient.id),
+        Invoice.fecha_emision, fecha_inicio, fecha_fin
+    )
+    if estado and estado != 'todas':
+        consulta = consulta.where(Invoice.estado_pago == estado)
+    consulta = consulta.order_by(Invoice.fecha_emision, Invoice.id).execution_options(yield_per=BLOQUE)
+
+    sin_limites_de_tiempo(db.session.connection(bind_arguments={'clause': consulta}))
+    for id_, fecha, nombre, apellidos, dni, total, pagado, estado_pago, metodo in db.session.execute(consulta):
+        base, iva = desglosar_iva(total)
+        yield [id_, fecha.date(), f'{nombre} {apellidos}', dni or '', base, iva, total,
+               pagado, total - pagado, estado_pago, metodo or '']
+
+
+def filas_pagos(fecha_inicio, fecha_fin):
+    """Una fila por pago recibido en el periodo."""
+    consulta = _rango(
+        db.select(Payment.invoice_id, Invoice.fecha_emision, Patient.nombre, Patient.apellidos, Patient.dni,
+                  Payment.fecha_pago, Payment.cantidad, Payment.metodo_pago, Payment.referencia)
+        .join(Invoice, Payment.invoice_id == Invoice.id)
+        .join(Patient, Invoice.patient_id == Patient.id),
+        Payment.fecha_pago, fecha_inicio, fecha_fin
+    ).order_by(Payment.fecha_pago, Payment.id).execution_options(yield_per=BLOQUE)
+
+    sin_limites_de_tiempo(db.session.connection(bind_arguments={'clause': consulta}))
+    for factura, fecha_factura, nombre, apellidos, dni, fecha, cantidad, metodo, referencia in \
+            db.session.execute(consulta):
+        yield [factura, fecha_factura.date(), f'{nombre} {apellidos}', dni or '', fecha.date(), cantidad,
+               metodo, referencia or '']
+
+
+# ---------- CSV ----------
+
+# Excel interpreta como fórmula un texto que empieza por estos caracteres
+_INICIO_FORMULA = ('=', '+', '-', '@', '\t', '\r')
+
+
+def _texto_csv(valor):
+    """Texto de paciente, concepto o referencia con un ' delante si Excel lo tomaría por una fórmula."""
+    return f"'{valor}" if valor.startswith(_INICIO_FORMULA) else valor
+
+
+def fila_csv(fila):
+    """
+    Fila lista para csv.writer: fechas como dd/mm/aaaa, importes con punto
+    decimal y textos protegidos contra fórmulas (los números no se tocan).
+    """
+    return [v.strftime('%d/%m/%Y') if isinstance(v, date) else _texto_csv(v) if isinstance(v, str) else v
+            for v in fila]
+
+
+def generar_csv(columnas, filas):
+    """CSV (separador ';', como espera Excel en español) en trozos de bytes de BLOQUE filas."""
+    buffer = io.StringIO()
+    buffer.write('\ufeff')  # BOM: Excel reconoce así el UTF-8
+    escritor = csv.writer(buffer, delimiter=';')
+    escritor.writerow(columnas)
+    for n, fila in enumerate(filas, 1):
+        escritor.writerow(fila_csv(fila))
+        if n % BLOQUE == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+# ---------- XLSX ----------
+
+_TIPOS_CONTENIDO = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>
+</Types>'''
+
+_RELACIONES = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>'''
+
+_LIBRO = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets><sheet name="{hoja}" sheetId="1" r:id="rId1"/></sheets>
+</workbook>'''
+
+_RELACIONES_LIBRO = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>
+<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>'''
+
+# Estilos: 0 normal, 1 fecha dd/mm/yyyy, 2 importe #,##0.00, 3 cabecera en negrita
+_ESTILOS = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<numFmts count="1"><numFmt numFmtId="164" formatCode="dd/mm/yyyy"/></numFmts>
+<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font><font><b/><sz val="11"/><name val="Calibri"/></font></fonts>
+<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="4">
+<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>
+<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+<xf numFmtId="4" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>
+</cellXfs>
+<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>
+</styleSheet>'''
+
+_INICIO_HOJA = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                '<sheetViews><sheetView workbookViewId="0"><pane ySplit="1" topLeftCell="A2" state="frozen"/>'
+                '</sheetView></sheetViews><sheetData>')
+_FIN_HOJA = '</sheetData></worksheet>'
+
+_EPOCA_EXCEL = date(1899, 12, 30)
+
+
+def _celda_xlsx(valor, estilo_texto=0):
+    if isinstance(valor, bool) or valor is None:
+        valor = '' if valor is None else str(valor)
+    if isinstance(valor, datetime):
+        valor = valor.date()
+    if isinstance(valor, date):
+        return f'<c s="1"><v>{(valor - _EPOCA_EXCEL).days}</v></c>'
+    if isinstance(valor, int):
+        return f'<c><v>{valor}</v></c>'
+    if not isinstance(valor, str):  # Decimal: se escribe tal cual, sin pasar por float
+        return f'<c s="2"><v>{valor}</v></c>'
+    estilo = f' s="{estilo_texto}"' if estilo_texto else ''
+    return f'<c t="inlineStr"{estilo}><is><t xml:space="preserve">{escape(valor)}</t></is></c>'
+
+
+class _SalidaTrozos:
+    """Fichero de solo escritura que acumula lo escrito hasta que se recoge con `vaciar`."""
+
+    def __init__(self):
+        self._trozos = []
+
+    def write(self, datos):
+        self._trozos.append(bytes(datos))
+        return len(datos)
+
+    def flush(self):
+        pass
+
+    def vaciar(self):
+        datos = b''.join(self._trozos)
+        self._trozos = []
+        return datos
+
+
+def generar_xlsx(columnas, filas, hoja='Datos'):
+    """Libro XLSX de una hoja en trozos de bytes de BLOQUE filas."""
+    salida = _SalidaTrozos()
+    # Salida sin seek: zipfile escribe los tamaños detrás de cada fichero
+    with zipfile.ZipFile(salida, 'w', zipfile.ZIP_DEFLATED) as libro:
+        libro.writestr('[Content_Types].xml', _TIPOS_CONTENIDO)
+        libro.writestr('_rels/.rels', _RELACIONES)
+        libro.writestr('xl/workbook.xml', _LIBRO.format(hoja=escape(hoja)))
+        libro.writestr('xl/_rels/workbook.xml.rels', _RELACIONES_LIBRO)
+        libro.writestr('xl/styles.xml', _ESTILOS)
+        with libro.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as xml:
+            xml.write(_INICIO_HOJA.encode('utf-8'))
+            xml.write(('<row>' + ''.join(_celda_xlsx(c, 3) for c in columnas) + '</row>').encode('utf-8'))
+            for n, fila in enumerate(filas, 1):
+                xml.write(('<row>' + ''.join(_celda_xlsx(v) for v in fila) + '</row>').encode('utf-8'))
+                if n % BLOQUE == 0:
+                    yield salida.vaciar()
+            xml.write(_FIN_HOJA.encode('utf-8'))
+    yield salida.vaciar()
@@ -0,0 +1,271 @@
+"""
+Cola de trabajos en segundo plano guardada en la base de datos (tabla jobs).
+
+Las vistas encolan los PDF y exportaciones largas con `encolar` y responden
+al momento; los workers, arrancados con
+
+    flask --app run jobs worker [--procesos N]
+
+reclaman los trabajos pendientes, los ejecutan y dejan el fichero resultante
+en JOBS_DIR. Si el worker no comparte disco con el servicio web (servicios
+separados en Render), JOBS_EN_BD=1 guarda el fichero en la propia fila del
+trabajo al terminar. La página del trabajo consulta el progreso y ofrece la
+descarga al terminar. Las tareas se registran con el decorador `tarea` (ver
+app/tareas.py).
+
+Reclamar un trabajo es un UPDATE condicionado a que siga 'pendiente': si dos
+workers eligen el mismo, solo uno lo consigue (igual en SQLite y Postgres).
+Un trabajo que lleva más de JOBS_TIMEOUT segundos 'en_curso' (worker caído)
+vuelve a la cola hasta JOBS_MAX_INTENTOS veces; los workers lo comprueban al
+arrancar y cada INTERVALO_RECUPERACION segundos.
+"""
+from app import db
+from app.models import Job
+from datetime import datetime, timedelta
+from flask import current_app
+import click
+import json
+import logging
+import os
+import re
+import signal
+import socket
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+# nombre -> (función, parámetros admitidos desde el formulario)
+TAREAS = {}
+
+# Segundos entre búsquedas de trabajos bloqueados en cada worker
+INTERVALO_RECUPERACION = 60
+
+
+def tarea(nombre, parametros=()):
+    """Registra una tarea. La función recibe la Ejecucion y los parámetros como argumentos con nombre."""
+    def decorador(f):
+        TAREAS[nombre] = (f, tuple(parametros))
+        return f
+    return decorador
+
+
+def encolar(tipo, parametros=None, user_id=None):
+    """Crea un trabajo pendiente y lo devuelve (hace commit)."""
+    if tipo not in TAREAS:
+        raise ValueError(f'Tarea desconocida: {tipo}')
+    job = Job(tipo=tipo, parametros=json.dumps(parametros or {}, default=str), user_id=user_id)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def ruta_fichero(job):
+    """Ruta absoluta del fichero resultante de un trabajo."""
+    return os.path.join(current_app.config['JOBS_DIR'], job.fichero)
+
+
+class Ejecucion:
+    """Lo que recibe una tarea para informar del progreso y escribir su resultado."""
+
+    INTERVALO_PROGRESO = 1.0  # segundos mínimos entre escrituras de progreso
+
+    def __init__(self, job):
+        self.job_id = job.id
+        self.fichero = None
+        self.nombre_fichero = None
+        self._ultimo_progreso = 0.0
+
+    def progreso(self, porcentaje, mensaje=None):
+        """Guarda el avance (0-100). Se escribe como mucho una vez por segundo."""
+        ahora = time.monotonic()
+        if ahora - self._ultimo_progreso < self.INTERVALO_PROGRESO and porcentaje < 100:
+            return
+        self._ultimo_progreso = ahora
+        valores = {'progreso': max(0, min(100, int(porcentaje)))}
+        if mensaje is not None:
+            valores['mensaje'] = mensaje
+        # UPDATE directo: no arrastra los objetos que la tarea tenga en la sesión
+        with db.engine.begin() as conexion:
+            conexion.execute(db.update(Job).where(Job.id == self.job_id).values(**valores))
+
+    def abrir(self, nombre_descarga, modo='wb', **kwargs):
+        """Abre el fichero de resultado del trabajo (uno por trabajo) con el nombre de descarga dado."""
+        self.nombre_fichero = re.sub(r'[^\w.-]+', '_', nombre_descarga)
+        self.fichero = f'{self.job_id}-{self.nombre_fichero}'
+        os.makedirs(current_app.config['JOBS_DIR'], exist_ok=True)
+        return open(os.path.join(current_app.config['JOBS_DIR'], self.fichero), modo, **kwargs)
+
+
+def reclamar(worker_id):
+    """Marca como 'en_curso' el siguiente trabajo pendiente y lo devuelve (None si no hay)."""
+    while True:
+        candidato = db.session.query(Job.id).filter(Job.estado == 'pendiente') \
+            .order_by(Job.id).limit(1).scalar()
+        if candidato is None:
+            db.session.rollback()
+            return None
+        reclamado = db.session.execute(
+            db.update(Job).where(Job.id == candidato, Job.estado == 'pendiente').values(
+                estado='en_curso', worker=worker_id, fecha_inicio=datetime.utcnow(),
+                intentos=Job.intentos + 1, progreso=0
+            )
+        ).rowcount
+        db.session.commit()
+        if reclamado:
+            return db.session.get(Job, candidato)
+
+
+def ejecutar(job):
+    """Ejecuta un trabajo ya reclamado y guarda su resultado o su error."""
+    job_id = job.id
+    funcion = TAREAS.get(job.tipo, (None,))[0]
+    ejecucion = Ejecucion(job)
+    try:
+        if funcion is None:
+            raise ValueError(f'Tarea desconocida: {job.tipo}')
+        funcion(ejecucion, **job.get_parametros())
+        # La tarea puede haber vaciado la sesión: se vuelve a cargar el trabajo
+        job = db.session.get(Job, job_id)
+        job.fichero = ejecucion.fichero
+        job.nombre_fichero = ejecucion.nombre_fichero
+        if ejecucion.fichero and current_app.config['JOBS_EN_BD']:
+            ruta = ruta_fichero(job)
+            with open(ruta, 'rb') as f:
+                job.contenido = f.read()
+            os.remove(ruta)
+        job.estado = 'terminado'
+        job.progreso = 100
+        job.mensaje = None
+    except Exception as e:
+        logger.error('Error en el trabajo %s (%s):\n%s', job.id, job.tipo, traceback.format_exc())
+        db.session.rollback()
+        if ejecucion.fichero:
+            try:
+                os.remove(os.path.join(current_app.config['JOBS_DIR'], ejecucion.fichero))
+            except OSError:
+                pass
+        job = db.session.get(Job, job_id)
+        job.estado = 'error'
+        job.mensaje = str(e)[:500] or type(e).__name__
+    job.fecha_fin = datetime.utcnow()
+    db.session.commit()
+    return job
+
+
+def recuperar_bloqueados():
+    """Devuelve a la cola (o da por fallidos) los trabajos de workers caídos."""
+    limite = datetime.utcnow() - timedelta(seconds=current_app.config['JOBS_TIMEOUT'])
+    bloqueados = Job.query.filter(Job.estado == 'en_curso', Job.fecha_inicio < limite).all()
+    for job in bloqueados:
+        if job.intentos < current_app.config['JOBS_MAX_INTENTOS']:
+            job.estado = 'pendiente'
+        else:
+            job.estado = 'error'
+            job.mensaje = 'El trabajo no terminó (tiempo agotado)'
+            job.fecha_fin = datetime.utcnow()
+    db.session.commit()
+    return len(bloqueados)
+
+
+def trabajar(app, intervalo=2.0, una_vez=False):
+    """Bucle de un worker: ejecuta trabajos hasta recibir SIGTERM/SIGINT (o vaciar la cola con una_vez)."""
+    worker_id = f'{socket.gethostname()}:{os.getpid()}'
+    parar = []
+
+    def _parar(signum, frame):
+        parar.append(signum)  # termina el trabajo en curso antes de salir
+
+    signal.signal(signal.SIGTERM, _parar)
+    signal.signal(signal.SIGINT, _parar)
+
+    click.echo(f"Worker {worker_id} esperando trabajos...")
+    siguiente_recuperacion = 0.0
+    while not parar:
+        with app.app_context():
+            # Con el worker siempre en marcha, los trabajos de otro worker caído
+            # se recuperan sin esperar a un reinicio
+            if time.monotonic() >= siguiente_recuperacion:
+                recuperados = recuperar_bloqueados()
+                if recuperados:
+                    click.echo(f"  {recuperados} trabajo(s) bloqueado(s) recuperado(s)")
+                siguiente_recuperacion = time.monotonic() + INTERVALO_RECUPERACION
+            job = reclamar(worker_id)
+            if job is not None:
+                click.echo(f"  Trabajo {job.id} ({job.tipo})...")
+                job = ejecutar(job)
+                click.echo(f"  Trabajo {job.id}: {job.estado}")
+                continue
+        if una_vez:
+            break
+        time.sleep(intervalo)
+
+
+def limpiar(dias):
+    """Borra los trabajos terminados hace más de `dias` días y sus ficheros."""
+    limite = datetime.utcnow() - timedelta(days=dias)
+    antiguos = Job.query.filter(Job.estado.in_(['terminado', 'error']), Job.fecha_fin < limite).all()
+    for job in antiguos:
+        if job.fichero:
+            try:
+                os.remove(ruta_fichero(job))
+            except OSError:
+                pass
+        db.session.delete(job)
+    db.session.commit()
+    return len(antiguos)
+
+
+def init_app(app):
+    """Configuración y órdenes `flask jobs ...`."""
+    app.config.setdefault('JOBS_DIR', os.environ.get('JOBS_DIR', os.path.join(app.instance_path, 'jobs')))
+    app.config.setdefault('JOBS_TIMEOUT', int(os.environ.get('JOBS_TIMEOUT', 3600)))
+    app.config.setdefault('JOBS_MAX_INTENTOS', int(os.environ.get('JOBS_MAX_INTENTOS', 2)))
+    app.config.setdefault('JOBS_EN_BD', os.environ.get('JOBS_EN_BD', '0') == '1')
+
+    # Registra las tareas
+    from app import tareas  # noqa: F401
+
+    @app.cli.group('jobs')
+    def jobs_cli():
+        """Cola de trabajos en segundo plano."""
+
+    @jobs_cli.command('worker')
+    @click.option('--procesos', default=1, show_default=True, help='Número de procesos worker')
+    @click.option('--intervalo', default=2.0, show_default=True, help='Segundos entre consultas a la cola vacía')
+    @click.option('--una-vez', is_flag=True, help='Sale al vaciar la cola')
+    def worker(procesos, intervalo, una_vez):
+        """Ejecuta los trabajos pendientes."""
+        if procesos <= 1:
+            trabajar(app, intervalo, una_vez)
+            return
+
+        hijos = []
+        for _ in range(procesos):
+            pid = os.fork()
+            if pid == 0:
+                # Conexiones propias en cada proceso
+                with app.app_context():
+                    for engine in db.engines.values():
+                        engine.dispose(close=False)
+                trabajar(app, intervalo, una_vez)
+                os._exit(0)
+            hijos.append(pid)
+
+        def _reenviar(signum, frame):
+            for pid in hijos:
+                try:
+                    os.kill(pid, signum)
+                except OSError:
+                    pass
+
+        signal.signal(signal.SIGTERM, _reenviar)
+        signal.signal(signal.SIGINT, _reenviar)
+        for pid in hijos:
+            os.waitpid(pid, 0)
+
+    @jobs_cli.command('limpiar')
+    @click.option('--dias', default=7, show_default=True, help='Antigüedad mínima de los trabajos a borrar')
+    def limpiar_cmd(dias):
+        """Borra los trabajos terminados antiguos y sus ficheros."""
+        click.echo(f"OK: {limpiar(dias)} trabajo(s) borrado(s).")
@@ -1,11 +1,24 @@
 """
 Modelos SQLAlchemy para la aplicación de clínica dental.
 """
-from app import db
+from app import db, dinero
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, time
+from datetime import datetime, time, timedelta
+from decimal import Decimal
 import json
+import re
+import time as reloj
+import unicodedata
+
+
+def normalizar_texto(texto):
+    """Pasa a minúsculas, elimina tildes y colapsa espacios (para búsquedas)."""
+    if not texto:
+        return ''
+    texto = unicodedata.normalize('NFKD', texto)
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return re.sub(r'\s+', ' ', texto.lower()).strip()
 
 
 class User(UserMixin, db.Model):
@@ -64,6 +77,7 @@ class Patient(db.Model):
     notas_generales = db.Column(db.Text)
     password_hash = db.Column(db.String(255))  # Para login de pacientes
     activo = db.Column(db.Boolean, default=True, nullable=False)
+    busqueda = db.Column(db.Text, nullable=False, default='', server_default='', index=True)  # Texto normalizado para el buscador (ver app/search.py)
     
     # Relaciones
     appointments = db.relationship('Appointment', backref='patient', lazy='dynamic', cascade='all, delete-orphan')
@@ -87,10 +101,30 @@ class Patient(db.Model):
         """Retorna el nombre completo del paciente."""
         return f"{self.nombre} {self.apellidos}"
     
+    def texto_busqueda(self):
+        """Texto normalizado por el que se indexa al paciente (apellidos primero)."""
+        return normalizar_texto(' '.join(
+            v for v in [self.apellidos, self.nombre, self.email, self.dni] if v
+        ))
+    
     def __repr__(self):
         return f'<Patient {self.nombre_completo()}>'
 
 
+@db.event.listens_for(Patient, 'before_insert')
+@db.event.listens_for(Patient, 'before_update')
+def _actualizar_busqueda_paciente(mapper, connection, target):
+    """Mantiene sincronizada la columna de búsqueda en cada escritura."""
+    target.busqueda = target.texto_busqueda()
+
+
+@db.event.listens_for(Patient.__table__, 'after_create')
+def _crear_indices_busqueda(target, connection, **kw):
+    """Crea los índices de texto del buscador al crear la tabla."""
+    from app.search import instalar_indices_busqueda
+    instalar_indices_busqueda(connection)
+
+
 class Appointment(db.Model):
     """Cita médica."""
     __tablename__ = 'appointments'
@@ -106,11 +140,38 @@ class Appointment(db.Model):
     estado = db.Column(db.String(50), default='programada', nullable=False)  # programada, confirmada, cancelada, realizada
     notas = db.Column(db.Text)
     fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     def __repr__(self):
         return f'<Appointment {self.id} - {self.patient.nombre_completo()}>'
 
 
+@db.event.listens_for(Appointment.__table__, 'after_create')
+def _crear_restriccion_solapes(target, connection, **kw):
+    """Crea la restricción de no solapamiento de citas al crear la tabla."""
+    from app.scheduling import instalar_restriccion_solapes
+    instalar_restriccion_solapes(connection)
+
+
+def _renovar_citas(connection, columna, valor):
+    """Marca como modificadas las citas que muestran el nombre cambiado (ETag del calendario)."""
+    citas = Appointment.__table__
+    connection.execute(citas.update().where(citas.c[columna] == valor).values(fecha_actualizacion=datetime.utcnow()))
+
+
+@db.event.listens_for(Patient, 'after_update')
+def _renombrar_paciente(mapper, connection, target):
+    estado = db.inspect(target)
+    if estado.attrs.nombre.history.has_changes() or estado.attrs.apellidos.history.has_changes():
+        _renovar_citas(connection, 'patient_id', target.id)
+
+
+@db.event.listens_for(User, 'after_update')
+def _renombrar_usuario(mapper, connection, target):
+    if db.inspect(target).attrs.nombre.history.has_changes():
+        _renovar_citas(connection, 'dentist_id', target.id)
+
+
 class ClinicalRecord(db.Model):
     """Historia clínica general del paciente."""
     __tablename__ = 'clinical_records'
@@ -161,7 +222,7 @@ class TreatmentPlan(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('patients.id'), nullable=False, index=True)
     dentist_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
-    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
     descripcion_general = db.Column(db.Text)
     estado = db.Column(db.String(50), default='propuesto', nullable=False)  # propuesto, en_curso, finalizado, cancelado
     coste_estimado = db.Column(db.Numeric(10, 2), default=0)
@@ -196,33 +257,53 @@ class Invoice(db.Model):
     
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('patients.id'), nullable=False, index=True)
-    fecha_emision = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    fecha_emision = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
     total = db.Column(db.Numeric(10, 2), nullable=False)
     estado_pago = db.Column(db.String(50), default='pendiente', nullable=False)  # pendiente, pagado, parcial
     metodo_pago = db.Column(db.String(50))  # efectivo, tarjeta, transferencia, financiación
+    total_pagado = db.Column(db.Numeric(10, 2), default=0, server_default='0', nullable=False)  # Suma de pagos, mantenida por los eventos de Payment
     
     # Relaciones
     payments = db.relationship('Payment', backref='invoice', lazy='dynamic', cascade='all, delete-orphan')
     
     def calcular_total_pagado(self):
         """Calcula el total pagado de esta factura."""
-        return sum([p.cantidad for p in self.payments])
+        return self.total_pagado or Decimal('0')
     
     def calcular_saldo_pendiente(self):
         """Calcula el saldo pendiente de esta factura."""
-        return float(self.total) - float(self.calcular_total_pagado())
+        return dinero.saldo_pendiente(self.total, self.calcular_total_pagado())
     
     def actualizar_estado_pago(self):
         """Actualiza el estado de pago según los pagos realizados."""
-        total_pagado = self.calcular_total_pagado()
-        if total_pagado == 0:
-            self.estado_pago = 'pendiente'
-        elif total_pagado >= float(self.total):
-            self.estado_pago = 'pagado'
-        else:
-            self.estado_pago = 'parcial'
+        # Volcar los pagos pendientes para que total_pagado esté al día
+        db.session.flush()
+        self.estado_pago = dinero.estado_pago(self.total, self.calcular_total_pagado())
         db.session.commit()
     
+    @classmethod
+    def recalcular_total_pagado(cls, invoice_ids=None):
+        """Recalcula total_pagado desde los pagos con un único UPDATE (todas o las indicadas)."""
+        suma_pagos = db.select(db.func.coalesce(db.func.sum(Payment.cantidad), 0)).where(
+            Payment.invoice_id == cls.id
+        ).scalar_subquery()
+        update = db.update(cls).values(total_pagado=suma_pagos)
+        if invoice_ids is not None:
+            update = update.where(cls.id.in_(invoice_ids))
+        db.session.execute(update.execution_options(synchronize_session=False))
+    
+    @classmethod
+    def recalcular_estado_pago(cls, invoice_ids=None):
+        """Recalcula estado_pago desde total_pagado con un único UPDATE (mismas reglas que dinero.estado_pago)."""
+        update = db.update(cls).values(estado_pago=db.case(
+            (cls.total_pagado <= 0, 'pendiente'),
+            (cls.total_pagado >= cls.total, 'pagado'),
+            else_='parcial'
+        ))
+        if invoice_ids is not None:
+            update = update.where(cls.id.in_(invoice_ids))
+        db.session.execute(update.execution_options(synchronize_session=False))
+    
     def __repr__(self):
         return f'<Invoice {self.id} - Patient {self.patient_id} - Total: {self.total}>'
 
@@ -232,9 +313,10 @@ class Payment(db.Model):
     __tablename__ = 'payments'
     
     id = db.Column(db.Integer, primary_key=True)
-    invoice_id = db.Column(db.Integer, db.ForeignKey('invoices.id'), nullable=False, index=True)
+    # active_history: al modificar un pago se necesita el valor anterior para ajustar total_pagado
+    invoice_id = db.column_property(db.Column(db.Integer, db.ForeignKey('invoices.id'), nullable=False, index=True), active_history=True)
     fecha_pago = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
-    cantidad = db.Column(db.Numeric(10, 2), nullable=False)
+    cantidad = db.column_property(db.Column(db.Numeric(10, 2), nullable=False), active_history=True)
     metodo_pago = db.Column(db.String(50), nullable=False)
     referencia = db.Column(db.String(100))  # Referencia de pago
     
@@ -242,6 +324,73 @@ class Payment(db.Model):
         return f'<Payment {self.id} - Invoice {self.invoice_id} - Cantidad: {self.cantidad}>'
 
 
+def _ajustar_total_pagado(connection, target, invoice_id, cantidad):
+    """Suma `cantidad` (puede ser negativa) al total_pagado de la factura de forma atómica."""
+    if not invoice_id or not cantidad:
+        return
+    facturas = Invoice.__table__
+    connection.execute(
+        facturas.update().where(facturas.c.id == invoice_id).values(
+            total_pagado=facturas.c.total_pagado + dinero.importe(cantidad)
+        )
+    )
+    # La factura en memoria queda desactualizada: se expira tras el flush
+    session = db.inspect(target).session
+    if session is not None:
+        session.info.setdefault('facturas_total_pagado', set()).add(invoice_id)
+
+
+@db.event.listens_for(Payment, 'after_insert')
+def _sumar_pago(mapper, connection, target):
+    _ajustar_total_pagado(connection, target, target.invoice_id, target.cantidad)
+
+
+@db.event.listens_for(Payment, 'after_delete')
+def _restar_pago(mapper, connection, target):
+    _ajustar_total_pagado(connection, target, target.invoice_id, -dinero.importe(target.cantidad))
+
+
+@db.event.listens_for(Payment, 'after_update')
+def _modificar_pago(mapper, connection, target):
+    estado = db.inspect(target)
+    historial_factura = estado.attrs.invoice_id.history
+    historial_cantidad = estado.attrs.cantidad.history
+    if not historial_factura.has_changes() and not historial_cantidad.has_changes():
+        return
+    factura_anterior = (historial_factura.deleted or [target.invoice_id])[0]
+    cantidad_anterior = (historial_cantidad.deleted or [target.cantidad])[0]
+    _ajustar_total_pagado(connection, target, factura_anterior, -dinero.importe(cantidad_anterior))
+    _ajustar_total_pagado(connection, target, target.invoice_id, target.cantidad)
+
+
+@db.event.listens_for(db.session, 'after_flush_postexec')
+def _expirar_total_pagado(session, flush_context):
+    """Fuerza a releer total_pagado de las facturas afectadas por pagos."""
+    for invoice_id in session.info.pop('facturas_total_pagado', set()):
+        factura = session.identity_map.get(db.inspect(Invoice).identity_key_from_primary_key((invoice_id,)))
+        if factura is not None:
+            session.expire(factura, ['total_pagado'])
+
+
+class FinancialSummary(db.Model):
+    """Resumen mensual de facturación por estado de pago (ver app/reporting.py)."""
+    __tablename__ = 'financial_summary'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    mes = db.Column(db.Date, nullable=False, index=True)  # Primer día del mes de emisión
+    estado_pago = db.Column(db.String(50), nullable=False)
+    num_facturas = db.Column(db.Integer, default=0, nullable=False)
+    total = db.Column(db.Numeric(12, 2), default=0, nullable=False)
+    total_pagos = db.Column(db.Numeric(12, 2), default=0, nullable=False)  # Pagos de las facturas del mes
+    base_imponible = db.Column(db.Numeric(12, 2), default=0, server_default='0', nullable=False)  # Suma de la base de cada factura
+    fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (db.UniqueConstraint('mes', 'estado_pago', name='_mes_estado_uc'),)
+    
+    def __repr__(self):
+        return f'<FinancialSummary {self.mes} - {self.estado_pago}: {self.total}>'
+
+
 class Notification(db.Model):
     """Registro de notificaciones enviadas a pacientes."""
     __tablename__ = 'notifications'
@@ -290,6 +439,7 @@ class ClinicSettings(db.Model):
     email = db.Column(db.String(120))
     web = db.Column(db.String(200))
     logo_url = db.Column(db.String(500))
+    logo_datos = db.deferred(db.Column(db.LargeBinary))  # Imagen del logo para los PDF (ver pdf.descargar_logo)
     numero_colegio = db.Column(db.String(50))  # Número de colegio profesional
     iban = db.Column(db.String(50))  # IBAN para facturas
     notas_pie_factura = db.Column(db.Text)  # Texto para el pie de página de facturas
@@ -306,10 +456,68 @@ class ClinicSettings(db.Model):
             db.session.commit()
         return settings
     
+    @classmethod
+    def crear_por_defecto(cls):
+        """Crea la fila de configuración en el primer arranque (si la tabla ya existe)."""
+        if not db.inspect(db.engine).has_table(cls.__tablename__):
+            return
+        if db.session.query(cls.id).first() is None:
+            db.session.add(cls(nombre_clinica='Clínica Dental'))
+            db.session.commit()
+    
+    @classmethod
+    def cached(cls):
+        """
+        Configuración de solo lectura guardada en memoria del proceso.
+        
+        Se recarga cuando este proceso guarda cambios y, como mucho, cada
+        CONFIGURACION_TTL segundos para ver los cambios hechos en otros workers.
+        """
+        entrada = _configuracion_cache
+        if entrada['settings'] is None or entrada['version'] != _configuracion_version[0] \
+                or reloj.monotonic() >= entrada['caduca']:
+            version = _configuracion_version[0]
+            settings = cls.query.first()
+            # Copia sin sesión: se puede usar entre peticiones sin DetachedInstanceError
+            copia = cls(**{c.key: getattr(settings, c.key) for c in cls.__table__.columns}) if settings \
+                else cls(nombre_clinica='Clínica Dental')
+            entrada.update(settings=copia, version=version, caduca=reloj.monotonic() + CONFIGURACION_TTL)
+        return entrada['settings']
+    
+    @staticmethod
+    def invalidar_cache():
+        """Fuerza a recargar la configuración en la próxima lectura de este proceso."""
+        _configuracion_version[0] += 1
+    
     def __repr__(self):
         return f'<ClinicSettings {self.nombre_clinica}>'
 
 
+# Caché por proceso de ClinicSettings.cached()
+CONFIGURACION_TTL = 30
+_configuracion_version = [0]
+_configuracion_cache = {'settings': None, 'version': None, 'caduca': 0.0}
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def _anotar_cambio_configuracion(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, ClinicSettings):
+            session.info['configuracion_modificada'] = True
+            break
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def _invalidar_configuracion(session):
+    if session.info.pop('configuracion_modificada', False):
+        ClinicSettings.invalidar_cache()
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def _descartar_cambio_configuracion(session):
+    session.info.pop('configuracion_modificada', None)
+
+
 class DoctorSchedule(db.Model):
     """Horario de trabajo de un doctor (días de la semana que trabaja)."""
     __tablename__ = 'doctor_schedules'
@@ -421,3 +629,41 @@ class Honorario(db.Model):
 
 
 
+
+
+class Job(db.Model):
+    """Trabajo en segundo plano (PDF, exportaciones) ejecutado por los workers de app/jobs.py."""
+    __tablename__ = 'jobs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(50), nullable=False)  # nombre de la tarea registrada en app/jobs.py
+    parametros = db.Column(db.Text, default='{}', nullable=False)  # JSON
+    estado = db.Column(db.String(20), default='pendiente', nullable=False)  # pendiente, en_curso, terminado, error
+    progreso = db.Column(db.Integer, default=0, nullable=False)  # 0-100
+    mensaje = db.Column(db.Text)
+    fichero = db.Column(db.String(255))  # Ruta relativa al directorio de trabajos
+    nombre_fichero = db.Column(db.String(255))  # Nombre con el que se descarga
+    contenido = db.deferred(db.Column(db.LargeBinary))  # Fichero guardado en la BD (JOBS_EN_BD)
+    intentos = db.Column(db.Integer, default=0, nullable=False)
+    worker = db.Column(db.String(100))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True, index=True)
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    fecha_inicio = db.Column(db.DateTime)
+    fecha_fin = db.Column(db.DateTime)
+    
+    # Relación
+    user = db.relationship('User', backref=db.backref('jobs', lazy='dynamic'))
+    
+    # Los workers buscan el siguiente pendiente por estado e id
+    __table_args__ = (db.Index('ix_jobs_estado_id', 'estado', 'id'),)
+    
+    def get_parametros(self):
+        """Parámetros de la tarea como diccionario."""
+        return json.loads(self.parametros or '{}')
+    
+    @property
+    def terminado(self):
+        return self.estado in ('terminado', 'error')
+    
+    def __repr__(self):
+        return f'<Job {self.id} {self.tipo} {self.estado}>'
@@ -0,0 +1,115 @@
+"""
+Paginación por cursor (keyset) para los listados del panel.
+
+En lugar de OFFSET, cada página se pide con un cursor que guarda los valores
+de ordenación de la última fila mostrada; la consulta continúa con
+`(columnas) > (valores)` y usa el índice, así que el coste de una página no
+depende de cuántas filas haya antes. La última columna de ordenación debe
+ser el id para que el orden sea total.
+"""
+from app import db
+from datetime import date, datetime
+import base64
+import json
+
+POR_PAGINA = 20
+
+
+def _a_json(valor):
+    if isinstance(valor, (date, datetime)):
+        return valor.isoformat()
+    return valor
+
+
+def codificar_cursor(valores):
+    """Convierte los valores de ordenación de la última fila en un cursor opaco."""
+    return base64.urlsafe_b64encode(json.dumps([_a_json(v) for v in valores]).encode()).decode()
+
+
+def decodificar_cursor(cursor):
+    """Inverso de codificar_cursor; devuelve None si el cursor no es válido."""
+    try:
+        valores = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+    return valores if isinstance(valores, list) else None
+
+
+def _desde_json(columna, valor):
+    """
+    Recupera el tipo Python de un valor del cursor según el tipo de la columna.
+
+    Lanza ValueError o TypeError si el valor no corresponde a la columna.
+    """
+    if valor is None:
+        return None
+    try:
+        tipo = columna.type.python_type
+    except NotImplementedError:
+        tipo = None
+    if tipo is datetime:
+        return datetime.fromisoformat(valor)
+    if tipo is date:
+        return date.fromisoformat(valor)
+    if not isinstance(valor, tipo or (str, int, float)):
+        raise TypeError(f'Valor de cursor no válido: {valor!r}')
+    return valor
+
+
+def valores_cursor(cursor, columnas):
+    """
+    Valores de ordenación de un cursor, con el tipo de cada columna.
+
+    Devuelve None si no hay cursor o no es válido (manipulado, de otro
+    listado...): el listado vuelve a empezar por la primera página.
+    """
+    valores = decodificar_cursor(cursor) if cursor else None
+    if not valores or len(valores) != len(columnas):
+        return None
+    try:
+        return [_desde_json(c, v) for c, v in zip(columnas, valores)]
+    except (ValueError, TypeError):
+        return None
+
+
+class PaginaCursor:
+    """Página de resultados con el cursor para pedir la siguiente."""
+
+    def __init__(self, items, cursor_siguiente):
+        self.items = items
+        self.cursor_siguiente = cursor_siguiente
+
+    @property
+    def has_next(self):
+        return self.cursor_siguiente is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def paginar(query, columnas, cursor=None, por_pagina=POR_PAGINA, descendente=False):
+    """
+    Devuelve una PaginaCursor de `query` ordenada por `columnas` (la última, el id).
+
+    Todas las columnas se ordenan en el mismo sentido; con `descendente` la
+    siguiente página continúa hacia valores menores.
+    """
+    valores = valores_cursor(cursor, columnas)
+    if valores:
+        fila = db.tuple_(*columnas)
+        limite = db.tuple_(*[db.literal(v, type_=c.type) for c, v in zip(columnas, valores)])
+        query = query.filter(fila < limite if descendente else fila > limite)
+
+    orden = [c.desc() for c in columnas] if descendente else list(columnas)
+    items = query.order_by(*orden).limit(por_pagina + 1).all()
+
+    cursor_siguiente = None
+    if len(items) > por_pagina:
+        items = items[:por_pagina]
+        ultimo = items[-1]
+        cursor_siguiente = codificar_cursor([getattr(ultimo, c.key) for c in columnas])
+
+    return PaginaCursor(items, cursor_siguiente)
@@ -0,0 +1,399 @@
+"""
+Generación de los PDF de la clínica (honorarios, presupuestos, facturas).
+
+Los estilos de párrafo y de tabla y el logo se construyen una vez por proceso
+y se comparten entre documentos. Cada documento solo crea su plantilla de
+página: los Frame guardan estado durante el build y no se pueden compartir
+entre hilos.
+
+Todos los documentos usan DocumentoClinica: cabecera con el logo y los datos
+de ClinicSettings y pie con notas_pie_factura y el número de página. Varios
+documentos pueden ir seguidos en un mismo PDF (lotes de facturas): cada uno
+empieza con InicioDocumento y numera sus páginas desde 1.
+"""
+from app import dinero
+from datetime import datetime
+from functools import lru_cache
+from io import BytesIO
+from flask import current_app, make_response
+from reportlab.lib import colors
+from reportlab.lib.enums import TA_CENTER, TA_RIGHT
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import cm
+from reportlab.lib.utils import ImageReader
+from reportlab.platypus import (BaseDocTemplate, PageTemplate, Frame, Flowable, Table, TableStyle, Paragraph,
+                                Spacer, PageBreak)
+from urllib.request import urlopen
+from xml.sax.saxutils import escape
+import os
+
+COLOR_PRIMARIO = colors.HexColor('#0d6efd')
+COLOR_TEXTO = colors.HexColor('#495057')
+COLOR_SECUNDARIO = colors.HexColor('#6c757d')
+COLOR_BORDE = colors.HexColor('#dee2e6')
+COLOR_FILA_ALTERNA = colors.HexColor('#f8f9fa')
+COLOR_TOTAL = colors.HexColor('#e9ecef')
+
+MARGEN = 2 * cm
+ALTO_CABECERA = 2.2 * cm
+ALTO_LOGO = 1.6 * cm
+
+
+# ---------- Recursos compartidos (una vez por proceso) ----------
+
+@lru_cache(maxsize=None)
+def estilos():
+    """Estilos de párrafo de todos los documentos."""
+    base = getSampleStyleSheet()
+    return {
+        'normal': base['Normal'],
+        'titulo': ParagraphStyle('Titulo', parent=base['Heading1'], fontSize=18,
+                                 textColor=COLOR_PRIMARIO, spaceAfter=30, alignment=TA_CENTER),
+        'subtitulo': ParagraphStyle('Subtitulo', parent=base['Normal'], fontSize=12,
+                                    textColor=COLOR_TEXTO, spaceAfter=20, alignment=TA_CENTER),
+        'seccion': ParagraphStyle('Seccion', parent=base['Heading3'], textColor=COLOR_TEXTO, spaceBefore=12),
+        'derecha': ParagraphStyle('Derecha', parent=base['Normal'], alignment=TA_RIGHT),
+        'nota': ParagraphStyle('Nota', parent=base['Normal'], fontSize=9, textColor=COLOR_SECUNDARIO,
+                               alignment=TA_CENTER, spaceBefore=20),
+    }
+
+
+@lru_cache(maxsize=None)
+def estilo_tabla(con_total=True):
+    """Tabla con cabecera azul, filas alternas y, opcionalmente, fila final de total."""
+    ultima_fila = -2 if con_total else -1
+    comandos = [
+        # Encabezado
+        ('BACKGROUND', (0, 0), (-1, 0), COLOR_PRIMARIO),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+        ('ALIGN', (-1, 0), (-1, -1), 'RIGHT'),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, 0), 12),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+        ('TOPPADDING', (0, 0), (-1, 0), 12),
+
+        # Filas de datos
+        ('FONTNAME', (0, 1), (-1, ultima_fila), 'Helvetica'),
+        ('FONTSIZE', (0, 1), (-1, ultima_fila), 10),
+        ('ROWBACKGROUNDS', (0, 1), (-1, ultima_fila), [colors.white, COLOR_FILA_ALTERNA]),
+        ('GRID', (0, 0), (-1, -1), 1, COLOR_BORDE),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('LEFTPADDING', (0, 0), (-1, -1), 8),
+        ('RIGHTPADDING', (0, 0), (-1, -1), 8),
+        ('TOPPADDING', (0, 1), (-1, ultima_fila), 8),
+        ('BOTTOMPADDING', (0, 1), (-1, ultima_fila), 8),
+    ]
+    if con_total:
+        comandos += [
+            ('BACKGROUND', (0, -1), (-1, -1), COLOR_TOTAL),
+            ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, -1), (-1, -1), 11),
+            ('TOPPADDING', (0, -1), (-1, -1), 12),
+            ('BOTTOMPADDING', (0, -1), (-1, -1), 12),
+        ]
+    return TableStyle(comandos)
+
+
+def descargar_logo(origen):
+    """
+    Contenido del logo (URL o ruta /static/...) si es una imagen legible, o None.
+
+    Se llama al guardar la configuración: los PDF usan los bytes guardados en
+    ClinicSettings.logo_datos y nunca descargan nada mientras se generan.
+    """
+    if not origen:
+        return None
+    if origen.startswith('/static/'):
+        origen = os.path.join(current_app.static_folder, origen[len('/static/'):])
+    try:
+        if origen.startswith(('http://', 'https://')):
+            with urlopen(origen, timeout=5) as respuesta:
+                datos = respuesta.read()
+        else:
+            with open(origen, 'rb') as f:
+                datos = f.read()
+        ImageReader(BytesIO(datos)).getSize()  # falla aquí si el formato no se puede leer
+        return datos
+    except Exception:
+        current_app.logger.warning('No se pudo leer el logo de la clínica: %s', origen)
+        return None
+
+
+@lru_cache(maxsize=4)
+def _imagen_logo(datos):
+    return ImageReader(BytesIO(datos))
+
+
+def logo_clinica(configuracion):
+    """Logo guardado en ClinicSettings.logo_datos como ImageReader (uno por proceso y versión del logo)."""
+    datos = configuracion.logo_datos if configuracion else None
+    if not datos:
+        return None
+    return _imagen_logo(datos)
+
+
+def importe(valor):
+    """Importe con dos decimales y símbolo de euro."""
+    return f"{dinero.importe(valor)} €"
+
+
+def texto(valor):
+    """Texto de usuario listo para un Paragraph (escapa <, > y &)."""
+    return escape(str(valor)) if valor is not None else ''
+
+
+# ---------- Plantilla de documento ----------
+
+class InicioDocumento(Flowable):
+    """Marca invisible del comienzo de un documento dentro de un PDF con varios."""
+
+    def wrap(self, ancho, alto):
+        return 0, 0
+
+    def draw(self):
+        pass
+
+
+class DocumentoClinica(BaseDocTemplate):
+    """A4 con cabecera (logo y datos de la clínica) y pie (notas y número de página)."""
+
+    def __init__(self, destino, configuracion=None, titulo='', pie=None, **kwargs):
+        kwargs.setdefault('pagesize', A4)
+        for margen in ('leftMargin', 'rightMargin', 'bottomMargin'):
+            kwargs.setdefault(margen, MARGEN)
+        kwargs.setdefault('topMargin', MARGEN + (ALTO_CABECERA if configuracion else 0))
+        super().__init__(destino, title=titulo, author=configuracion.nombre_clinica if configuracion else '',
+                         **kwargs)
+        self.configuracion = configuracion
+        self.logo = logo_clinica(configuracion)
+        self.pie = pie if pie is not None else (configuracion.notas_pie_factura if configuracion else None)
+        self.primera_pagina = 1
+        marco = Frame(self.leftMargin, self.bottomMargin, self.width, self.height, id='contenido')
+        self.addPageTemplates([PageTemplate(id='clinica', frames=[marco], onPage=self._decorar_cabecera,
+                                            onPageEnd=self._decorar_pie)])
+
+    def afterFlowable(self, flowable):
+        if isinstance(flowable, InicioDocumento):
+            self.primera_pagina = self.page
+
+    def _decorar_cabecera(self, canvas, doc):
+        if self.configuracion:
+            canvas.saveState()
+            self._dibujar_cabecera(canvas, *self.pagesize)
+            canvas.restoreState()
+
+    def _decorar_pie(self, canvas, doc):
+        # Al final de la página: ya se sabe a qué documento del lote pertenece
+        canvas.saveState()
+        ancho = self.pagesize[0]
+        canvas.setFont('Helvetica', 8)
+        canvas.setFillColor(COLOR_SECUNDARIO)
+        if self.pie:
+            canvas.drawCentredString(ancho / 2, MARGEN / 2 + 10, self.pie.replace('\n', ' ')[:180])
+        canvas.drawRightString(ancho - self.rightMargin, MARGEN / 2, f'Página {doc.page - self.primera_pagina + 1}')
+        canvas.restoreState()
+
+    def _dibujar_cabecera(self, canvas, ancho, alto):
+        config = self.configuracion
+        arriba = alto - MARGEN
+        x = self.leftMargin
+        if self.logo is not None:
+            ancho_logo, alto_logo = self.logo.getSize()
+            escala = ALTO_LOGO / alto_logo
+            canvas.drawImage(self.logo, x, arriba - ALTO_LOGO, width=ancho_logo * escala, height=ALTO_LOGO,
+                             mask='auto')
+            x += ancho_logo * escala + 0.5 * cm
+
+        canvas.setFillColor(COLOR_TEXTO)
+        canvas.setFont('Helvetica-Bold', 12)
+        canvas.drawString(x, arriba - 12, config.nombre_clinica or '')
+        canvas.setFont('Helvetica', 8)
+        lineas = [
+            f'NIF/CIF: {config.nif_cif}' if config.nif_cif else '',
+            ', '.join(v for v in [config.direccion, config.codigo_postal, config.ciudad, config.provincia] if v),
+            ' · '.join(v for v in [config.telefono, config.email, config.web] if v),
+        ]
+        y = arriba - 24
+        for linea in filter(None, lineas):
+            canvas.drawString(x, y, linea[:120])
+            y -= 10
+
+        canvas.setStrokeColor(COLOR_BORDE)
+        canvas.line(self.leftMargin, arriba - ALTO_CABECERA + 0.4 * cm,
+                    ancho - self.rightMargin, arriba - ALTO_CABECERA + 0.4 * cm)
+
+
+def renderizar(story, configuracion=None, titulo='', pie=None):
+    """Construye el documento y devuelve los bytes del PDF."""
+    buffer = BytesIO()
+    DocumentoClinica(buffer, configuracion=configuracion, titulo=titulo, pie=pie).build(story)
+    return buffer.getvalue()
+
+
+def respuesta_pdf(datos, nombre_fichero, adjunto=False):
+    """Respuesta HTTP con un PDF."""
+    response = make_response(datos)
+    response.headers['Content-Type'] = 'application/pdf'
+    response.headers['Content-Disposition'] = \
+        f'{"attachment" if adjunto else "inline"}; filename={nombre_fichero.replace(" ", "_")}'
+    return response
+
+
+def tabla_importes(cabecera, filas, total=None, col_widths=None):
+    """Tabla con la última columna de importes y, si se indica, fila de total."""
+    datos = [cabecera] + filas
+    if total is not None:
+        datos.append(['TOTAL'] + [''] * (len(cabecera) - 2) + [importe(total)])
+    tabla = Table(datos, colWidths=col_widths, repeatRows=1)
+    tabla.setStyle(estilo_tabla(total is not None))
+    return tabla
+
+
+# ---------- Documentos ----------
+
+def pdf_honorarios(doctor, honorarios, configuracion=None):
+    """Lista de honorarios configurados para un doctor."""
+    e = estilos()
+    story = [
+        Paragraph("HONORARIOS MÉDICOS", e['titulo']),
+        Paragraph(f"Dr./Dra. {texto(doctor.nombre)}", e['subtitulo']),
+        Paragraph(f"Fecha de generación: {datetime.now().strftime('%d/%m/%Y %H:%M')}", e['normal']),
+        Spacer(1, 0.5 * cm),
+    ]
+
+    if not honorarios:
+        story.append(Paragraph("No hay honorarios configurados para este doctor.", e['normal']))
+    else:
+        filas = [[h.nombre_tratamiento, f"{h.precio:.2f}"] for h in honorarios]
+        total = dinero.sumar(h.precio for h in honorarios)
+        story.append(tabla_importes(['Tratamiento', 'Precio Honorario (€)'], filas, total,
+                                    col_widths=[12 * cm, 4 * cm]))
+        story.append(Spacer(1, 0.5 * cm))
+        story.append(Paragraph("Este documento contiene los honorarios configurados para el doctor.", e['nota']))
+
+    return renderizar(story, configuracion, titulo=f'Honorarios {doctor.nombre}', pie='')
+
+
+def pdf_presupuesto(plan, items, configuracion=None):
+    """Presupuesto de un plan de tratamiento."""
+    e = estilos()
+    story = [
+        Paragraph("PRESUPUESTO", e['titulo']),
+        Paragraph(f"Paciente: {texto(plan.patient.nombre_completo())}", e['subtitulo']),
+        Paragraph(f"Dentista: {texto(plan.dentist_user.nombre)}", e['normal']),
+        Paragraph(f"Fecha: {plan.fecha_creacion.strftime('%d/%m/%Y')}", e['normal']),
+    ]
+    if plan.descripcion_general:
+        story.append(Paragraph(texto(plan.descripcion_general), e['normal']))
+    story.append(Spacer(1, 0.5 * cm))
+
+    filas = [[item.nombre_tratamiento, item.pieza_dental or '-',
+              item.fecha_prevista.strftime('%d/%m/%Y') if item.fecha_prevista else '-',
+              importe(item.precio)] for item in items]
+    total = dinero.sumar(item.precio for item in items)
+    story.append(tabla_importes(['Tratamiento', 'Pieza', 'Fecha prevista', 'Precio'], filas, total,
+                                col_widths=[8 * cm, 2 * cm, 3 * cm, 3 * cm]))
+    story.append(Paragraph("Precios con IVA incluido. Presupuesto válido durante 30 días desde su fecha de emisión.",
+                           e['nota']))
+
+    return renderizar(story, configuracion, titulo=f'Presupuesto {plan.id}')
+
+
+def pdf_liquidacion_honorarios(doctor, filas, fecha_desde, fecha_hasta, configuracion=None):
+    """
+    Honorarios devengados por un doctor en un periodo.
+
+    `filas` son tuplas (item, paciente, honorario) de los tratamientos realizados.
+    """
+    e = estilos()
+    story = [
+        Paragraph("LIQUIDACIÓN DE HONORARIOS", e['titulo']),
+        Paragraph(f"Dr./Dra. {texto(doctor.nombre)}", e['subtitulo']),
+        Paragraph(f"Periodo: {fecha_desde.strftime('%d/%m/%Y')} - {fecha_hasta.strftime('%d/%m/%Y')}", e['normal']),
+        Spacer(1, 0.5 * cm),
+    ]
+    if not filas:
+        story.append(Paragraph("No hay tratamientos realizados en el periodo.", e['normal']))
+    else:
+        tabla = [[item.fecha_realizacion.strftime('%d/%m/%Y') if item.fecha_realizacion else '-',
+                  item.nombre_tratamiento, paciente.nombre_completo(), importe(item.precio), importe(honorario.precio)]
+                 for item, paciente, honorario in filas]
+        total = dinero.sumar(honorario.precio for _, _, honorario in filas)
+        story.append(tabla_importes(['Fecha', 'Tratamiento', 'Paciente', 'Facturado', 'Honorario'], tabla, total,
+                                    col_widths=[2.2 * cm, 4.8 * cm, 4.6 * cm, 2.2 * cm, 2.2 * cm]))
+    return renderizar(story, configuracion, titulo=f'Honorarios {doctor.nombre}', pie='')
+
+
+def contenido_factura(factura, pagos, configuracion=None):
+    """Flowables de una factura (para un PDF suelto o para un lote)."""
+    e = estilos()
+    paciente = factura.patient
+    base, iva = dinero.desglosar_iva(factura.total)
+
+    datos = Table([
+        [Paragraph(f"<b>Factura nº</b> {factura.id}", e['normal']),
+         Paragraph(f"<b>Paciente:</b> {texto(paciente.nombre_completo())}", e['normal'])],
+        [Paragraph(f"<b>Fecha:</b> {factura.fecha_emision.strftime('%d/%m/%Y')}", e['normal']),
+         Paragraph(f"<b>DNI:</b> {texto(paciente.dni or '-')}", e['normal'])],
+        ['', Paragraph(texto(paciente.direccion or ''), e['normal'])],
+    ], colWidths=[6 * cm, 11 * cm])
+    datos.setStyle(TableStyle([('VALIGN', (0, 0), (-1, -1), 'TOP'), ('LEFTPADDING', (0, 0), (-1, -1), 0)]))
+
+    story = [
+        InicioDocumento(),
+        Paragraph("FACTURA", e['titulo']),
+        datos,
+        Spacer(1, 0.8 * cm),
+        tabla_importes(['Concepto', 'Importe'], [
+            ['Servicios odontológicos (base imponible)', importe(base)],
+            [f'IVA ({dinero.porcentaje_iva():g}%)', importe(iva)],
+        ], factura.total, col_widths=[13 * cm, 4 * cm]),
+    ]
+
+    if pagos:
+        story.append(Paragraph("Pagos", e['seccion']))
+        filas = [[p.fecha_pago.strftime('%d/%m/%Y'), p.metodo_pago, p.referencia or '-', importe(p.cantidad)]
+                 for p in pagos]
+        story.append(tabla_importes(['Fecha', 'Método', 'Referencia', 'Importe'], filas, factura.total_pagado,
+                                    col_widths=[3 * cm, 4 * cm, 6 * cm, 4 * cm]))
+
+    pendiente = factura.total - (factura.total_pagado or 0)
+    if pendiente > 0:
+        story.append(Spacer(1, 0.5 * cm))
+        story.append(Paragraph(f"<b>Pendiente de pago:</b> {importe(pendiente)}", e['derecha']))
+        if configuracion and configuracion.iban:
+            story.append(Paragraph(f"Pago por transferencia a la cuenta {texto(configuracion.iban)}", e['derecha']))
+    return story
+
+
+def pdf_factura(factura, pagos, configuracion=None):
+    """Una factura."""
+    return renderizar(contenido_factura(factura, pagos, configuracion), configuracion,
+                      titulo=f'Factura {factura.id}')
+
+
+class LoteFacturas:
+    """
+    Varias facturas en un solo PDF, una tras otra empezando cada una en página nueva.
+
+    Se añaden por bloques con `agregar` y se escribe todo con `guardar`; lo que
+    se guarda entre medias son flowables, no objetos de la base de datos.
+    """
+
+    def __init__(self, configuracion=None):
+        self.configuracion = configuracion
+        self.story = []
+        self.num_facturas = 0
+
+    def agregar(self, factura, pagos):
+        if self.story:
+            self.story.append(PageBreak())
+        self.story.extend(contenido_factura(factura, pagos, self.configuracion))
+        self.num_facturas += 1
+
+    def guardar(self, destino, titulo='Facturas'):
+        if not self.story:
+            self.story.append(Paragraph("No hay facturas en el periodo.", estilos()['normal']))
+        DocumentoClinica(destino, configuracion=self.configuracion, titulo=titulo).build(self.story)
@@ -0,0 +1,187 @@
+"""
+Instrumentación de rendimiento por petición.
+
+Mide para cada petición el número de consultas SQL y su tiempo, el tiempo de
+renderizado de plantillas y la latencia total. Lo añade a la respuesta como
+cabecera Server-Timing (solo para administradores) y lo acumula por endpoint
+en memoria del proceso (página /panel/debug/perf). Viene activada en modo
+debug; en producción se activa con PERF_ENABLED=1.
+
+Una sentencia SQL con la misma forma repetida PERF_N1_UMBRAL veces o más en
+una petición se marca como posible N+1 (p. ej. cargar `cita.patient` en un
+bucle).
+"""
+from collections import Counter, deque
+from flask import g, request, has_request_context, template_rendered, before_render_template
+from flask_login import current_user
+from app.models import User
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import os
+import re
+import threading
+import time
+
+# Listas de parámetros IN (?, ?, ?) y literales numéricos: misma forma de sentencia
+_LISTA_PARAMETROS = re.compile(r'\((?:\s*(?:\?|%\(\w+\)s|:\w+|\$\d+)\s*,)+\s*(?:\?|%\(\w+\)s|:\w+|\$\d+)\s*\)')
+_NUMERO = re.compile(r'\b\d+\b')
+_ESPACIOS = re.compile(r'\s+')
+
+
+def forma_sentencia(sentencia):
+    """Normaliza una sentencia SQL para agrupar las que solo cambian en los valores."""
+    sentencia = _LISTA_PARAMETROS.sub('(?)', sentencia)
+    sentencia = _NUMERO.sub('N', sentencia)
+    return _ESPACIOS.sub(' ', sentencia).strip()
+
+
+class EstadisticasEndpoint:
+    """Acumulado de las peticiones de un endpoint."""
+
+    def __init__(self):
+        self.peticiones = 0
+        self.tiempo_total = 0.0
+        self.tiempo_max = 0.0
+        self.sql_num = 0
+        self.sql_tiempo = 0.0
+        self.plantilla_tiempo = 0.0
+        self.peticiones_n1 = 0
+        self.sospechosas_n1 = {}  # forma -> máximo de repeticiones en una petición
+
+    @property
+    def tiempo_medio(self):
+        return self.tiempo_total / self.peticiones if self.peticiones else 0.0
+
+    @property
+    def sql_medio(self):
+        return self.sql_num / self.peticiones if self.peticiones else 0.0
+
+    @property
+    def sql_tiempo_medio(self):
+        return self.sql_tiempo / self.peticiones if self.peticiones else 0.0
+
+    @property
+    def plantilla_tiempo_medio(self):
+        return self.plantilla_tiempo / self.peticiones if self.peticiones else 0.0
+
+
+class Perf:
+    """Extensión de instrumentación (init_app como el resto de extensiones)."""
+
+    def __init__(self):
+        self.activo = False
+        self.umbral_n1 = 5
+        self.endpoints = {}
+        self.recientes = deque(maxlen=50)
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('PERF_ENABLED', os.environ.get('PERF_ENABLED', '1' if app.debug else '0') == '1')
+        app.config.setdefault('PERF_N1_UMBRAL', int(os.environ.get('PERF_N1_UMBRAL', 5)))
+        self.activo = app.config['PERF_ENABLED']
+        self.umbral_n1 = app.config['PERF_N1_UMBRAL']
+        app.extensions['perf'] = self
+        if not self.activo:
+            return
+
+        app.before_request(self._iniciar_peticion)
+        app.after_request(self._terminar_peticion)
+        before_render_template.connect(self._iniciar_plantilla, app)
+        template_rendered.connect(self._terminar_plantilla, app)
+
+    # ---------- Ciclo de la petición ----------
+
+    def _iniciar_peticion(self):
+        g._perf = {
+            'inicio': time.perf_counter(),
+            'sql_num': 0,
+            'sql_tiempo': 0.0,
+            'plantilla_tiempo': 0.0,
+            'plantillas': [],
+            'formas': Counter(),
+        }
+
+    def _iniciar_plantilla(self, sender, template, context, **extra):
+        datos = g.get('_perf')
+        if datos is not None:
+            datos['plantillas'].append(time.perf_counter())
+
+    def _terminar_plantilla(self, sender, template, context, **extra):
+        datos = g.get('_perf')
+        if datos is not None and datos['plantillas']:
+            inicio = datos['plantillas'].pop()
+            if not datos['plantillas']:  # solo el render exterior, sin contar anidados dos veces
+                datos['plantilla_tiempo'] += time.perf_counter() - inicio
+
+    def _terminar_peticion(self, respuesta):
+        datos = g.pop('_perf', None)
+        if datos is None:
+            return respuesta
+
+        total = time.perf_counter() - datos['inicio']
+        sospechosas = {forma: n for forma, n in datos['formas'].items() if n >= self.umbral_n1}
+
+        # Los tiempos internos no se enseñan a pacientes ni a visitantes
+        if isinstance(current_user._get_current_object(), User) and current_user.is_admin():
+            respuesta.headers.add('Server-Timing', ', '.join([
+                f'sql;dur={datos["sql_tiempo"] * 1000:.1f};desc="{datos["sql_num"]} consultas"',
+                f'tpl;dur={datos["plantilla_tiempo"] * 1000:.1f}',
+                f'total;dur={total * 1000:.1f}',
+            ]))
+
+        endpoint = request.endpoint or request.path
+        with self._lock:
+            estadisticas = self.endpoints.setdefault(endpoint, EstadisticasEndpoint())
+            estadisticas.peticiones += 1
+            estadisticas.tiempo_total += total
+            estadisticas.tiempo_max = max(estadisticas.tiempo_max, total)
+            estadisticas.sql_num += datos['sql_num']
+            estadisticas.sql_tiempo += datos['sql_tiempo']
+            estadisticas.plantilla_tiempo += datos['plantilla_tiempo']
+            if sospechosas:
+                estadisticas.peticiones_n1 += 1
+                for forma, n in sospechosas.items():
+                    estadisticas.sospechosas_n1[forma] = max(n, estadisticas.sospechosas_n1.get(forma, 0))
+            self.recientes.appendleft({
+                'momento': time.time(),
+                'metodo': request.method,
+                'ruta': request.path,  # sin la query string: puede llevar datos de pacientes
+                'endpoint': endpoint,
+                'estado': respuesta.status_code,
+                'total': total,
+                'sql_num': datos['sql_num'],
+                'sql_tiempo': datos['sql_tiempo'],
+                'n1': max(sospechosas.values()) if sospechosas else 0,
+            })
+        return respuesta
+
+    # ---------- Consulta de los datos ----------
+
+    def resumen(self):
+        """Estadísticas por endpoint, de más a menos tiempo acumulado."""
+        with self._lock:
+            return sorted(self.endpoints.items(), key=lambda item: item[1].tiempo_total, reverse=True)
+
+    def reiniciar(self):
+        with self._lock:
+            self.endpoints.clear()
+            self.recientes.clear()
+
+
+perf = Perf()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _antes_de_consulta(conn, cursor, statement, parameters, context, executemany):
+    conn.info['perf_inicio'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _despues_de_consulta(conn, cursor, statement, parameters, context, executemany):
+    if not perf.activo or not has_request_context():
+        return
+    datos = g.get('_perf')
+    if datos is not None:
+        datos['sql_num'] += 1
+        datos['sql_tiempo'] += time.perf_counter() - conn.info.get('perf_inicio', time.perf_counter())
+        datos['formas'][forma_sentencia(statement)] += 1
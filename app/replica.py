@@ -0,0 +1,107 @@
+"""
+Réplica de lectura opcional para informes y listados.
+
+Con REPLICA_DATABASE_URL configurada se añade un segundo bind ('replica') y
+las vistas decoradas con `replica.lectura` leen de él; el resto de vistas y
+todas las escrituras siguen en la base principal. Sin la variable, todo va a
+la principal y el decorador no hace nada.
+
+Lectura de lo propio escrito: tras un commit con cambios, la petición sigue
+en la principal hasta terminar y la sesión del usuario guarda el momento de
+la escritura; durante REPLICA_RETRASO segundos sus vistas de lectura también
+van a la principal, así que el redirect de un POST ya ve lo guardado aunque la
+réplica vaya con retraso.
+
+Las respuestas leídas de la réplica no se guardan en la caché de vistas
+(app/cache.py): sus versiones de etiquetas son las de la principal y la
+réplica puede ir con retraso. Las de la principal sí se guardan.
+
+Para pruebas vale como réplica una copia local de la base SQLite:
+    cp clinic.db /tmp/replica.db
+    REPLICA_DATABASE_URL=sqlite:////tmp/replica.db python run.py
+"""
+from app.database import opciones_motor
+from flask import g, has_request_context, session as sesion_usuario
+from flask_sqlalchemy.session import Session
+from functools import wraps
+from sqlalchemy import event
+import os
+import time
+
+BIND_REPLICA = 'replica'
+
+
+class SesionEnrutada(Session):
+    """Sesión de Flask-SQLAlchemy que manda las lecturas de las vistas de solo lectura a la réplica."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self._leer_de_replica(clause):
+            return self._db.engines[BIND_REPLICA]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _leer_de_replica(self, clause):
+        if not has_request_context() or not g.get('_leer_replica'):
+            return False
+        if self._flushing or self.info.get('replica_escritura'):
+            return False
+        if clause is not None and getattr(clause, 'is_dml', False):
+            return False
+        return BIND_REPLICA in self._db.engines
+
+
+def anotar_escritura(session):
+    """Lo que queda de petición (y de transacción) lee de la principal; también tras escrituras masivas."""
+    session.info['replica_escritura'] = True
+
+
+@event.listens_for(SesionEnrutada, 'after_flush')
+def _anotar_escritura(session, flush_context):
+    anotar_escritura(session)
+
+
+@event.listens_for(SesionEnrutada, 'after_commit')
+def _recordar_escritura(session):
+    if session.info.get('replica_escritura') and has_request_context():
+        sesion_usuario['_ultima_escritura'] = time.time()
+
+
+class Replica:
+    """Extensión de la réplica de lectura (init_app antes de db.init_app)."""
+
+    def __init__(self):
+        self.activa = False
+        self.retraso = 10
+
+    def init_app(self, app):
+        app.config.setdefault('REPLICA_DATABASE_URL', os.environ.get('REPLICA_DATABASE_URL'))
+        app.config.setdefault('REPLICA_RETRASO', int(os.environ.get('REPLICA_RETRASO', 10)))
+        url = app.config['REPLICA_DATABASE_URL']
+        if url and url.startswith('postgres://'):
+            url = url.replace('postgres://', 'postgresql://', 1)
+
+        self.activa = bool(url)
+        self.retraso = app.config['REPLICA_RETRASO']
+        if self.activa:
+            binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+            binds[BIND_REPLICA] = {'url': url, **opciones_motor(url)}
+        app.extensions['replica'] = self
+
+    def lectura(self, f):
+        """
+        Decorador para vistas que solo leen: sus consultas van a la réplica salvo
+        que el usuario haya escrito hace menos de REPLICA_RETRASO segundos.
+        Va debajo de login_required/role_required.
+        """
+        @wraps(f)
+        def envoltura(*args, **kwargs):
+            if self.activa and time.time() - sesion_usuario.get('_ultima_escritura', 0) > self.retraso:
+                g._leer_replica = True
+            return f(*args, **kwargs)
+        return envoltura
+
+    def en_uso(self):
+        """True si las consultas de la petición actual van a la réplica."""
+        return self.activa and has_request_context() and bool(g.get('_leer_replica'))
+
+
+replica = Replica()
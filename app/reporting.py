@@ -0,0 +1,325 @@
+"""
+Informes financieros de gestoría.
+
+Los totales de facturación se materializan en `financial_summary`: una fila
+por mes de emisión y estado de pago, con el número de facturas, su total y
+los pagos recibidos. La tabla se mantiene al día en el mismo commit en el
+que cambian facturas o pagos (se recalculan solo los meses afectados,
+bajo un bloqueo por mes para que dos commits simultáneos no se pisen).
+
+Los informes leen los meses cerrados de la tabla y calculan en vivo solo el
+mes en curso y los tramos de mes sueltos al principio o final del rango.
+
+También incluye el informe de honorarios de los doctores por periodo.
+"""
+from app import db
+from app.models import Invoice, Payment, FinancialSummary, Honorario, TreatmentItem, TreatmentPlan, Patient
+from app.dinero import desglosar_iva, base_sql
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+
+def inicio_mes(fecha):
+    """Primer día del mes de la fecha dada."""
+    return date(fecha.year, fecha.month, 1)
+
+
+def mes_siguiente(mes):
+    """Primer día del mes siguiente."""
+    return date(mes.year + 1, 1, 1) if mes.month == 12 else date(mes.year, mes.month + 1, 1)
+
+
+def anotar_desglose(facturas):
+    """Añade base_imponible e iva a cada factura para mostrarlos en las plantillas."""
+    for factura in facturas:
+        factura.base_imponible, factura.iva = desglosar_iva(factura.total)
+    return facturas
+
+
+# ==================== CÁLCULO ====================
+
+def _agregado_en_vivo(desde, hasta, estado=None):
+    """Agrega facturas y pagos con fecha de emisión en [desde, hasta)."""
+    filtros = [Invoice.fecha_emision >= desde, Invoice.fecha_emision < hasta]
+    if estado:
+        filtros.append(Invoice.estado_pago == estado)
+
+    return {
+        estado_pago: [numero, total or Decimal('0'), pagos or Decimal('0'), base or Decimal('0')]
+        for estado_pago, numero, total, pagos, base in db.session.query(
+            Invoice.estado_pago,
+            db.func.count(Invoice.id),
+            db.func.sum(Invoice.total),
+            db.func.sum(Invoice.total_pagado),
+            db.func.sum(base_sql(Invoice.total))
+        ).filter(*filtros).group_by(Invoice.estado_pago)
+    }
+
+
+def _agregado_materializado(mes_desde, mes_hasta, estado=None):
+    """Suma las filas de financial_summary de los meses en [mes_desde, mes_hasta)."""
+    query = db.session.query(
+        FinancialSummary.estado_pago,
+        db.func.sum(FinancialSummary.num_facturas),
+        db.func.sum(FinancialSummary.total),
+        db.func.sum(FinancialSummary.total_pagos),
+        db.func.sum(FinancialSummary.base_imponible)
+    ).filter(
+        FinancialSummary.mes >= mes_desde,
+        FinancialSummary.mes < mes_hasta
+    )
+    if estado:
+        query = query.filter(FinancialSummary.estado_pago == estado)
+
+    return {
+        estado_pago: [int(numero or 0), Decimal(total or 0), Decimal(pagos or 0), Decimal(base or 0)]
+        for estado_pago, numero, total, pagos, base in query.group_by(FinancialSummary.estado_pago)
+    }
+
+
+def resumen_rango(fecha_inicio, fecha_fin, estado=None):
+    """
+    Totales por estado de pago de las facturas emitidas entre dos fechas (incluidas).
+
+    Devuelve {estado_pago: (num_facturas, total, total_pagos, base_imponible)} con
+    importes Decimal. La base es la suma de la base de cada factura (app/dinero.py).
+    """
+    desde = datetime.combine(fecha_inicio, datetime.min.time())
+    hasta = datetime.combine(fecha_fin + timedelta(days=1), datetime.min.time())
+
+    # Meses completos y ya cerrados dentro del rango
+    primer_mes = inicio_mes(fecha_inicio)
+    if primer_mes < fecha_inicio:
+        primer_mes = mes_siguiente(primer_mes)
+    ultimo_mes = min(inicio_mes(fecha_fin + timedelta(days=1)), inicio_mes(date.today()))
+
+    partes = []
+    if primer_mes < ultimo_mes:
+        partes.append(_agregado_materializado(primer_mes, ultimo_mes, estado))
+        tramos = [(desde, datetime.combine(primer_mes, datetime.min.time())),
+                  (datetime.combine(ultimo_mes, datetime.min.time()), hasta)]
+    else:
+        tramos = [(desde, hasta)]
+
+    for tramo_desde, tramo_hasta in tramos:
+        if tramo_desde < tramo_hasta:
+            partes.append(_agregado_en_vivo(tramo_desde, tramo_hasta, estado))
+
+    resumen = {}
+    for parte in partes:
+        for estado_pago, valores in parte.items():
+            acumulado = resumen.setdefault(estado_pago, [0, Decimal('0'), Decimal('0'), Decimal('0')])
+            for i, valor in enumerate(valores):
+                acumulado[i] += valor
+
+    return {estado_pago: tuple(valores) for estado_pago, valores in resumen.items()}
+
+
+# ==================== MANTENIMIENTO DE LA TABLA ====================
+
+# Espacio de claves de los bloqueos consultivos de Postgres para los meses del resumen
+BLOQUEO_RESUMEN = 7007
+
+
+def _bloquear_meses(session, meses):
+    """
+    Serializa el recálculo de cada mes entre transacciones hasta el commit.
+
+    En Postgres toma un bloqueo consultivo por mes (en orden, para no cruzarse
+    con otra transacción): quien espera recalcula después del commit de la
+    otra, con sus datos ya visibles, en lugar de chocar con la restricción
+    única (mes, estado_pago) o dejar agregados de una instantánea vieja. En
+    SQLite las escrituras ya van de una en una.
+    """
+    conexion = session.connection()
+    if conexion.dialect.name != 'postgresql':
+        return
+    for mes in sorted(meses):
+        conexion.execute(db.text('SELECT pg_advisory_xact_lock(:espacio, :mes)'),
+                         {'espacio': BLOQUEO_RESUMEN, 'mes': mes.year * 100 + mes.month})
+
+
+def recalcular_meses(session, meses):
+    """Regenera las filas de financial_summary de los meses indicados."""
+    _bloquear_meses(session, meses)
+    for mes in sorted(meses):
+        desde = datetime.combine(mes, datetime.min.time())
+        hasta = datetime.combine(mes_siguiente(mes), datetime.min.time())
+
+        filas = [
+            {
+                'mes': mes,
+                'estado_pago': estado_pago,
+                'num_facturas': numero,
+                'total': total,
+                'total_pagos': pagos,
+                'base_imponible': base,
+                'fecha_actualizacion': datetime.utcnow()
+            }
+            for estado_pago, (numero, total, pagos, base) in _agregado_en_vivo(desde, hasta).items()
+        ]
+
+        session.execute(db.delete(FinancialSummary).where(FinancialSummary.mes == mes))
+        if filas:
+            session.execute(db.insert(FinancialSummary), filas)
+
+
+def recalcular_todo(session):
+    """Regenera financial_summary completa (carga inicial o reparación)."""
+    primera, ultima = session.query(
+        db.func.min(Invoice.fecha_emision),
+        db.func.max(Invoice.fecha_emision)
+    ).one()
+    session.execute(db.delete(FinancialSummary))
+    if primera is None:
+        return
+    meses = []
+    mes = inicio_mes(primera)
+    while mes <= inicio_mes(ultima):
+        meses.append(mes)
+        mes = mes_siguiente(mes)
+    recalcular_meses(session, meses)
+
+
+def anotar_facturas_modificadas(session, invoice_ids):
+    """Para escrituras masivas (sin objetos en la sesión): recalcula al hacer commit los meses de esas facturas."""
+    session.info.setdefault('resumen_facturas', set()).update(invoice_ids)
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def _anotar_meses_afectados(session, flush_context):
+    """Apunta los meses cuyas facturas o pagos han cambiado en este flush."""
+    meses = session.info.setdefault('resumen_meses', set())
+    facturas = session.info.setdefault('resumen_facturas', set())
+
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Invoice):
+            historial = db.inspect(obj).attrs.fecha_emision.history
+            for fecha in list(historial.added) + list(historial.unchanged) + list(historial.deleted):
+                if fecha:
+                    meses.add(inicio_mes(fecha))
+        elif isinstance(obj, Payment):
+            historial = db.inspect(obj).attrs.invoice_id.history
+            facturas.update(i for i in list(historial.added) + list(historial.unchanged) + list(historial.deleted) if i)
+
+
+@db.event.listens_for(db.session, 'before_flush')
+def _cargar_fechas_pendientes(session, flush_context, instances):
+    """
+    Carga la fecha de emisión de las facturas y la factura de los pagos que
+    se modifican o borran sin tenerlas cargadas (expiradas, load_only...): su
+    historial estaría vacío y el mes no se apuntaría. Antes del flush la fila
+    todavía existe.
+    """
+    with session.no_autoflush:
+        for obj in list(session.dirty) + list(session.deleted):
+            if isinstance(obj, Invoice) and obj.id is not None:
+                obj.fecha_emision
+            elif isinstance(obj, Payment) and obj.id is not None:
+                obj.invoice_id, obj.cantidad
+
+
+@db.event.listens_for(db.session, 'before_commit')
+def _actualizar_resumen(session):
+    """Recalcula los meses afectados dentro de la misma transacción."""
+    session.flush()
+    meses = session.info.pop('resumen_meses', set())
+    facturas = session.info.pop('resumen_facturas', set())
+
+    if facturas:
+        for (fecha,) in session.query(Invoice.fecha_emision).filter(Invoice.id.in_(facturas)):
+            meses.add(inicio_mes(fecha))
+
+    if meses:
+        recalcular_meses(session, meses)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def _descartar_meses_afectados(session):
+    session.info.pop('resumen_meses', None)
+    session.info.pop('resumen_facturas', None)
+
+
+# ==================== HONORARIOS ====================
+
+def _tratamientos_con_honorario(fecha_desde=None, fecha_hasta=None):
+    """Join de cada honorario con los tratamientos realizados que le corresponden."""
+    return db.session.query(Honorario).join(
+        TreatmentPlan, TreatmentPlan.dentist_id == Honorario.doctor_id
+    ).join(
+        TreatmentItem, db.and_(
+            TreatmentItem.treatment_plan_id == TreatmentPlan.id,
+            TreatmentItem.nombre_tratamiento == Honorario.nombre_tratamiento
+        )
+    ).filter(
+        TreatmentItem.estado == 'realizado',
+        *_filtro_realizacion(fecha_desde, fecha_hasta)
+    )
+
+
+def _filtro_realizacion(fecha_desde, fecha_hasta):
+    filtros = []
+    if fecha_desde:
+        filtros.append(TreatmentItem.fecha_realizacion >= fecha_desde)
+    if fecha_hasta:
+        filtros.append(TreatmentItem.fecha_realizacion <= fecha_hasta)
+    return filtros
+
+
+def resumen_honorarios(honorario_ids, fecha_desde=None, fecha_hasta=None):
+    """
+    Tratamientos realizados de cada honorario en el periodo (fechas incluidas).
+
+    Devuelve {honorario_id: (num_realizados, total_facturado, total_honorario)}.
+    """
+    if not honorario_ids:
+        return {}
+    filas = _tratamientos_con_honorario(fecha_desde, fecha_hasta).with_entities(
+        Honorario.id,
+        db.func.count(TreatmentItem.id),
+        db.func.coalesce(db.func.sum(TreatmentItem.precio), 0),
+        db.func.sum(Honorario.precio)
+    ).filter(Honorario.id.in_(honorario_ids)).group_by(Honorario.id)
+    return {
+        honorario_id: (numero, Decimal(facturado), Decimal(honorario))
+        for honorario_id, numero, facturado, honorario in filas
+    }
+
+
+def honorarios_por_doctor(fecha_desde=None, fecha_hasta=None, doctor_id=None):
+    """Total a pagar a cada doctor en el periodo: {doctor_id: (num_realizados, total_honorario)}."""
+    query = _tratamientos_con_honorario(fecha_desde, fecha_hasta).with_entities(
+        Honorario.doctor_id,
+        db.func.count(TreatmentItem.id),
+        db.func.sum(Honorario.precio)
+    )
+    if doctor_id:
+        query = query.filter(Honorario.doctor_id == doctor_id)
+    return {
+        doctor: (numero, Decimal(total))
+        for doctor, numero, total in query.group_by(Honorario.doctor_id)
+    }
+
+
+def detalle_honorarios(honorarios, fecha_desde=None, fecha_hasta=None):
+    """
+    Tratamientos realizados (item, plan, paciente) de los honorarios dados, en una consulta.
+
+    Devuelve {honorario_id: [(item, plan, paciente), ...]}.
+    """
+    claves = {(h.doctor_id, h.nombre_tratamiento): h.id for h in honorarios}
+    detalle = {h.id: [] for h in honorarios}
+    if not claves:
+        return detalle
+    filas = db.session.query(TreatmentItem, TreatmentPlan, Patient).join(
+        TreatmentPlan, TreatmentItem.treatment_plan_id == TreatmentPlan.id
+    ).join(
+        Patient, TreatmentPlan.patient_id == Patient.id
+    ).filter(
+        TreatmentItem.estado == 'realizado',
+        db.tuple_(TreatmentPlan.dentist_id, TreatmentItem.nombre_tratamiento).in_(list(claves)),
+        *_filtro_realizacion(fecha_desde, fecha_hasta)
+    ).order_by(TreatmentItem.fecha_realizacion, TreatmentItem.id)
+    for item, plan, paciente in filas:
+        detalle[claves[(plan.dentist_id, item.nombre_tratamiento)]].append((item, plan, paciente))
+    return detalle
@@ -1,29 +1,46 @@
 """
 Rutas del panel interno de gestión (admin, recepcionista, dentistas).
 """
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, make_response
+from flask import (Blueprint, render_template, request, redirect, url_for, flash, jsonify, make_response, send_file,
+                   abort, Response, stream_with_context)
 from flask_login import login_required, current_user
 from app import db
-from io import BytesIO
-from reportlab.lib.pagesizes import letter, A4
-from reportlab.lib import colors
-from reportlab.lib.units import cm
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
 from datetime import datetime
 from app.models import (
     User, Patient, Appointment, ClinicalRecord, Odontogram,
     TreatmentPlan, TreatmentItem, Invoice, Payment, Notification,
-    Room, ClinicSettings, DoctorSchedule, TimeClock, DayOff, Honorario
+    Room, ClinicSettings, DoctorSchedule, TimeClock, DayOff, Honorario, Job
 )
 from app.routes_auth import role_required
+from app.search import buscar_pacientes
+from app.pagination import paginar
+from app.cache import cache
+from app.perf import perf
+from app.database import metricas_pool
+from app.replica import replica
+from app.pdf import pdf_presupuesto, pdf_factura, respuesta_pdf, descargar_logo
+from app.jobs import TAREAS, encolar, ruta_fichero
+from app.exportacion import (COLUMNAS_FACTURAS, COLUMNAS_PAGOS, filas_facturas, filas_pagos, generar_csv,
+                             generar_xlsx)
+from app.reporting import (resumen_rango, anotar_desglose, inicio_mes, mes_siguiente,
+                           resumen_honorarios, honorarios_por_doctor, detalle_honorarios)
+from app.dinero import CERO, importe, sumar
+from app.conciliacion import leer_extracto, conciliar, empaquetar_extracto, desempaquetar_extracto
+from app.scheduling import (ESTADOS_ACTIVOS, comprobar_horario, bloquear_agenda, buscar_conflicto,
+                            recurso_en_conflicto)
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime, timedelta, date
-from decimal import Decimal
+import io
 import json
 
 bp = Blueprint('panel', __name__)
 
+# Mensajes para los conflictos detectados por el servicio de agenda
+MENSAJES_CONFLICTO = {
+    'dentista': 'El dentista ya tiene una cita en ese horario',
+    'sala': 'La sala ya está ocupada en ese horario'
+}
+
 
 @bp.route('/dashboard')
 @login_required
@@ -34,47 +51,49 @@ def dashboard():
     today = datetime.now().date()
     start_of_week = today - timedelta(days=today.weekday())
     
-    # Estadísticas básicas
-    stats = {
-        'total_pacientes': Patient.query.filter_by(activo=True).count(),
-        'citas_hoy': Appointment.query.filter(
-            Appointment.fecha_hora_inicio >= datetime.combine(today, datetime.min.time()),
-            Appointment.fecha_hora_inicio < datetime.combine(today + timedelta(days=1), datetime.min.time())
-        ).count(),
-        'citas_pendientes': Appointment.query.filter_by(estado='programada').count(),
-        'facturas_pendientes': Invoice.query.filter_by(estado_pago='pendiente').count()
-    }
+    inicio_hoy = datetime.combine(today, datetime.min.time())
+    inicio_manana = datetime.combine(today + timedelta(days=1), datetime.min.time())
+    
+    citas_hoy_query = Appointment.query.filter(
+        Appointment.fecha_hora_inicio >= inicio_hoy,
+        Appointment.fecha_hora_inicio < inicio_manana
+    )
     
     # Si es dentista, filtrar solo sus citas
     if current_user.is_dentist():
-        citas_hoy = Appointment.query.filter(
-            Appointment.dentist_id == current_user.id,
-            Appointment.fecha_hora_inicio >= datetime.combine(today, datetime.min.time()),
-            Appointment.fecha_hora_inicio < datetime.combine(today + timedelta(days=1), datetime.min.time())
-        ).all()
-        stats['citas_hoy'] = len(citas_hoy)
-    else:
-        citas_hoy = Appointment.query.filter(
-            Appointment.fecha_hora_inicio >= datetime.combine(today, datetime.min.time()),
-            Appointment.fecha_hora_inicio < datetime.combine(today + timedelta(days=1), datetime.min.time())
-        ).all()
+        citas_hoy_query = citas_hoy_query.filter(Appointment.dentist_id == current_user.id)
     
-    pacientes = Patient.query.filter_by(activo=True).order_by(Patient.apellidos).all()
+    # Estadísticas básicas en una sola consulta agregada
+    total_pacientes, citas_hoy_total, citas_pendientes, facturas_pendientes = db.session.query(
+        Patient.query.filter_by(activo=True).with_entities(db.func.count(Patient.id)).scalar_subquery(),
+        citas_hoy_query.with_entities(db.func.count(Appointment.id)).scalar_subquery(),
+        Appointment.query.filter_by(estado='programada').with_entities(db.func.count(Appointment.id)).scalar_subquery(),
+        Invoice.query.filter_by(estado_pago='pendiente').with_entities(db.func.count(Invoice.id)).scalar_subquery()
+    ).one()
+    
+    stats = {
+        'total_pacientes': total_pacientes,
+        'citas_hoy': citas_hoy_total,
+        'citas_pendientes': citas_pendientes,
+        'facturas_pendientes': facturas_pendientes
+    }
+    
+    citas_hoy = citas_hoy_query.all()
+    
+    # Los pacientes no se incrustan en la página: el modal de cita los busca
+    # bajo demanda en api_pacientes_buscar
     dentistas = User.query.filter_by(rol='dentista', activo=True).all()
     salas = Room.query.filter_by(activo=True).order_by(Room.nombre).all()
     
     # Convertir a diccionarios para JSON (solo si se necesitan en JavaScript)
-    pacientes_json = [{'id': p.id, 'nombre': p.nombre_completo()} for p in pacientes]
     dentistas_json = [{'id': d.id, 'nombre': d.nombre} for d in dentistas]
     salas_json = [{'id': s.id, 'nombre': s.nombre} for s in salas]
     
     return render_template('panel/dashboard.html', 
                          stats=stats, 
                          citas_hoy=citas_hoy,
-                         pacientes=pacientes,
                          dentistas=dentistas,
                          salas=salas,
-                         pacientes_json=pacientes_json,
                          dentistas_json=dentistas_json,
                          salas_json=salas_json,
                          start_of_week=start_of_week)
@@ -109,29 +128,50 @@ def calendario_citas_semana():
     if current_user.is_dentist():
         query = query.filter_by(dentist_id=current_user.id)
     
-    citas = query.order_by(Appointment.fecha_hora_inicio).all()
-    
-    # Formatear citas para el calendario
-    citas_json = []
-    for cita in citas:
-        citas_json.append({
-            'id': cita.id,
-            'patient_id': cita.patient_id,
-            'patient_name': cita.patient.nombre_completo(),
-            'dentist_id': cita.dentist_id,
-            'dentist_name': cita.dentist.nombre,
-            'start': cita.fecha_hora_inicio.strftime('%Y-%m-%dT%H:%M:%S'),
-            'end': cita.fecha_hora_fin.strftime('%Y-%m-%dT%H:%M:%S'),
-            'sillon': cita.sillon or '',
-            'motivo': cita.motivo or '',
-            'estado': cita.estado
+    # ETag débil a partir del número de citas y su última modificación:
+    # si la semana no ha cambiado se responde 304 sin serializar nada.
+    # Renombrar un paciente o un dentista también renueva sus citas (ver models.py)
+    total, ultima_modificacion = query.with_entities(
+        db.func.count(Appointment.id),
+        db.func.max(Appointment.fecha_actualizacion)
+    ).one()
+    etag = f'{start_of_week:%Y%m%d}-{current_user.id}-{total}-{ultima_modificacion or ""}'
+    
+    if request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+    else:
+        citas = query.options(
+            db.joinedload(Appointment.patient),
+            db.joinedload(Appointment.dentist)
+        ).order_by(Appointment.fecha_hora_inicio).all()
+        
+        # Formatear citas para el calendario
+        citas_json = []
+        for cita in citas:
+            citas_json.append({
+                'id': cita.id,
+                'patient_id': cita.patient_id,
+                'patient_name': cita.patient.nombre_completo(),
+                'dentist_id': cita.dentist_id,
+                'dentist_name': cita.dentist.nombre,
+                'start': cita.fecha_hora_inicio.strftime('%Y-%m-%dT%H:%M:%S'),
+                'end': cita.fecha_hora_fin.strftime('%Y-%m-%dT%H:%M:%S'),
+                'sillon': cita.sillon or '',
+                'motivo': cita.motivo or '',
+                'estado': cita.estado
+            })
+        
+        response = jsonify({
+            'start_of_week': start_of_week.strftime('%Y-%m-%d'),
+            'end_of_week': end_of_week.strftime('%Y-%m-%d'),
+            'citas': citas_json
         })
     
-    return jsonify({
-        'start_of_week': start_of_week.strftime('%Y-%m-%d'),
-        'end_of_week': end_of_week.strftime('%Y-%m-%d'),
-        'citas': citas_json
-    })
+    # El navegador guarda la respuesta pero la revalida siempre con If-None-Match
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
 
 @bp.route('/calendario/crear-cita', methods=['POST'])
@@ -160,37 +200,20 @@ def calendario_crear_cita():
         motivo = data.get('motivo', '')
         sillon = data.get('sillon', '')
         
-        # Verificar que el doctor trabaja ese día
-        dia_semana = fecha_hora_inicio.weekday()
-        horario_dia = DoctorSchedule.query.filter_by(
-            doctor_id=dentist_id,
-            dia_semana=dia_semana,
-            activo=True
-        ).first()
-        
-        if not horario_dia:
-            return jsonify({'success': False, 'error': 'El doctor no trabaja ese día'}), 400
+        # Verificar que la cita está dentro del horario del doctor
+        error_horario = comprobar_horario(dentist_id, fecha_hora_inicio, fecha_hora_fin)
+        if error_horario:
+            return jsonify({'success': False, 'error': error_horario}), 400
         
-        # Verificar que la cita está dentro del horario de trabajo
-        hora_inicio_cita = fecha_hora_inicio.time()
-        hora_fin_cita = fecha_hora_fin.time()
-        
-        if hora_inicio_cita < horario_dia.hora_inicio or hora_fin_cita > horario_dia.hora_fin:
-            return jsonify({'success': False, 'error': f'La cita debe estar entre {horario_dia.hora_inicio.strftime("%H:%M")} y {horario_dia.hora_fin.strftime("%H:%M")}'}), 400
+        room_id = data.get('room_id')
+        room = Room.query.get(room_id) if room_id else None
         
-        # Verificar que no haya conflicto de horario
-        conflicto = Appointment.query.filter(
-            Appointment.dentist_id == dentist_id,
-            Appointment.estado.in_(['programada', 'confirmada']),
-            Appointment.fecha_hora_inicio < fecha_hora_fin,
-            Appointment.fecha_hora_fin > fecha_hora_inicio
-        ).first()
+        # Bloquear la agenda y verificar que no haya conflicto de horario
+        bloquear_agenda(dentist_id, room_id)
+        conflicto = buscar_conflicto(dentist_id, fecha_hora_inicio, fecha_hora_fin, room_id=room_id)
         
         if conflicto:
-            return jsonify({'success': False, 'error': 'El dentista ya tiene una cita en ese horario'}), 400
-        
-        room_id = data.get('room_id')
-        room = Room.query.get(room_id) if room_id else None
+            return jsonify({'success': False, 'error': MENSAJES_CONFLICTO[conflicto]}), 400
         
         cita = Appointment(
             patient_id=paciente_id,
@@ -214,6 +237,9 @@ def calendario_crear_cita():
                 'dentist_name': cita.dentist.nombre
             }
         })
+    except IntegrityError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': MENSAJES_CONFLICTO[recurso_en_conflicto(e)]}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'error': str(e)}), 400
@@ -228,23 +254,16 @@ def pacientes_list():
     """Listado de pacientes."""
     search = request.args.get('search', '')
     page = request.args.get('page', 1, type=int)
-    
-    query = Patient.query.filter_by(activo=True)
+    cursor = request.args.get('cursor')
     
     if search:
-        query = query.filter(
-            db.or_(
-                Patient.nombre.ilike(f'%{search}%'),
-                Patient.apellidos.ilike(f'%{search}%'),
-                Patient.email.ilike(f'%{search}%'),
-                Patient.dni.ilike(f'%{search}%')
-            )
+        # Búsqueda indexada, ordenada por relevancia y paginada por cursor
+        pacientes = buscar_pacientes(search, cursor=cursor)
+    else:
+        pacientes = Patient.query.filter_by(activo=True).order_by(Patient.apellidos, Patient.nombre).paginate(
+            page=page, per_page=20, error_out=False
         )
     
-    pacientes = query.order_by(Patient.apellidos, Patient.nombre).paginate(
-        page=page, per_page=20, error_out=False
-    )
-    
     return render_template('panel/pacientes/list.html', pacientes=pacientes, search=search)
 
 
@@ -317,6 +336,7 @@ def paciente_new():
 @bp.route('/citas')
 @login_required
 @role_required('admin', 'recepcionista', 'dentista')
+@cache.vista(ttl=60, etiquetas=('citas', 'pacientes'))
 def citas_list():
     """Listado de citas con filtros."""
     fecha = request.args.get('fecha')
@@ -346,8 +366,12 @@ def citas_list():
     if estado:
         query = query.filter_by(estado=estado)
     
-    citas = query.order_by(Appointment.fecha_hora_inicio).all()
-    dentistas = User.query.filter_by(rol='dentista', activo=True).all()
+    citas = paginar(
+        query.options(db.joinedload(Appointment.patient), db.joinedload(Appointment.dentist)),
+        (Appointment.fecha_hora_inicio, Appointment.id),
+        cursor=request.args.get('cursor')
+    )
+    dentistas = User.query.filter_by(rol='dentista', activo=True).order_by(User.nombre).all() if not current_user.is_dentist() else []
     
     return render_template('panel/citas/list.html', citas=citas, dentistas=dentistas,
                          fecha=fecha, estado=estado, dentist_id=dentist_id)
@@ -370,25 +394,21 @@ def cita_new():
             '%Y-%m-%d %H:%M'
         )
         
-        # Verificar que el doctor trabaja ese día
-        dia_semana = fecha_hora_inicio.weekday()
-        horario_dia = DoctorSchedule.query.filter_by(
-            doctor_id=dentist_id,
-            dia_semana=dia_semana,
-            activo=True
-        ).first()
+        room_id = request.form.get('room_id', type=int)
+        
+        # Verificar que la cita está dentro del horario del doctor
+        error_horario = comprobar_horario(dentist_id, fecha_hora_inicio, fecha_hora_fin)
         
-        if not horario_dia:
-            flash('El doctor no trabaja ese día. Por favor, selecciona otro día.', 'error')
+        if error_horario:
+            flash(error_horario, 'error')
         else:
-            # Verificar que la cita está dentro del horario de trabajo
-            hora_inicio_cita = fecha_hora_inicio.time()
-            hora_fin_cita = fecha_hora_fin.time()
+            # Bloquear la agenda y verificar que no haya conflicto de horario
+            bloquear_agenda(dentist_id, room_id)
+            conflicto = buscar_conflicto(dentist_id, fecha_hora_inicio, fecha_hora_fin, room_id=room_id)
             
-            if hora_inicio_cita < horario_dia.hora_inicio or hora_fin_cita > horario_dia.hora_fin:
-                flash(f'La cita debe estar entre {horario_dia.hora_inicio.strftime("%H:%M")} y {horario_dia.hora_fin.strftime("%H:%M")}', 'error')
+            if conflicto:
+                flash(MENSAJES_CONFLICTO[conflicto], 'error')
             else:
-                room_id = request.form.get('room_id', type=int)
                 cita = Appointment(
                     patient_id=paciente_id,
                     dentist_id=dentist_id,
@@ -405,6 +425,9 @@ def cita_new():
                     db.session.commit()
                     flash('Cita creada correctamente.', 'success')
                     return redirect(url_for('panel.citas_list'))
+                except IntegrityError as e:
+                    db.session.rollback()
+                    flash(MENSAJES_CONFLICTO[recurso_en_conflicto(e)], 'error')
                 except Exception as e:
                     db.session.rollback()
                     flash('Error al crear la cita.', 'error')
@@ -418,30 +441,26 @@ def cita_new():
 
 @bp.route('/api/pacientes/buscar', methods=['GET'])
 @login_required
-@role_required('admin', 'recepcionista')
+@role_required('admin', 'recepcionista', 'dentista')
 def api_pacientes_buscar():
     """API para buscar pacientes por nombre, apellidos, email o DNI."""
     search = request.args.get('q', '')
+    cursor = request.args.get('cursor')
     pacientes = []
+    cursor_siguiente = None
     
     if search:
-        query = Patient.query.filter_by(activo=True).filter(
-            db.or_(
-                Patient.nombre.ilike(f'%{search}%'),
-                Patient.apellidos.ilike(f'%{search}%'),
-                Patient.email.ilike(f'%{search}%'),
-                Patient.dni.ilike(f'%{search}%')
-            )
-        ).limit(20).all()
+        pagina = buscar_pacientes(search, cursor=cursor)
+        cursor_siguiente = pagina.cursor_siguiente
         
         pacientes = [{
             'id': p.id,
             'nombre_completo': p.nombre_completo(),
             'email': p.email,
             'telefono': p.telefono or ''
-        } for p in query]
+        } for p in pagina.items]
     
-    return jsonify({'pacientes': pacientes})
+    return jsonify({'pacientes': pacientes, 'cursor_siguiente': cursor_siguiente})
 
 
 @bp.route('/api/pacientes/crear-rapido', methods=['POST'])
@@ -496,37 +515,43 @@ def cita_edit(cita_id):
     from_dashboard = request.args.get('from') == 'dashboard' or request.form.get('from') == 'dashboard'
     
     if request.method == 'POST':
-        cita.patient_id = request.form.get('patient_id', type=int)
-        cita.dentist_id = request.form.get('dentist_id', type=int)
-        cita.fecha_hora_inicio = datetime.strptime(
+        # Los valores se validan antes de tocar la cita: si quedara modificada en
+        # la sesión, las consultas del formulario la volcarían contra el trigger
+        # o la restricción de solapes
+        dentist_id = request.form.get('dentist_id', type=int)
+        fecha_hora_inicio = datetime.strptime(
             f"{request.form.get('fecha')} {request.form.get('hora_inicio')}",
             '%Y-%m-%d %H:%M'
         )
-        cita.fecha_hora_fin = datetime.strptime(
+        fecha_hora_fin = datetime.strptime(
             f"{request.form.get('fecha')} {request.form.get('hora_fin')}",
             '%Y-%m-%d %H:%M'
         )
-        # Verificar que el doctor trabaja ese día
-        dia_semana = cita.fecha_hora_inicio.weekday()
-        horario_dia = DoctorSchedule.query.filter_by(
-            doctor_id=cita.dentist_id,
-            dia_semana=dia_semana,
-            activo=True
-        ).first()
+        room_id = request.form.get('room_id', type=int)
+        
+        # Verificar que la cita está dentro del horario del doctor
+        error_horario = comprobar_horario(dentist_id, fecha_hora_inicio, fecha_hora_fin)
         
-        if not horario_dia:
-            flash('El doctor no trabaja ese día. Por favor, selecciona otro día.', 'error')
+        if error_horario:
+            flash(error_horario, 'error')
         else:
-            # Verificar que la cita está dentro del horario de trabajo
-            hora_inicio_cita = cita.fecha_hora_inicio.time()
-            hora_fin_cita = cita.fecha_hora_fin.time()
+            # Bloquear la agenda y verificar que no haya conflicto de horario
+            bloquear_agenda(dentist_id, room_id)
+            conflicto = None
+            if request.form.get('estado') in ESTADOS_ACTIVOS:
+                conflicto = buscar_conflicto(dentist_id, fecha_hora_inicio, fecha_hora_fin,
+                                             room_id=room_id, excluir_id=cita.id)
             
-            if hora_inicio_cita < horario_dia.hora_inicio or hora_fin_cita > horario_dia.hora_fin:
-                flash(f'La cita debe estar entre {horario_dia.hora_inicio.strftime("%H:%M")} y {horario_dia.hora_fin.strftime("%H:%M")}', 'error')
+            if conflicto:
+                flash(MENSAJES_CONFLICTO[conflicto], 'error')
             else:
-                room_id = request.form.get('room_id', type=int)
+                sillon = request.form.get('sillon') or (Room.query.get(room_id).nombre if room_id else None)
+                cita.patient_id = request.form.get('patient_id', type=int)
+                cita.dentist_id = dentist_id
+                cita.fecha_hora_inicio = fecha_hora_inicio
+                cita.fecha_hora_fin = fecha_hora_fin
                 cita.room_id = room_id if room_id else None
-                cita.sillon = request.form.get('sillon') or (Room.query.get(room_id).nombre if room_id else None)
+                cita.sillon = sillon
                 cita.motivo = request.form.get('motivo')
                 cita.estado = request.form.get('estado')
                 cita.notas = request.form.get('notas')
@@ -538,6 +563,9 @@ def cita_edit(cita_id):
                     if from_dashboard:
                         return redirect(url_for('panel.dashboard'))
                     return redirect(url_for('panel.citas_list'))
+                except IntegrityError as e:
+                    db.session.rollback()
+                    flash(MENSAJES_CONFLICTO[recurso_en_conflicto(e)], 'error')
                 except Exception as e:
                     db.session.rollback()
                     flash('Error al actualizar la cita.', 'error')
@@ -563,13 +591,26 @@ def cita_change_status(cita_id):
     
     nuevo_estado = request.form.get('estado')
     if nuevo_estado in ['programada', 'confirmada', 'cancelada', 'realizada']:
-        cita.estado = nuevo_estado
-        try:
-            db.session.commit()
-            flash('Estado de la cita actualizado.', 'success')
-        except Exception as e:
-            db.session.rollback()
-            flash('Error al actualizar el estado.', 'error')
+        # Reactivar una cita vuelve a ocupar su hueco: comprobar que sigue libre
+        conflicto = None
+        if nuevo_estado in ESTADOS_ACTIVOS and cita.estado not in ESTADOS_ACTIVOS:
+            bloquear_agenda(cita.dentist_id, cita.room_id)
+            conflicto = buscar_conflicto(cita.dentist_id, cita.fecha_hora_inicio, cita.fecha_hora_fin,
+                                         room_id=cita.room_id, excluir_id=cita.id)
+        
+        if conflicto:
+            flash(MENSAJES_CONFLICTO[conflicto], 'error')
+        else:
+            cita.estado = nuevo_estado
+            try:
+                db.session.commit()
+                flash('Estado de la cita actualizado.', 'success')
+            except IntegrityError as e:
+                db.session.rollback()
+                flash(MENSAJES_CONFLICTO[recurso_en_conflicto(e)], 'error')
+            except Exception as e:
+                db.session.rollback()
+                flash('Error al actualizar el estado.', 'error')
     
     return redirect(url_for('panel.citas_list'))
 
@@ -664,12 +705,17 @@ def treatments_list():
     if dentist_id:
         query = query.filter_by(dentist_id=dentist_id)
     
-    # Ordenar por fecha de creación descendente
-    tratamientos = query.order_by(TreatmentPlan.fecha_creacion.desc()).all()
+    # Ordenar por fecha de creación descendente, paginado por cursor
+    tratamientos = paginar(
+        query.options(db.joinedload(TreatmentPlan.patient), db.joinedload(TreatmentPlan.dentist_user)),
+        (TreatmentPlan.fecha_creacion, TreatmentPlan.id),
+        cursor=request.args.get('cursor'),
+        descendente=True
+    )
     
-    # Obtener listas para filtros
-    pacientes = Patient.query.filter_by(activo=True).order_by(Patient.apellidos).all()
-    dentistas = User.query.filter_by(rol='dentista', activo=True).all()
+    # Listas para filtros: los pacientes se buscan bajo demanda, solo se carga el seleccionado
+    paciente_filtro = db.session.get(Patient, patient_id) if patient_id else None
+    dentistas = User.query.filter_by(rol='dentista', activo=True).order_by(User.nombre).all()
     
     # Estadísticas rápidas
     stats = {
@@ -681,7 +727,7 @@ def treatments_list():
     
     return render_template('panel/tratamientos/all.html', 
                          tratamientos=tratamientos,
-                         pacientes=pacientes,
+                         paciente_filtro=paciente_filtro,
                          dentistas=dentistas,
                          estado=estado,
                          patient_id=patient_id,
@@ -702,7 +748,7 @@ def treatment_plans_list(patient_id):
             patient_id=patient_id,
             dentist_id=request.form.get('dentist_id', type=int),
             descripcion_general=request.form.get('descripcion_general'),
-            coste_estimado=float(request.form.get('coste_estimado', 0))
+            coste_estimado=importe(request.form.get('coste_estimado'))
         )
         
         try:
@@ -747,6 +793,16 @@ def treatment_plan_detail(plan_id):
     return render_template('panel/tratamientos/detail.html', plan=plan, items=items)
 
 
+@bp.route('/tratamientos/<int:plan_id>/presupuesto.pdf')
+@login_required
+@role_required('admin', 'recepcionista', 'dentista')
+def treatment_plan_pdf(plan_id):
+    """Presupuesto en PDF de un plan de tratamiento."""
+    plan = TreatmentPlan.query.get_or_404(plan_id)
+    items = plan.treatment_items.order_by(TreatmentItem.fecha_prevista).all()
+    return respuesta_pdf(pdf_presupuesto(plan, items, ClinicSettings.cached()), f'presupuesto_{plan.id}.pdf')
+
+
 @bp.route('/tratamientos/<int:plan_id>/item/nuevo', methods=['POST'])
 @login_required
 @role_required('admin', 'recepcionista', 'dentista')
@@ -759,7 +815,7 @@ def treatment_item_new(plan_id):
         nombre_tratamiento=request.form.get('nombre_tratamiento'),
         pieza_dental=request.form.get('pieza_dental'),
         fecha_prevista=datetime.strptime(request.form.get('fecha_prevista'), '%Y-%m-%d').date() if request.form.get('fecha_prevista') else None,
-        precio=float(request.form.get('precio', 0))
+        precio=importe(request.form.get('precio'))
     )
     
     try:
@@ -798,6 +854,8 @@ def treatment_item_mark_done(item_id):
 @bp.route('/facturas')
 @login_required
 @role_required('admin', 'recepcionista')
+@replica.lectura
+@cache.vista(ttl=120, etiquetas=('facturas', 'pacientes'))
 def invoices_list():
     """Listado de facturas."""
     estado = request.args.get('estado')
@@ -818,10 +876,16 @@ def invoices_list():
         fecha_hasta_obj = datetime.strptime(fecha_hasta, '%Y-%m-%d')
         query = query.filter(Invoice.fecha_emision <= fecha_hasta_obj)
     
-    facturas = query.order_by(Invoice.fecha_emision.desc()).all()
-    pacientes = Patient.query.filter_by(activo=True).order_by(Patient.apellidos).all()
+    facturas = paginar(
+        query.options(db.joinedload(Invoice.patient)),
+        (Invoice.fecha_emision, Invoice.id),
+        cursor=request.args.get('cursor'),
+        descendente=True
+    )
+    # El filtro de paciente se busca bajo demanda; solo se carga el seleccionado
+    paciente_filtro = db.session.get(Patient, patient_id) if patient_id else None
     
-    return render_template('panel/facturas/list.html', facturas=facturas, pacientes=pacientes,
+    return render_template('panel/facturas/list.html', facturas=facturas, paciente_filtro=paciente_filtro,
                          estado=estado, patient_id=patient_id, fecha_desde=fecha_desde, fecha_hasta=fecha_hasta)
 
 
@@ -837,15 +901,15 @@ def treatment_invoice(plan_id):
         return redirect(url_for('panel.treatment_plan_detail', plan_id=plan_id))
     
     if request.method == 'POST':
-        total = float(request.form.get('total', 0))
+        total = importe(request.form.get('total'))
         metodo_pago = request.form.get('metodo_pago', 'pendiente')
         
         # Calcular total si no se especificó (suma de items realizados)
         if total == 0:
             items_realizados = plan.treatment_items.filter_by(estado='realizado').all()
-            total = sum(float(item.precio) for item in items_realizados if item.precio)
+            total = sumar(item.precio for item in items_realizados)
             if total == 0:
-                total = float(plan.coste_estimado) if plan.coste_estimado else 0
+                total = importe(plan.coste_estimado)
         
         factura = Invoice(
             patient_id=plan.patient_id,
@@ -866,9 +930,9 @@ def treatment_invoice(plan_id):
     
     # Calcular total sugerido
     items_realizados = plan.treatment_items.filter_by(estado='realizado').all()
-    total_sugerido = sum(float(item.precio) for item in items_realizados if item.precio)
+    total_sugerido = sumar(item.precio for item in items_realizados)
     if total_sugerido == 0:
-        total_sugerido = float(plan.coste_estimado) if plan.coste_estimado else 0
+        total_sugerido = importe(plan.coste_estimado)
     
     return render_template('panel/facturas/treatment_invoice.html', 
                          plan=plan, 
@@ -887,7 +951,7 @@ def invoice_new(patient_id):
     if request.method == 'POST':
         factura = Invoice(
             patient_id=patient_id,
-            total=float(request.form.get('total')),
+            total=importe(request.form.get('total')),
             metodo_pago=request.form.get('metodo_pago')
         )
         
@@ -914,6 +978,18 @@ def invoice_detail(invoice_id):
     return render_template('panel/facturas/detail.html', factura=factura, pagos=pagos)
 
 
+@bp.route('/facturas/<int:invoice_id>/factura.pdf')
+@login_required
+@role_required('admin', 'recepcionista')
+def invoice_pdf(invoice_id):
+    """Factura en PDF con los datos de la clínica."""
+    factura = Invoice.query.get_or_404(invoice_id)
+    pagos = factura.payments.order_by(Payment.fecha_pago).all()
+    
+    pdf_data = pdf_factura(factura, pagos, ClinicSettings.cached())
+    return respuesta_pdf(pdf_data, f'factura_{factura.id}.pdf')
+
+
 @bp.route('/facturas/<int:invoice_id>/pago/nuevo', methods=['POST'])
 @login_required
 @role_required('admin', 'recepcionista')
@@ -923,7 +999,7 @@ def payment_new(invoice_id):
     
     pago = Payment(
         invoice_id=invoice_id,
-        cantidad=float(request.form.get('cantidad')),
+        cantidad=importe(request.form.get('cantidad')),
         metodo_pago=request.form.get('metodo_pago'),
         referencia=request.form.get('referencia')
     )
@@ -939,6 +1015,51 @@ def payment_new(invoice_id):
     return redirect(url_for('panel.invoice_detail', invoice_id=invoice_id))
 
 
+@bp.route('/facturas/conciliar', methods=['GET', 'POST'])
+@login_required
+@role_required('admin', 'recepcionista')
+def payments_import():
+    """
+    Importar un extracto del banco o del TPV y registrar los cobros en sus facturas (ver app/conciliacion.py).
+    
+    Al subir el fichero solo se comprueba; los pagos se registran al confirmar.
+    """
+    resultado = errores = extracto = None
+    guardar = False
+    formato = request.form.get('formato', 'auto')
+    metodo_pago = request.form.get('metodo_pago', 'transferencia')
+    
+    if request.method == 'POST':
+        guardar = bool(request.form.get('confirmar'))
+        try:
+            if guardar:
+                contenido = desempaquetar_extracto(request.form.get('extracto_datos', ''))
+            else:
+                fichero = request.files.get('extracto')
+                if not fichero or not fichero.filename:
+                    flash('Selecciona el fichero del extracto.', 'warning')
+                    return redirect(url_for('panel.payments_import'))
+                contenido = fichero.read()
+            movimientos, errores = leer_extracto(contenido, formato)
+            resultado = conciliar(movimientos, metodo_pago, guardar=guardar)
+        except ValueError as e:
+            db.session.rollback()
+            flash(f'No se pudo leer el extracto: {e}', 'error')
+            return redirect(url_for('panel.payments_import'))
+        except Exception:
+            db.session.rollback()
+            flash('Error al registrar los pagos.', 'error')
+            return redirect(url_for('panel.payments_import'))
+        
+        if guardar and resultado['conciliados']:
+            flash(f"{len(resultado['conciliados'])} pagos registrados ({resultado['total']} €).", 'success')
+        elif resultado['conciliados']:
+            extracto = empaquetar_extracto(contenido)
+    
+    return render_template('panel/facturas/conciliar.html', resultado=resultado, errores=errores, guardado=guardar,
+                         extracto=extracto, formato=formato, metodo_pago=metodo_pago)
+
+
 # ==================== NOTIFICACIONES ====================
 
 @bp.route('/pacientes/<int:patient_id>/notificacion/nueva', methods=['GET', 'POST'])
@@ -1252,11 +1373,15 @@ def clinic_settings():
         if logo_url:
             # Si es una ruta relativa sin /static/, añadirla
             if not logo_url.startswith('http') and not logo_url.startswith('/'):
-                settings.logo_url = f'/static/{logo_url}'
-            else:
-                settings.logo_url = logo_url
+                logo_url = f'/static/{logo_url}'
         else:
-            settings.logo_url = None
+            logo_url = None
+        # El logo se descarga aquí, una vez, y los PDF usan la copia guardada
+        if logo_url != settings.logo_url or (logo_url and not settings.logo_datos):
+            settings.logo_datos = descargar_logo(logo_url)
+            if logo_url and settings.logo_datos is None:
+                flash('No se pudo descargar el logo; los PDF saldrán sin él.', 'warning')
+        settings.logo_url = logo_url
         settings.numero_colegio = request.form.get('numero_colegio')
         settings.iban = request.form.get('iban')
         settings.notas_pie_factura = request.form.get('notas_pie_factura')
@@ -1314,6 +1439,7 @@ def fichaje_dashboard():
 @bp.route('/fichaje/semana')
 @login_required
 @role_required('admin', 'recepcionista')
+@cache.vista(ttl=120, etiquetas=('fichajes',))
 def fichaje_semana():
     """API para obtener fichajes de la semana en formato JSON."""
     fecha_str = request.args.get('fecha', None)
@@ -1484,15 +1610,15 @@ def dias_libres_list():
     elif estado == 'pendientes':
         query = query.filter_by(aprobado=False)
     
-    dias_libres = query.order_by(DayOff.fecha_inicio.desc()).all()
-    empleados = User.query.filter(
-        User.activo == True,
-        User.rol.in_(['admin', 'recepcionista', 'dentista', 'auxiliar', 'comercial'])
-    ).order_by(User.nombre).all()
+    dias_libres = paginar(
+        query.options(db.joinedload(DayOff.user)),
+        (DayOff.fecha_inicio, DayOff.id),
+        cursor=request.args.get('cursor'),
+        descendente=True
+    )
     
     return render_template('panel/fichaje/dias_libres.html',
                          dias_libres=dias_libres,
-                         empleados=empleados,
                          estado=estado)
 
 
@@ -1588,6 +1714,8 @@ def dias_libres_rechazar(dia_libre_id):
 @bp.route('/gestoria')
 @login_required
 @role_required('admin')
+@replica.lectura
+@cache.vista(ttl=300, etiquetas=('facturas',))
 def gestoria_dashboard():
     """Panel de gestoría con resumen financiero."""
     # Filtros
@@ -1605,58 +1733,52 @@ def gestoria_dashboard():
     else:
         fecha_fin = datetime.strptime(fecha_fin_str, '%Y-%m-%d').date()
     
-    # Obtener facturas en el rango
-    facturas = Invoice.query.filter(
-        Invoice.fecha_emision >= fecha_inicio,
-        Invoice.fecha_emision <= fecha_fin
-    ).all()
-    
-    # Calcular totales
-    # Si el total incluye IVA, calcular base imponible primero
-    # Base = Total / 1.21, IVA = Base * 0.21
-    total_facturado = sum(float(f.total) for f in facturas)
-    total_base_imponible = sum(float(f.total) / 1.21 for f in facturas)  # Base sin IVA
-    total_iva = total_facturado - total_base_imponible  # IVA 21%
-    
-    # Facturas pagadas
-    facturas_pagadas = [f for f in facturas if f.estado_pago == 'pagado']
-    total_pagado = sum(float(f.total) for f in facturas_pagadas)
+    # Totales por estado de pago: meses cerrados desde financial_summary,
+    # mes en curso calculado en vivo (ver app/reporting.py)
+    resumen = resumen_rango(fecha_inicio, fecha_fin)
     
-    # Facturas pendientes
-    facturas_pendientes = [f for f in facturas if f.estado_pago == 'pendiente']
-    total_pendiente = sum(float(f.total) for f in facturas_pendientes)
+    vacio = (0, CERO, CERO, CERO)
+    num_pagadas, total_pagado, _, _ = resumen.get('pagado', vacio)
+    num_pendientes, total_pendiente, _, _ = resumen.get('pendiente', vacio)
+    num_parciales, total_parcial, _, _ = resumen.get('parcial', vacio)
     
-    # Facturas parciales
-    facturas_parciales = [f for f in facturas if f.estado_pago == 'parcial']
-    total_parcial = sum(float(f.total) for f in facturas_parciales)
+    # Precios con IVA incluido: la base es la suma de la base de cada factura
+    # (ver app/dinero.py) y el IVA, lo que queda hasta el total
+    total_facturado = sumar(total for _, total, _, _ in resumen.values())
+    total_base_imponible = sumar(base for _, _, _, base in resumen.values())
+    total_iva = total_facturado - total_base_imponible
     
     # Calcular pagos recibidos
-    pagos = Payment.query.join(Invoice).filter(
-        Invoice.fecha_emision >= fecha_inicio,
-        Invoice.fecha_emision <= fecha_fin
-    ).all()
+    total_pagos = sumar(pagos for _, _, pagos, _ in resumen.values())
     
-    total_pagos = sum(float(p.cantidad) for p in pagos)
+    # Solo las últimas facturas pagadas que muestra la plantilla
+    ultimas_pagadas = anotar_desglose(Invoice.query.options(db.joinedload(Invoice.patient)).filter(
+        Invoice.fecha_emision >= fecha_inicio,
+        Invoice.fecha_emision < fecha_fin + timedelta(days=1),
+        Invoice.estado_pago == 'pagado'
+    ).order_by(Invoice.fecha_emision.desc(), Invoice.id.desc()).limit(10).all())
     
     return render_template('panel/gestoria/dashboard.html',
-                         facturas=facturas,
                          fecha_inicio=fecha_inicio,
                          fecha_fin=fecha_fin,
-                         total_facturado=round(total_facturado, 2),
-                         total_iva=round(total_iva, 2),
-                         total_base_imponible=round(total_base_imponible, 2),
-                         total_pagado=round(total_pagado, 2),
-                         total_pendiente=round(total_pendiente, 2),
-                         total_parcial=round(total_parcial, 2),
-                         total_pagos=round(total_pagos, 2),
-                         facturas_pagadas=facturas_pagadas,
-                         facturas_pendientes=facturas_pendientes,
-                         facturas_parciales=facturas_parciales)
+                         total_facturado=total_facturado,
+                         total_iva=total_iva,
+                         total_base_imponible=total_base_imponible,
+                         total_pagado=total_pagado,
+                         total_pendiente=total_pendiente,
+                         total_parcial=total_parcial,
+                         total_pagos=total_pagos,
+                         num_pagadas=num_pagadas,
+                         num_pendientes=num_pendientes,
+                         num_parciales=num_parciales,
+                         ultimas_pagadas=ultimas_pagadas)
 
 
 @bp.route('/gestoria/facturas')
 @login_required
 @role_required('admin')
+@replica.lectura
+@cache.vista(ttl=300, etiquetas=('facturas',))
 def gestoria_facturas():
     """Listado detallado de facturas para gestoría."""
     fecha_inicio_str = request.args.get('fecha_inicio', None)
@@ -1674,19 +1796,28 @@ def gestoria_facturas():
     else:
         fecha_fin = datetime.strptime(fecha_fin_str, '%Y-%m-%d').date()
     
-    query = Invoice.query.filter(
+    query = Invoice.query.options(db.joinedload(Invoice.patient)).filter(
         Invoice.fecha_emision >= fecha_inicio,
-        Invoice.fecha_emision <= fecha_fin
+        Invoice.fecha_emision < fecha_fin + timedelta(days=1)
     )
     
     if estado != 'todas':
         query = query.filter_by(estado_pago=estado)
     
-    facturas = query.order_by(Invoice.fecha_emision.desc()).all()
+    # Paginado: el listado completo del periodo se descarga con gestoria_exportar
+    facturas = paginar(
+        query,
+        (Invoice.fecha_emision, Invoice.id),
+        cursor=request.args.get('cursor'),
+        descendente=True
+    )
+    anotar_desglose(facturas.items)
     
-    # Calcular totales para evitar errores de Decimal en la plantilla
-    total_facturado = sum(float(f.total) for f in facturas)
-    total_base_imponible = sum(float(f.total) / 1.21 for f in facturas)
+    # Totales desde los resúmenes mensuales (mes en curso en vivo)
+    resumen = resumen_rango(fecha_inicio, fecha_fin, estado if estado != 'todas' else None)
+    num_facturas = sum(numero for numero, _, _, _ in resumen.values())
+    total_facturado = sumar(total for _, total, _, _ in resumen.values())
+    total_base_imponible = sumar(base for _, _, _, base in resumen.values())
     total_iva = total_facturado - total_base_imponible
     
     return render_template('panel/gestoria/facturas.html',
@@ -1694,9 +1825,43 @@ def gestoria_facturas():
                          fecha_inicio=fecha_inicio,
                          fecha_fin=fecha_fin,
                          estado=estado,
-                         total_facturado=round(total_facturado, 2),
-                         total_base_imponible=round(total_base_imponible, 2),
-                         total_iva=round(total_iva, 2))
+                         num_facturas=num_facturas,
+                         total_facturado=total_facturado,
+                         total_base_imponible=total_base_imponible,
+                         total_iva=total_iva)
+
+
+@bp.route('/gestoria/exportar/<tipo>.<formato>')
+@login_required
+@role_required('admin')
+@replica.lectura
+def gestoria_exportar(tipo, formato):
+    """Facturas o pagos del periodo en CSV o XLSX, enviados en streaming (ver app/exportacion.py)."""
+    if tipo not in ('facturas', 'pagos') or formato not in ('csv', 'xlsx'):
+        abort(404)
+    try:
+        fecha_inicio = datetime.strptime(request.args.get('fecha_inicio', ''), '%Y-%m-%d').date()
+    except ValueError:
+        fecha_inicio = date.today().replace(day=1)
+    try:
+        fecha_fin = datetime.strptime(request.args.get('fecha_fin', ''), '%Y-%m-%d').date()
+    except ValueError:
+        fecha_fin = date.today()
+    
+    if tipo == 'facturas':
+        columnas, filas = COLUMNAS_FACTURAS, filas_facturas(fecha_inicio, fecha_fin, request.args.get('estado'))
+    else:
+        columnas, filas = COLUMNAS_PAGOS, filas_pagos(fecha_inicio, fecha_fin)
+    
+    if formato == 'csv':
+        contenido, mimetype = generar_csv(columnas, filas), 'text/csv; charset=utf-8'
+    else:
+        contenido = generar_xlsx(columnas, filas, hoja=tipo.capitalize())
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    
+    nombre = f'{tipo}_{fecha_inicio.strftime("%Y%m%d")}_{fecha_fin.strftime("%Y%m%d")}.{formato}'
+    return Response(stream_with_context(contenido), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={nombre}'})
 
 
 # ==================== HONORARIOS ====================
@@ -1704,47 +1869,58 @@ def gestoria_facturas():
 @bp.route('/honorarios')
 @login_required
 @role_required('admin')
+@replica.lectura
 def honorarios_list():
-    """Listado de honorarios por doctor."""
+    """Listado de honorarios por doctor con lo devengado en un periodo (por defecto, el mes actual)."""
     doctor_id = request.args.get('doctor_id', type=int)
+    hoy = date.today()
+    try:
+        fecha_desde = datetime.strptime(request.args.get('fecha_desde', ''), '%Y-%m-%d').date()
+    except ValueError:
+        fecha_desde = inicio_mes(hoy)
+    try:
+        fecha_hasta = datetime.strptime(request.args.get('fecha_hasta', ''), '%Y-%m-%d').date()
+    except ValueError:
+        fecha_hasta = mes_siguiente(inicio_mes(hoy)) - timedelta(days=1)
     
     query = Honorario.query
     
     if doctor_id:
         query = query.filter_by(doctor_id=doctor_id)
     
-    honorarios = query.order_by(Honorario.doctor_id, Honorario.nombre_tratamiento).all()
+    honorarios = paginar(
+        query.options(db.joinedload(Honorario.doctor)),
+        (Honorario.doctor_id, Honorario.nombre_tratamiento, Honorario.id),
+        cursor=request.args.get('cursor')
+    )
     
     # Obtener doctores para el filtro
     doctores = User.query.filter_by(rol='dentista', activo=True).order_by(User.nombre).all()
     
-    # Para cada honorario, obtener los tratamientos relacionados con información del paciente
+    # Tratamientos realizados en el periodo: recuentos e importes agrupados en SQL
+    resumen = resumen_honorarios([h.id for h in honorarios], fecha_desde, fecha_hasta)
+    detalle = detalle_honorarios(honorarios.items, fecha_desde, fecha_hasta)
+    totales_doctor = honorarios_por_doctor(fecha_desde, fecha_hasta, doctor_id)
+    
     honorarios_con_info = []
     for honorario in honorarios:
-        # Buscar TreatmentItems que coincidan con este honorario (mismo doctor y mismo nombre de tratamiento)
-        tratamientos_items = db.session.query(
-            TreatmentItem,
-            TreatmentPlan,
-            Patient
-        ).join(
-            TreatmentPlan, TreatmentItem.treatment_plan_id == TreatmentPlan.id
-        ).join(
-            Patient, TreatmentPlan.patient_id == Patient.id
-        ).filter(
-            TreatmentPlan.dentist_id == honorario.doctor_id,
-            TreatmentItem.nombre_tratamiento == honorario.nombre_tratamiento,
-            TreatmentItem.estado == 'realizado'  # Solo tratamientos realizados
-        ).all()
-        
+        num_realizados, total_facturado, total_honorario = resumen.get(honorario.id, (0, CERO, CERO))
         honorarios_con_info.append({
             'honorario': honorario,
-            'tratamientos': tratamientos_items
+            'tratamientos': detalle[honorario.id],
+            'num_realizados': num_realizados,
+            'total_facturado': total_facturado,
+            'total_honorario': total_honorario
         })
     
     return render_template('panel/honorarios/list.html', 
                          honorarios_con_info=honorarios_con_info,
+                         honorarios=honorarios,
                          doctores=doctores,
-                         doctor_id=doctor_id)
+                         totales_doctor=totales_doctor,
+                         doctor_id=doctor_id,
+                         fecha_desde=fecha_desde,
+                         fecha_hasta=fecha_hasta)
 
 
 @bp.route('/honorarios/nuevo', methods=['GET', 'POST'])
@@ -1755,7 +1931,7 @@ def honorario_new():
     if request.method == 'POST':
         doctor_id = request.form.get('doctor_id', type=int)
         nombre_tratamiento = request.form.get('nombre_tratamiento', '').strip()
-        precio = float(request.form.get('precio', 0))
+        precio = importe(request.form.get('precio'))
         
         # Verificar que el tratamiento existe en la base de datos
         tratamiento_existe = db.session.query(TreatmentItem.nombre_tratamiento).filter_by(
@@ -1798,14 +1974,17 @@ def honorario_new():
     doctor_id = request.args.get('doctor_id', type=int)
     tratamientos_por_doctor = {}
     
-    # Para cada doctor, obtener los tratamientos únicos que ha realizado
+    # Tratamientos únicos que ha realizado cada doctor, en una sola consulta
     for doctor in doctores:
-        tratamientos = db.session.query(TreatmentItem.nombre_tratamiento).join(
-            TreatmentPlan
-        ).filter(
-            TreatmentPlan.dentist_id == doctor.id
-        ).distinct().all()
-        tratamientos_por_doctor[doctor.id] = sorted([t[0] for t in tratamientos])
+        tratamientos_por_doctor[doctor.id] = []
+    for dentista_id, nombre_tratamiento in db.session.query(
+        TreatmentPlan.dentist_id, TreatmentItem.nombre_tratamiento
+    ).join(
+        TreatmentItem, TreatmentItem.treatment_plan_id == TreatmentPlan.id
+    ).filter(
+        TreatmentPlan.dentist_id.in_(list(tratamientos_por_doctor))
+    ).distinct().order_by(TreatmentItem.nombre_tratamiento):
+        tratamientos_por_doctor[dentista_id].append(nombre_tratamiento)
     
     # Tratamientos del doctor seleccionado (si hay uno)
     tratamientos_lista = []
@@ -1828,7 +2007,7 @@ def honorario_edit(honorario_id):
     
     if request.method == 'POST':
         honorario.nombre_tratamiento = request.form.get('nombre_tratamiento', '').strip()
-        honorario.precio = float(request.form.get('precio', 0))
+        honorario.precio = importe(request.form.get('precio'))
         
         # Verificar si ya existe otro con el mismo doctor y tratamiento
         existente = Honorario.query.filter(
@@ -1876,133 +2055,108 @@ def honorario_delete(honorario_id):
     return redirect(url_for('panel.honorarios_list', doctor_id=doctor_id))
 
 
-@bp.route('/honorarios/pdf/<int:doctor_id>')
+@bp.route('/honorarios/pdf/<int:doctor_id>', methods=['GET', 'POST'])
 @login_required
 @role_required('admin')
 def honorarios_pdf(doctor_id):
-    """Generar PDF con la lista de honorarios de un doctor."""
+    """Encolar el PDF con la lista de honorarios de un doctor (tarea honorarios_pdf)."""
     doctor = User.query.get_or_404(doctor_id)
     
     if doctor.rol != 'dentista':
         flash('El usuario seleccionado no es un dentista.', 'error')
         return redirect(url_for('panel.honorarios_list'))
     
-    # Obtener honorarios del doctor
-    honorarios = Honorario.query.filter_by(doctor_id=doctor_id).order_by(Honorario.nombre_tratamiento).all()
-    
-    # Crear el PDF en memoria
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=2*cm, leftMargin=2*cm, topMargin=2*cm, bottomMargin=2*cm)
-    
-    # Contenido del PDF
-    story = []
-    styles = getSampleStyleSheet()
-    
-    # Estilos personalizados
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=18,
-        textColor=colors.HexColor('#0d6efd'),
-        spaceAfter=30,
-        alignment=TA_CENTER
-    )
-    
-    subtitle_style = ParagraphStyle(
-        'CustomSubtitle',
-        parent=styles['Normal'],
-        fontSize=12,
-        textColor=colors.HexColor('#495057'),
-        spaceAfter=20,
-        alignment=TA_CENTER
-    )
-    
-    # Título
-    story.append(Paragraph("HONORARIOS MÉDICOS", title_style))
-    story.append(Paragraph(f"Dr./Dra. {doctor.nombre}", subtitle_style))
-    story.append(Paragraph(f"Fecha de generación: {datetime.now().strftime('%d/%m/%Y %H:%M')}", styles['Normal']))
-    story.append(Spacer(1, 0.5*cm))
-    
-    if not honorarios:
-        story.append(Paragraph("No hay honorarios configurados para este doctor.", styles['Normal']))
-    else:
-        # Preparar datos de la tabla
-        table_data = [['Tratamiento', 'Precio Honorario (€)']]
-        
-        total_honorarios = 0
-        for honorario in honorarios:
-            table_data.append([
-                honorario.nombre_tratamiento,
-                f"{honorario.precio:.2f}"
-            ])
-            total_honorarios += float(honorario.precio)
-        
-        # Añadir fila de total
-        table_data.append([
-            '<b>TOTAL</b>',
-            f'<b>{total_honorarios:.2f} €</b>'
-        ])
-        
-        # Crear tabla
-        table = Table(table_data, colWidths=[12*cm, 4*cm])
-        
-        # Estilo de la tabla
-        table.setStyle(TableStyle([
-            # Encabezado
-            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#0d6efd')),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 12),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('TOPPADDING', (0, 0), (-1, 0), 12),
-            
-            # Filas de datos
-            ('FONTNAME', (0, 1), (-1, -2), 'Helvetica'),
-            ('FONTSIZE', (0, 1), (-1, -2), 10),
-            ('ROWBACKGROUNDS', (0, 1), (-1, -2), [colors.white, colors.HexColor('#f8f9fa')]),
-            ('GRID', (0, 0), (-1, -1), 1, colors.HexColor('#dee2e6')),
-            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-            ('LEFTPADDING', (0, 0), (-1, -1), 8),
-            ('RIGHTPADDING', (0, 0), (-1, -1), 8),
-            ('TOPPADDING', (0, 1), (-1, -2), 8),
-            ('BOTTOMPADDING', (0, 1), (-1, -2), 8),
-            
-            # Fila de total
-            ('BACKGROUND', (0, -1), (-1, -1), colors.HexColor('#e9ecef')),
-            ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, -1), (-1, -1), 11),
-            ('TOPPADDING', (0, -1), (-1, -1), 12),
-            ('BOTTOMPADDING', (0, -1), (-1, -1), 12),
-        ]))
-        
-        story.append(table)
-        story.append(Spacer(1, 0.5*cm))
-        
-        # Nota al pie
-        nota_style = ParagraphStyle(
-            'Nota',
-            parent=styles['Normal'],
-            fontSize=9,
-            textColor=colors.HexColor('#6c757d'),
-            alignment=TA_CENTER,
-            spaceBefore=20
-        )
-        story.append(Paragraph("Este documento contiene los honorarios configurados para el doctor.", nota_style))
-    
-    # Construir PDF
-    doc.build(story)
-    
-    # Obtener el PDF del buffer
-    buffer.seek(0)
-    pdf_data = buffer.getvalue()
-    buffer.close()
-    
-    # Crear respuesta
-    response = make_response(pdf_data)
-    response.headers['Content-Type'] = 'application/pdf'
-    response.headers['Content-Disposition'] = f'inline; filename=honorarios_{doctor.nombre.replace(" ", "_")}_{datetime.now().strftime("%Y%m%d")}.pdf'
-    
-    return response
+    job = encolar('honorarios_pdf', {'doctor_id': doctor.id}, user_id=current_user.id)
+    flash('Trabajo encolado. La descarga estará disponible al terminar.', 'info')
+    return redirect(url_for('panel.job_detail', job_id=job.id))
+
+
+
+# ==================== TRABAJOS EN SEGUNDO PLANO ====================
+
+@bp.route('/trabajos')
+@login_required
+@role_required('admin')
+def jobs_list():
+    """Listado de los últimos trabajos (PDF y exportaciones) encolados."""
+    trabajos = Job.query.order_by(Job.id.desc()).limit(50).all()
+    return render_template('panel/trabajos/list.html', trabajos=trabajos)
+
+
+@bp.route('/trabajos/<tipo>', methods=['POST'])
+@login_required
+@role_required('admin')
+def job_new(tipo):
+    """Encolar un trabajo con los parámetros del formulario."""
+    if tipo not in TAREAS:
+        abort(404)
+    parametros = {nombre: request.form[nombre] for nombre in TAREAS[tipo][1] if request.form.get(nombre)}
+    job = encolar(tipo, parametros, user_id=current_user.id)
+    flash('Trabajo encolado. La descarga estará disponible al terminar.', 'info')
+    return redirect(url_for('panel.job_detail', job_id=job.id))
 
+
+@bp.route('/trabajos/<int:job_id>')
+@login_required
+@role_required('admin')
+def job_detail(job_id):
+    """Progreso de un trabajo y descarga del resultado."""
+    job = Job.query.get_or_404(job_id)
+    return render_template('panel/trabajos/detail.html', job=job)
+
+
+@bp.route('/trabajos/<int:job_id>/estado')
+@login_required
+@role_required('admin')
+def job_status(job_id):
+    """Estado del trabajo en JSON (lo consulta la página de detalle)."""
+    job = Job.query.get_or_404(job_id)
+    return jsonify({
+        'estado': job.estado,
+        'progreso': job.progreso,
+        'mensaje': job.mensaje,
+        'descarga': url_for('panel.job_download', job_id=job.id) if job.estado == 'terminado' and job.fichero else None
+    })
+
+
+@bp.route('/trabajos/<int:job_id>/descargar')
+@login_required
+@role_required('admin')
+def job_download(job_id):
+    """Descargar el fichero generado por un trabajo terminado."""
+    job = Job.query.get_or_404(job_id)
+    if job.estado != 'terminado' or not job.fichero:
+        abort(404)
+    if job.contenido is not None:
+        return send_file(io.BytesIO(job.contenido), as_attachment=True, download_name=job.nombre_fichero)
+    try:
+        return send_file(ruta_fichero(job), as_attachment=True, download_name=job.nombre_fichero)
+    except FileNotFoundError:
+        abort(404)
+
+
+# ==================== DEPURACIÓN ====================
+
+@bp.route('/debug/perf')
+@login_required
+@role_required('admin')
+def debug_perf():
+    """Métricas de rendimiento por endpoint de este proceso (worker)."""
+    return render_template('panel/debug/perf.html',
+                         activo=perf.activo,
+                         endpoints=perf.resumen(),
+                         recientes=list(perf.recientes),
+                         umbral_n1=perf.umbral_n1,
+                         cache_stats=cache.estadisticas(),
+                         pool_stats=metricas_pool.estado(db.engine.pool))
+
+
+@bp.route('/debug/perf/reiniciar', methods=['POST'])
+@login_required
+@role_required('admin')
+def debug_perf_reiniciar():
+    """Reiniciar las métricas acumuladas."""
+    perf.reiniciar()
+    metricas_pool.reiniciar()
+    flash('Métricas de rendimiento reiniciadas.', 'success')
+    return redirect(url_for('panel.debug_perf'))
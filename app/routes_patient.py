@@ -1,10 +1,14 @@
 """
 Rutas del área privada del paciente.
 """
-from flask import Blueprint, render_template, request, redirect, url_for, flash
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
 from flask_login import login_required, current_user
 from app import db
 from app.models import Patient, Appointment, TreatmentPlan, TreatmentItem, Invoice, Payment, User, DoctorSchedule
+from app.scheduling import (cargar_horarios, disponibilidad_rango, comprobar_horario, bloquear_agenda,
+                            buscar_conflicto, recurso_en_conflicto)
+from app.replica import replica
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime, date, timedelta
 
 bp = Blueprint('patient', __name__)
@@ -12,6 +16,7 @@ bp = Blueprint('patient', __name__)
 
 @bp.route('/dashboard')
 @login_required
+@replica.lectura
 def dashboard():
     """Panel principal del paciente."""
     if not isinstance(current_user, Patient):
@@ -51,6 +56,7 @@ def dashboard():
 
 @bp.route('/citas')
 @login_required
+@replica.lectura
 def citas_list():
     """Listado de todas las citas del paciente."""
     if not isinstance(current_user, Patient):
@@ -100,66 +106,47 @@ def calendario_disponibilidad():
         return jsonify({'error': 'Fecha y dentista requeridos'}), 400
     
     fecha = datetime.strptime(fecha_str, '%Y-%m-%d').date()
-    dia_semana = fecha.weekday()  # 0=Lunes, 6=Domingo
+    horarios = cargar_horarios(dentist_id)
     
-    # Verificar si el doctor trabaja ese día
-    horario_dia = DoctorSchedule.query.filter_by(
-        doctor_id=dentist_id,
-        dia_semana=dia_semana,
-        activo=True
-    ).first()
-    
-    if not horario_dia:
+    if fecha.weekday() not in horarios:
         # El doctor no trabaja ese día
         return jsonify({'tramos': [], 'message': 'El doctor no trabaja este día'})
     
-    # Usar horario del doctor
-    hora_inicio = horario_dia.hora_inicio.hour
-    minuto_inicio = horario_dia.hora_inicio.minute
-    hora_fin = horario_dia.hora_fin.hour
-    minuto_fin = horario_dia.hora_fin.minute
+    tramos = disponibilidad_rango(dentist_id, fecha, fecha, horarios=horarios)[fecha]
     
-    # Generar tramos de 30 minutos según el horario del doctor
-    tramos_disponibles = []
-    hora_actual = hora_inicio
-    minuto_actual = minuto_inicio
+    return jsonify({'tramos': tramos})
+
+
+@bp.route('/calendario/disponibilidad-semana', methods=['GET'])
+@login_required
+def calendario_disponibilidad_semana():
+    """Obtener la disponibilidad de toda una semana en una sola petición."""
+    if not isinstance(current_user, Patient):
+        return jsonify({'error': 'Acceso denegado'}), 403
     
-    while hora_actual < hora_fin or (hora_actual == hora_fin and minuto_actual < minuto_fin):
-        tramo_inicio = datetime.combine(fecha, datetime.min.time().replace(hour=hora_actual, minute=minuto_actual))
-        tramo_fin = tramo_inicio + timedelta(minutes=30)
-        
-        # Verificar si el tramo está en el pasado
-        if tramo_inicio < datetime.now():
-            # Avanzar al siguiente tramo
-            minuto_actual += 30
-            if minuto_actual >= 60:
-                hora_actual += 1
-                minuto_actual -= 60
-            continue
-        
-        # Verificar si hay conflicto con citas existentes
-        conflicto = Appointment.query.filter(
-            Appointment.dentist_id == dentist_id,
-            Appointment.estado.in_(['programada', 'confirmada']),
-            Appointment.fecha_hora_inicio < tramo_fin,
-            Appointment.fecha_hora_fin > tramo_inicio
-        ).first()
-        
-        disponible = conflicto is None
-        
-        tramos_disponibles.append({
-            'start': tramo_inicio.strftime('%Y-%m-%dT%H:%M:%S'),
-            'end': tramo_fin.strftime('%Y-%m-%dT%H:%M:%S'),
-            'disponible': disponible
-        })
-        
-        # Avanzar al siguiente tramo
-        minuto_actual += 30
-        if minuto_actual >= 60:
-            hora_actual += 1
-            minuto_actual -= 60
+    fecha_str = request.args.get('fecha', None)
+    dentist_id = request.args.get('dentist_id', type=int)
+    
+    if not dentist_id:
+        return jsonify({'error': 'Dentista requerido'}), 400
+    
+    if fecha_str:
+        fecha_base = datetime.strptime(fecha_str, '%Y-%m-%d').date()
+    else:
+        fecha_base = date.today()
+    
+    # Calcular inicio y fin de semana (lunes a domingo)
+    start_of_week = fecha_base - timedelta(days=fecha_base.weekday())
+    end_of_week = start_of_week + timedelta(days=6)
     
-    return jsonify({'tramos': tramos_disponibles})
+    dias = disponibilidad_rango(dentist_id, start_of_week, end_of_week)
+    
+    return jsonify({
+        'start_of_week': start_of_week.strftime('%Y-%m-%d'),
+        'end_of_week': end_of_week.strftime('%Y-%m-%d'),
+        'dias': {fecha.strftime('%Y-%m-%d'): tramos for fecha, tramos in dias.items()},
+        'tramos': [tramo for tramos in dias.values() for tramo in tramos]
+    })
 
 
 @bp.route('/calendario/solicitar-cita', methods=['POST'])
@@ -178,33 +165,14 @@ def calendario_solicitar_cita():
         fecha_hora_fin = datetime.strptime(data.get('end'), '%Y-%m-%dT%H:%M:%S')
         motivo = data.get('motivo', '')
         
-        # Verificar que el doctor trabaja ese día
-        dia_semana = fecha_hora_inicio.weekday()
-        horario_dia = DoctorSchedule.query.filter_by(
-            doctor_id=dentist_id,
-            dia_semana=dia_semana,
-            activo=True
-        ).first()
-        
-        if not horario_dia:
-            return jsonify({'success': False, 'error': 'El doctor no trabaja ese día'}), 400
-        
-        # Verificar que la cita está dentro del horario de trabajo
-        hora_inicio_cita = fecha_hora_inicio.time()
-        hora_fin_cita = fecha_hora_fin.time()
+        # Verificar que la cita está dentro del horario del doctor
+        error_horario = comprobar_horario(dentist_id, fecha_hora_inicio, fecha_hora_fin)
+        if error_horario:
+            return jsonify({'success': False, 'error': error_horario}), 400
         
-        if hora_inicio_cita < horario_dia.hora_inicio or hora_fin_cita > horario_dia.hora_fin:
-            return jsonify({'success': False, 'error': f'La cita debe estar entre {horario_dia.hora_inicio.strftime("%H:%M")} y {horario_dia.hora_fin.strftime("%H:%M")}'}), 400
-        
-        # Verificar que no haya conflicto
-        conflicto = Appointment.query.filter(
-            Appointment.dentist_id == dentist_id,
-            Appointment.estado.in_(['programada', 'confirmada']),
-            Appointment.fecha_hora_inicio < fecha_hora_fin,
-            Appointment.fecha_hora_fin > fecha_hora_inicio
-        ).first()
-        
-        if conflicto:
+        # Bloquear la agenda y verificar que no haya conflicto
+        bloquear_agenda(dentist_id)
+        if buscar_conflicto(dentist_id, fecha_hora_inicio, fecha_hora_fin):
             return jsonify({'success': False, 'error': 'Ese horario ya no está disponible'}), 400
         
         cita = Appointment(
@@ -223,6 +191,10 @@ def calendario_solicitar_cita():
             'success': True,
             'message': 'Cita solicitada correctamente. Te contactaremos para confirmarla.'
         })
+    except IntegrityError as e:
+        db.session.rollback()
+        recurso_en_conflicto(e)
+        return jsonify({'success': False, 'error': 'Ese horario ya no está disponible'}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'error': str(e)}), 400
@@ -230,6 +202,7 @@ def calendario_solicitar_cita():
 
 @bp.route('/tratamientos')
 @login_required
+@replica.lectura
 def tratamientos_list():
     """Listado de tratamientos del paciente (versión amigable)."""
     if not isinstance(current_user, Patient):
@@ -279,6 +252,7 @@ def tratamiento_detail(plan_id):
 
 @bp.route('/facturas')
 @login_required
+@replica.lectura
 def facturas_list():
     """Listado de facturas del paciente."""
     if not isinstance(current_user, Patient):
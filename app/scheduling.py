@@ -0,0 +1,243 @@
+"""
+Servicio de agenda: disponibilidad y detección de solapamientos de citas.
+
+Las citas de un rango de fechas se cargan con una sola consulta y los tramos
+libres/ocupados se calculan en memoria con un barrido sobre intervalos ordenados.
+Las reservas pasan por bloquear_agenda() + buscar_conflicto() para que dos
+reservas simultáneas del mismo hueco no puedan confirmarse a la vez.
+"""
+from app import db
+from app.models import Appointment, DoctorSchedule, User, Room
+from datetime import datetime, timedelta
+
+# Estados de cita que ocupan el horario del dentista
+ESTADOS_ACTIVOS = ['programada', 'confirmada']
+
+# Duración de cada tramo del calendario (minutos)
+DURACION_TRAMO = 30
+
+
+def cargar_horarios(dentist_id):
+    """Devuelve el horario activo del dentista indexado por día de la semana."""
+    horarios = DoctorSchedule.query.filter_by(doctor_id=dentist_id, activo=True).all()
+    return {h.dia_semana: h for h in horarios}
+
+
+def cargar_intervalos(dentist_id, inicio, fin):
+    """Carga en una consulta las citas activas del dentista que solapan [inicio, fin)."""
+    filas = Appointment.query.with_entities(
+        Appointment.fecha_hora_inicio,
+        Appointment.fecha_hora_fin
+    ).filter(
+        Appointment.dentist_id == dentist_id,
+        Appointment.estado.in_(ESTADOS_ACTIVOS),
+        Appointment.fecha_hora_inicio < fin,
+        Appointment.fecha_hora_fin > inicio
+    ).order_by(Appointment.fecha_hora_inicio).all()
+    return fusionar_intervalos([(f[0], f[1]) for f in filas])
+
+
+def fusionar_intervalos(intervalos):
+    """Ordena y fusiona intervalos solapados en una lista disjunta."""
+    fusionados = []
+    for inicio, fin in sorted(intervalos):
+        if fusionados and inicio <= fusionados[-1][1]:
+            if fin > fusionados[-1][1]:
+                fusionados[-1] = (fusionados[-1][0], fin)
+        else:
+            fusionados.append((inicio, fin))
+    return fusionados
+
+
+def generar_tramos(fecha, horario):
+    """Genera los tramos (inicio, fin) de un día según el horario del doctor."""
+    tramo_inicio = datetime.combine(fecha, horario.hora_inicio)
+    limite = datetime.combine(fecha, horario.hora_fin)
+    paso = timedelta(minutes=DURACION_TRAMO)
+    tramos = []
+    while tramo_inicio < limite:
+        tramos.append((tramo_inicio, tramo_inicio + paso))
+        tramo_inicio += paso
+    return tramos
+
+
+def calcular_tramos(tramos, ocupados, ahora=None):
+    """
+    Marca cada tramo como disponible u ocupado.
+
+    `tramos` y `ocupados` deben estar ordenados y `ocupados` ser disjunto
+    (ver fusionar_intervalos), de modo que basta un único puntero.
+    Los tramos ya pasados se omiten.
+    """
+    ahora = ahora or datetime.now()
+    resultado = []
+    i = 0
+    for tramo_inicio, tramo_fin in tramos:
+        if tramo_inicio < ahora:
+            continue
+        # Descartar intervalos que terminan antes de este tramo
+        while i < len(ocupados) and ocupados[i][1] <= tramo_inicio:
+            i += 1
+        disponible = not (i < len(ocupados) and ocupados[i][0] < tramo_fin)
+        resultado.append({
+            'start': tramo_inicio.strftime('%Y-%m-%dT%H:%M:%S'),
+            'end': tramo_fin.strftime('%Y-%m-%dT%H:%M:%S'),
+            'disponible': disponible
+        })
+    return resultado
+
+
+def disponibilidad_rango(dentist_id, fecha_inicio, fecha_fin, horarios=None, ahora=None):
+    """
+    Calcula la disponibilidad del dentista entre dos fechas (ambas incluidas).
+
+    Devuelve un diccionario {fecha: [tramos]}; los días en los que el doctor
+    no trabaja tienen una lista vacía.
+    """
+    if horarios is None:
+        horarios = cargar_horarios(dentist_id)
+    inicio = datetime.combine(fecha_inicio, datetime.min.time())
+    fin = datetime.combine(fecha_fin + timedelta(days=1), datetime.min.time())
+    ocupados = cargar_intervalos(dentist_id, inicio, fin) if horarios else []
+
+    dias = {}
+    fecha = fecha_inicio
+    while fecha <= fecha_fin:
+        horario_dia = horarios.get(fecha.weekday())
+        if horario_dia:
+            dias[fecha] = calcular_tramos(generar_tramos(fecha, horario_dia), ocupados, ahora)
+        else:
+            dias[fecha] = []
+        fecha += timedelta(days=1)
+    return dias
+
+
+# ==================== CONFLICTOS DE RESERVA ====================
+
+def comprobar_horario(dentist_id, inicio, fin):
+    """Devuelve un mensaje de error si la cita queda fuera del horario del doctor."""
+    with db.session.no_autoflush:
+        horario_dia = DoctorSchedule.query.filter_by(
+            doctor_id=dentist_id,
+            dia_semana=inicio.weekday(),
+            activo=True
+        ).first()
+
+    if not horario_dia:
+        return 'El doctor no trabaja ese día'
+
+    if inicio.time() < horario_dia.hora_inicio or fin.time() > horario_dia.hora_fin:
+        return f'La cita debe estar entre {horario_dia.hora_inicio.strftime("%H:%M")} y {horario_dia.hora_fin.strftime("%H:%M")}'
+
+    return None
+
+
+def bloquear_agenda(dentist_id, room_id=None):
+    """
+    Serializa las reservas sobre la agenda del dentista (y la sala) hasta el commit.
+
+    En Postgres bloquea las filas del dentista y la sala con SELECT ... FOR UPDATE;
+    en SQLite abre la transacción con BEGIN IMMEDIATE, que toma el bloqueo de
+    escritura de la base de datos antes de comprobar los conflictos.
+    """
+    conexion = db.session.connection()
+    if conexion.dialect.name == 'sqlite':
+        if not conexion.connection.dbapi_connection.in_transaction:
+            conexion.exec_driver_sql('BEGIN IMMEDIATE')
+        return
+
+    with db.session.no_autoflush:
+        db.session.query(User.id).filter(User.id == dentist_id).with_for_update().first()
+        if room_id:
+            db.session.query(Room.id).filter(Room.id == room_id).with_for_update().first()
+
+
+def buscar_conflicto(dentist_id, inicio, fin, room_id=None, excluir_id=None):
+    """
+    Devuelve 'dentista' o 'sala' si el hueco ya está ocupado, o None.
+
+    No vuelca los cambios pendientes de la sesión: al editar una cita, sus
+    nuevos valores no deben llegar a la base de datos antes de validarlos.
+    """
+    solapes = db.session.query(Appointment.id).filter(
+        Appointment.estado.in_(ESTADOS_ACTIVOS),
+        Appointment.fecha_hora_inicio < fin,
+        Appointment.fecha_hora_fin > inicio
+    )
+    if excluir_id:
+        solapes = solapes.filter(Appointment.id != excluir_id)
+
+    with db.session.no_autoflush:
+        if solapes.filter(Appointment.dentist_id == dentist_id).first():
+            return 'dentista'
+        if room_id and solapes.filter(Appointment.room_id == room_id).first():
+            return 'sala'
+    return None
+
+
+def recurso_en_conflicto(error):
+    """
+    'dentista' o 'sala' según la restricción o el trigger que ha rechazado la cita.
+
+    Cualquier otro IntegrityError (clave ajena, NOT NULL...) no es un solape y
+    se vuelve a lanzar.
+    """
+    mensaje = str(error.orig)
+    for recurso, restriccion in RESTRICCIONES_SOLAPE.items():
+        if restriccion in mensaje:
+            return recurso
+    raise error
+
+
+# ==================== RESTRICCIÓN EN BASE DE DATOS ====================
+
+# Nombre de la restricción (y del mensaje del trigger en SQLite) por recurso
+RESTRICCIONES_SOLAPE = {
+    'dentista': 'appointments_dentista_sin_solape',
+    'sala': 'appointments_sala_sin_solape',
+}
+
+# Postgres: restricción de exclusión sobre el rango de la cita (requiere btree_gist)
+DDL_POSTGRES = [
+    'CREATE EXTENSION IF NOT EXISTS btree_gist',
+    """ALTER TABLE appointments ADD CONSTRAINT appointments_dentista_sin_solape
+       EXCLUDE USING gist (dentist_id WITH =, tsrange(fecha_hora_inicio, fecha_hora_fin) WITH &&)
+       WHERE (estado IN ('programada', 'confirmada'))""",
+    """ALTER TABLE appointments ADD CONSTRAINT appointments_sala_sin_solape
+       EXCLUDE USING gist (room_id WITH =, tsrange(fecha_hora_inicio, fecha_hora_fin) WITH &&)
+       WHERE (estado IN ('programada', 'confirmada') AND room_id IS NOT NULL)""",
+]
+
+# SQLite: triggers que abortan la escritura si la cita solapa con otra activa.
+# El mensaje lleva el nombre de la restricción equivalente de Postgres para
+# saber qué recurso estaba ocupado (ver recurso_en_conflicto).
+_SOLAPE_SQLITE = """
+    SELECT RAISE(ABORT, '{restriccion}: la cita se solapa con otra cita activa')
+    WHERE NEW.estado IN ('programada', 'confirmada') AND EXISTS (
+        SELECT 1 FROM appointments a
+        WHERE a.id IS NOT NEW.id
+          AND a.estado IN ('programada', 'confirmada')
+          AND a.fecha_hora_inicio < NEW.fecha_hora_fin
+          AND a.fecha_hora_fin > NEW.fecha_hora_inicio
+          AND a.{columna} = NEW.{columna}
+    );
+"""
+_CONDICION_SQLITE = (_SOLAPE_SQLITE.format(restriccion=RESTRICCIONES_SOLAPE['dentista'], columna='dentist_id')
+                     + _SOLAPE_SQLITE.format(restriccion=RESTRICCIONES_SOLAPE['sala'], columna='room_id'))
+
+DDL_SQLITE = [
+    'DROP TRIGGER IF EXISTS appointments_sin_solape_insert',
+    'DROP TRIGGER IF EXISTS appointments_sin_solape_update',
+    f"""CREATE TRIGGER appointments_sin_solape_insert
+        BEFORE INSERT ON appointments BEGIN {_CONDICION_SQLITE} END""",
+    f"""CREATE TRIGGER appointments_sin_solape_update
+        BEFORE UPDATE OF dentist_id, room_id, fecha_hora_inicio, fecha_hora_fin, estado
+        ON appointments BEGIN {_CONDICION_SQLITE} END""",
+]
+
+
+def instalar_restriccion_solapes(conexion):
+    """Crea la restricción de no solapamiento adecuada al motor de base de datos."""
+    sentencias = DDL_POSTGRES if conexion.dialect.name == 'postgresql' else DDL_SQLITE
+    for sentencia in sentencias:
+        conexion.exec_driver_sql(sentencia)
@@ -0,0 +1,142 @@
+"""
+Buscador de pacientes.
+
+Cada paciente guarda en `busqueda` su texto normalizado (sin tildes y en
+minúsculas, ver Patient.texto_busqueda). Sobre esa columna se usan índices
+de texto propios de cada motor:
+
+- Postgres: índice GIN de trigramas (pg_trgm), que sirve para los LIKE de
+  prefijo de palabra ('garc%' o '% garc%').
+- SQLite: tabla FTS5 `patients_fts` sincronizada con triggers (prefijos).
+
+Los resultados se ordenan por relevancia y se paginan con cursores keyset
+sobre (relevancia, busqueda, id), así el coste no depende de la página.
+"""
+from app import db
+from app.models import Patient, normalizar_texto
+from app.pagination import POR_PAGINA, PaginaCursor, codificar_cursor, valores_cursor
+
+DDL_POSTGRES = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS ix_patients_busqueda_trgm ON patients USING gin (busqueda gin_trgm_ops)',
+]
+
+DDL_SQLITE = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5(
+        busqueda, content='patients', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS patients_fts_insert AFTER INSERT ON patients BEGIN
+        INSERT INTO patients_fts(rowid, busqueda) VALUES (NEW.id, NEW.busqueda);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS patients_fts_delete AFTER DELETE ON patients BEGIN
+        INSERT INTO patients_fts(patients_fts, rowid, busqueda) VALUES ('delete', OLD.id, OLD.busqueda);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS patients_fts_update AFTER UPDATE OF busqueda ON patients BEGIN
+        INSERT INTO patients_fts(patients_fts, rowid, busqueda) VALUES ('delete', OLD.id, OLD.busqueda);
+        INSERT INTO patients_fts(rowid, busqueda) VALUES (NEW.id, NEW.busqueda);
+    END""",
+    # Indexar las filas que ya existieran antes de crear la tabla FTS
+    "INSERT INTO patients_fts(patients_fts) VALUES ('rebuild')",
+]
+
+# Motores con FTS5 disponible, comprobado una vez por proceso
+_fts_disponible = {}
+
+
+def instalar_indices_busqueda(conexion):
+    """Crea los índices de texto del buscador según el motor de base de datos."""
+    if conexion.dialect.name == 'postgresql':
+        sentencias = DDL_POSTGRES
+    elif conexion.dialect.name == 'sqlite':
+        sentencias = DDL_SQLITE
+    else:
+        return
+    for sentencia in sentencias:
+        conexion.exec_driver_sql(sentencia)
+
+
+def recalcular_busqueda_pacientes():
+    """Recalcula por lotes la columna `busqueda` de todos los pacientes."""
+    ultimo_id = 0
+    while True:
+        lote = Patient.query.filter(Patient.id > ultimo_id).order_by(Patient.id).limit(1000).all()
+        if not lote:
+            break
+        for paciente in lote:
+            paciente.busqueda = paciente.texto_busqueda()
+        ultimo_id = lote[-1].id
+        db.session.commit()
+
+
+def _usar_fts():
+    """Indica si la base de datos actual es SQLite con la tabla FTS instalada."""
+    engine = db.engine
+    if engine.dialect.name != 'sqlite':
+        return False
+    if engine.url not in _fts_disponible:
+        _fts_disponible[engine.url] = db.inspect(engine).has_table('patients_fts')
+    return _fts_disponible[engine.url]
+
+
+def _escapar_like(texto):
+    return texto.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _filtro_texto(palabras):
+    """Condición que exige que todas las palabras aparezcan en el paciente."""
+    if _usar_fts():
+        # Búsqueda por prefijo de cada palabra: "garc"* "ana"*
+        consulta = ' '.join('"%s"*' % p.replace('"', '""') for p in palabras)
+        return Patient.id.in_(
+            db.select(db.literal_column('rowid'))
+            .select_from(db.table('patients_fts'))
+            .where(db.literal_column('patients_fts').op('MATCH')(consulta))
+        )
+    # Mismo criterio que FTS: cada palabra debe empezar alguna palabra del paciente
+    return db.and_(*[
+        db.or_(
+            Patient.busqueda.like(f'{_escapar_like(p)}%', escape='\\'),
+            Patient.busqueda.like(f'% {_escapar_like(p)}%', escape='\\')
+        ) for p in palabras
+    ])
+
+
+def _relevancia(normalizado):
+    """0 si coinciden los apellidos desde el principio, 1 si empieza una palabra, 2 si no."""
+    termino = _escapar_like(normalizado)
+    return db.case(
+        (Patient.busqueda.like(f'{termino}%', escape='\\'), 0),
+        (Patient.busqueda.like(f'% {termino}%', escape='\\'), 1),
+        else_=2
+    )
+
+
+def buscar_pacientes(termino, cursor=None, por_pagina=POR_PAGINA, solo_activos=True):
+    """Busca pacientes por nombre, apellidos, email o DNI, ordenados por relevancia."""
+    normalizado = normalizar_texto(termino)
+    palabras = normalizado.split()
+
+    query = Patient.query
+    if solo_activos:
+        query = query.filter(Patient.activo == True)
+    if palabras:
+        query = query.filter(_filtro_texto(palabras))
+        relevancia = _relevancia(normalizado)
+    else:
+        relevancia = db.literal(0)
+
+    orden = (relevancia, Patient.busqueda, Patient.id)
+    valores = valores_cursor(cursor, orden)
+    if valores:
+        query = query.filter(db.tuple_(*orden) > db.tuple_(*[db.literal(v, type_=c.type)
+                                                              for c, v in zip(orden, valores)]))
+
+    filas = query.add_columns(relevancia).order_by(*orden).limit(por_pagina + 1).all()
+
+    cursor_siguiente = None
+    if len(filas) > por_pagina:
+        filas = filas[:por_pagina]
+        ultimo, rango = filas[-1]
+        cursor_siguiente = codificar_cursor([rango, ultimo.busqueda, ultimo.id])
+
+    return PaginaCursor([paciente for paciente, _ in filas], cursor_siguiente)
@@ -0,0 +1,96 @@
+"""
+Caché de los usuarios con sesión iniciada.
+
+Flask-Login llama a `load_user` en cada petición autenticada (incluidas las
+consultas periódicas del calendario). Cada worker guarda una copia desacoplada
+de los últimos usuarios en un LRU y la vuelve a unir a la sesión de la
+petición con `merge(load=False)`, sin SELECT.
+
+Cada copia guarda la versión de la etiqueta 'usuario:<id>' de la caché
+compartida (app/cache.py) con la que se leyó. Al guardar cambios en el
+usuario (rol, activo, contraseña...) la etiqueta se incrementa y todos los
+workers descartan su copia en la siguiente petición, así que desactivar a
+un usuario o cambiarle la contraseña corta sus sesiones al momento. Con la
+caché desactivada ('nula') no hay versión compartida y el usuario se lee
+siempre de la base de datos. USUARIO_TTL limita además la vida de cada copia.
+"""
+from app import db
+from app.cache import cache
+from app.models import User
+from collections import OrderedDict
+from sqlalchemy.orm import make_transient_to_detached
+import threading
+import time
+
+USUARIO_TTL = 60
+MAX_USUARIOS = 256
+
+_cache = OrderedDict()  # user_id -> (version, caduca, copia desacoplada)
+_lock = threading.Lock()
+
+
+def _etiqueta(user_id):
+    return f'usuario:{user_id}'
+
+
+def _copia_desacoplada(usuario):
+    """Copia de las columnas del usuario, desacoplada de cualquier sesión."""
+    copia = User(**{c.key: getattr(usuario, c.key) for c in User.__table__.columns})
+    make_transient_to_detached(copia)
+    return copia
+
+
+def cargar_usuario(user_id):
+    """Devuelve el usuario de la sesión, desde la caché si su copia sigue vigente."""
+    if cache.backend.nombre == 'nula':
+        return db.session.get(User, user_id)
+
+    version = cache.versiones([_etiqueta(user_id)])[0]
+    with _lock:
+        entrada = _cache.get(user_id)
+        if entrada is not None:
+            if entrada[0] == version and time.monotonic() < entrada[1]:
+                _cache.move_to_end(user_id)
+                copia = entrada[2]
+            else:
+                del _cache[user_id]
+                copia = None
+        else:
+            copia = None
+
+    if copia is not None:
+        return db.session.merge(copia, load=False)
+
+    usuario = db.session.get(User, user_id)
+    if usuario is not None:
+        with _lock:
+            _cache[user_id] = (version, time.monotonic() + USUARIO_TTL, _copia_desacoplada(usuario))
+            while len(_cache) > MAX_USUARIOS:
+                _cache.popitem(last=False)
+    return usuario
+
+
+def invalidar_usuario(user_id):
+    """Invalida la copia en caché de un usuario en todos los workers."""
+    cache.invalidar(_etiqueta(user_id))
+    with _lock:
+        _cache.pop(user_id, None)
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def _anotar_usuarios_modificados(session, flush_context):
+    modificados = session.info.setdefault('usuarios_modificados', set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User) and obj.id is not None:
+            modificados.add(obj.id)
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def _invalidar_usuarios_modificados(session):
+    for user_id in session.info.pop('usuarios_modificados', set()):
+        invalidar_usuario(user_id)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def _descartar_usuarios_modificados(session):
+    session.info.pop('usuarios_modificados', None)
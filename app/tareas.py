@@ -0,0 +1,126 @@
+"""
+Tareas de la cola de trabajos (ver app/jobs.py).
+"""
+from app import db
+from app.jobs import tarea
+from app.models import User, Honorario, Invoice, Payment, ClinicSettings
+from app.pagination import paginar
+from app.pdf import pdf_honorarios, pdf_liquidacion_honorarios, pdf_factura, LoteFacturas
+from app.reporting import detalle_honorarios
+from datetime import date, datetime, timedelta
+from itertools import groupby
+import zipfile
+
+BLOQUE = 1000  # filas por consulta en las exportaciones
+
+
+def _fecha(valor, defecto):
+    return datetime.strptime(valor, '%Y-%m-%d').date() if valor else defecto
+
+
+@tarea('honorarios_pdf', parametros=('doctor_id',))
+def honorarios_pdf(ejecucion, doctor_id):
+    """PDF de los honorarios configurados para un doctor."""
+    doctor = db.session.get(User, int(doctor_id))
+    if doctor is None or doctor.rol != 'dentista':
+        raise ValueError('El usuario seleccionado no es un dentista.')
+    honorarios = Honorario.query.filter_by(doctor_id=doctor.id).order_by(Honorario.nombre_tratamiento).all()
+    with ejecucion.abrir(f'honorarios_{doctor.nombre}_{date.today():%Y%m%d}.pdf') as f:
+        f.write(pdf_honorarios(doctor, honorarios, ClinicSettings.cached()))
+
+
+@tarea('honorarios_periodo', parametros=('fecha_desde', 'fecha_hasta'))
+def honorarios_periodo(ejecucion, fecha_desde=None, fecha_hasta=None):
+    """ZIP con la liquidación de honorarios de cada doctor en el periodo (por defecto, el año en curso)."""
+    hoy = date.today()
+    desde = _fecha(fecha_desde, date(hoy.year, 1, 1))
+    hasta = _fecha(fecha_hasta, hoy)
+    configuracion = ClinicSettings.cached()
+
+    doctores = User.query.filter_by(rol='dentista').order_by(User.nombre).all()
+    with ejecucion.abrir(f'honorarios_{desde:%Y%m%d}_{hasta:%Y%m%d}.zip') as f, \
+            zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as zip_salida:
+        for n, doctor in enumerate(doctores):
+            ejecucion.progreso(n * 100 / max(len(doctores), 1), f'{doctor.nombre} ({n + 1}/{len(doctores)})')
+            honorarios = Honorario.query.filter_by(doctor_id=doctor.id).all()
+            if not honorarios:
+                continue
+            detalle = detalle_honorarios(honorarios, desde, hasta)
+            filas = sorted(
+                ((item, paciente, honorario) for honorario in honorarios
+                 for item, _, paciente in detalle[honorario.id]),
+                key=lambda fila: (fila[0].fecha_realizacion or desde, fila[0].id)
+            )
+            zip_salida.writestr(f'honorarios_{doctor.id}_{doctor.nombre.replace(" ", "_")}.pdf',
+                                pdf_liquidacion_honorarios(doctor, filas, desde, hasta, configuracion))
+            db.session.expunge_all()  # no acumular en memoria los tratamientos de todos los doctores
+
+
+def _facturas_del_periodo(fecha_inicio, fecha_fin, estado):
+    """Consulta de las facturas del periodo (por defecto, el mes en curso) con su paciente."""
+    hoy = date.today()
+    inicio = _fecha(fecha_inicio, hoy.replace(day=1))
+    fin = _fecha(fecha_fin, hoy)
+    query = Invoice.query.options(db.joinedload(Invoice.patient)).filter(
+        Invoice.fecha_emision >= inicio,
+        Invoice.fecha_emision < fin + timedelta(days=1)
+    )
+    if estado and estado != 'todas':
+        query = query.filter_by(estado_pago=estado)
+    return inicio, fin, query
+
+
+def _por_bloques(query):
+    """Recorre la consulta en bloques de BLOQUE facturas con cursor, vaciando la sesión entre bloques."""
+    cursor = None
+    while True:
+        pagina = paginar(query, [Invoice.fecha_emision, Invoice.id], cursor, por_pagina=BLOQUE)
+        yield pagina.items
+        db.session.expunge_all()
+        if not pagina.has_next:
+            return
+        cursor = pagina.cursor_siguiente
+
+
+def _pagos(facturas):
+    """Pagos de un bloque de facturas en una sola consulta, por factura."""
+    pagos = Payment.query.filter(Payment.invoice_id.in_([f.id for f in facturas])) \
+        .order_by(Payment.invoice_id, Payment.fecha_pago).all()
+    return {invoice_id: list(grupo) for invoice_id, grupo in groupby(pagos, key=lambda p: p.invoice_id)}
+
+
+@tarea('facturas_pdf', parametros=('fecha_inicio', 'fecha_fin', 'estado', 'formato'))
+def facturas_pdf(ejecucion, fecha_inicio=None, fecha_fin=None, estado='todas', formato='pdf'):
+    """
+    Facturas del periodo en PDF: todas en un único PDF (formato 'pdf') o un
+    PDF por factura dentro de un ZIP (formato 'zip'). Logo, estilos y
+    configuración se cargan una vez para todo el lote.
+    """
+    inicio, fin, query = _facturas_del_periodo(fecha_inicio, fecha_fin, estado)
+    total = query.count()
+    configuracion = ClinicSettings.cached()
+    nombre = f'facturas_{inicio:%Y%m%d}_{fin:%Y%m%d}'
+    hechas = 0
+
+    if formato == 'zip':
+        with ejecucion.abrir(f'{nombre}.zip') as f, zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as zip_salida:
+            for facturas in _por_bloques(query):
+                pagos = _pagos(facturas)
+                for factura in facturas:
+                    zip_salida.writestr(f'factura_{factura.id}.pdf',
+                                        pdf_factura(factura, pagos.get(factura.id, []), configuracion))
+                    hechas += 1
+                    ejecucion.progreso(hechas * 100 / max(total, 1), f'{hechas} de {total} facturas')
+        return
+
+    # Un solo PDF: se prepara el contenido por bloques y se maqueta al final
+    lote = LoteFacturas(configuracion)
+    for facturas in _por_bloques(query):
+        pagos = _pagos(facturas)
+        for factura in facturas:
+            lote.agregar(factura, pagos.get(factura.id, []))
+        hechas += len(facturas)
+        ejecucion.progreso(hechas * 50 / max(total, 1), f'{hechas} de {total} facturas preparadas')
+    ejecucion.progreso(50, 'Maquetando el PDF...')
+    with ejecucion.abrir(f'{nombre}.pdf') as f:
+        lote.guardar(f, titulo=f'Facturas {inicio:%d/%m/%Y} - {fin:%d/%m/%Y}')
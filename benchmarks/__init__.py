@@ -0,0 +1,10 @@
+"""
+Benchmarks de los endpoints más usados del panel y del área del paciente.
+
+Genera (o reutiliza) una base de datos sintética con generate_bulk_data.py,
+lanza cada escenario con el cliente de pruebas de Flask y guarda en JSON la
+latencia p50/p95, las consultas SQL por petición y el pico de memoria.
+
+    python -m benchmarks run --escala pequena
+    python -m benchmarks diff benchmarks/resultados/abc1234.json benchmarks/resultados/def5678.json
+"""
@@ -0,0 +1,195 @@
+"""
+Línea de órdenes del benchmark.
+
+    python -m benchmarks run [--escala pequena] [--iteraciones 20] [--solo dashboard ...]
+    python -m benchmarks diff ANTES.json DESPUES.json [--umbral 10]
+"""
+from datetime import date, datetime
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+
+DIRECTORIO_RESULTADOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resultados')
+
+
+def commit_actual():
+    """Hash corto del commit actual, con '+' si hay cambios sin guardar."""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                         stderr=subprocess.DEVNULL).strip()
+        cambios = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], text=True,
+                                          stderr=subprocess.DEVNULL).strip()
+        return commit + ('+' if cambios else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'desconocido'
+
+
+def ejecutar(args):
+    from generate_bulk_data import ESCALAS
+
+    hasta = args.hasta or date.today()
+    volumenes = dict(ESCALAS[args.escala])
+    database_url = args.database_url
+    generar_datos = args.regenerar
+    if database_url is None:
+        # Base SQLite propia por escala, semilla y fecha: se genera una vez y se reutiliza
+        ruta = os.path.join(tempfile.gettempdir(), f'clinica-bench-{args.escala}-{args.semilla}-{hasta}.db')
+        if args.regenerar and os.path.exists(ruta):
+            os.remove(ruta)
+        generar_datos = not os.path.exists(ruta)
+        database_url = f'sqlite:///{ruta}'
+
+    # La configuración se lee al crear la app
+    os.environ['DATABASE_URL'] = database_url
+    if not args.con_cache:
+        os.environ['CACHE_TYPE'] = 'nula'
+
+    from app import create_app, db
+    from benchmarks.escenarios import ESCENARIOS, preparar_contexto, cliente_admin, cliente_paciente
+    from benchmarks.medicion import medir
+    from flask import url_for
+
+    app = create_app()
+    escenarios = [e for e in ESCENARIOS if not args.solo or e[0] in args.solo]
+    with app.app_context():
+        if generar_datos:
+            from generate_bulk_data import generar
+            print(f"Generando datos ({args.escala}, semilla {args.semilla}, hasta {hasta})...")
+            db.create_all()
+            generar(volumenes, semilla=args.semilla, hasta=hasta)
+        contexto = preparar_contexto(hasta)
+        # Los clientes se crean antes de la primera petición (registran hooks en la app)
+        clientes = {'admin': cliente_admin(app, contexto), 'paciente': cliente_paciente(app, contexto)}
+        with app.test_request_context():
+            urls = {nombre: url_for(endpoint, **parametros(contexto))
+                    for nombre, _, endpoint, parametros in escenarios}
+        motor = db.engine.dialect.name
+        db.session.remove()
+
+    resultados = {}
+    print(f"\n{'Escenario':<28}{'p50 ms':>10}{'p95 ms':>10}{'SQL':>6}{'Mem KB':>10}  Estado")
+    for nombre, sesion, _, _ in escenarios:
+        with app.app_context():
+            resultado = medir(clientes[sesion], urls[nombre], args.iteraciones, args.calentamiento)
+        resultados[nombre] = resultado
+        print(f"{nombre:<28}{resultado['p50_ms']:>10.1f}{resultado['p95_ms']:>10.1f}"
+              f"{resultado['sql']:>6}{resultado['memoria_pico_kb']:>10.0f}  {resultado['estado']}")
+
+    salida = {
+        'commit': commit_actual(),
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'motor': motor,
+        'escala': args.escala if not args.database_url else None,
+        'volumenes': volumenes if not args.database_url else None,
+        'semilla': args.semilla,
+        'hasta': hasta.isoformat(),
+        'cache': bool(args.con_cache),
+        'escenarios': resultados,
+    }
+    ruta_salida = args.salida or os.path.join(
+        DIRECTORIO_RESULTADOS, f"{datetime.now():%Y%m%d-%H%M%S}-{salida['commit']}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(ruta_salida)), exist_ok=True)
+    with open(ruta_salida, 'w', encoding='utf-8') as f:
+        json.dump(salida, f, indent=2, ensure_ascii=False)
+    print(f"\nOK: Resultados guardados en {ruta_salida}")
+
+    errores = [n for n, r in resultados.items() if r['estado'] != 200]
+    if errores:
+        print(f"ERROR: Respuestas distintas de 200 en: {', '.join(errores)}")
+        return 1
+    return 0
+
+
+def _variacion(antes, despues):
+    if not antes:
+        return 0.0 if not despues else float('inf')
+    return (despues - antes) / antes * 100
+
+
+def comparar(args):
+    with open(args.antes, encoding='utf-8') as f:
+        antes = json.load(f)
+    with open(args.despues, encoding='utf-8') as f:
+        despues = json.load(f)
+
+    print(f"Antes:   {antes['commit']} ({antes['fecha']})")
+    print(f"Después: {despues['commit']} ({despues['fecha']})")
+    for clave in ('motor', 'volumenes', 'semilla', 'hasta', 'cache'):
+        if antes.get(clave) != despues.get(clave):
+            print(f"Aviso: '{clave}' distinto entre ejecuciones ({antes.get(clave)} / {despues.get(clave)})")
+
+    regresiones = []
+    print(f"\n{'Escenario':<28}{'p50 ms':>20}{'p95 ms':>20}{'SQL':>10}{'Mem KB':>18}")
+    for nombre in sorted(set(antes['escenarios']) | set(despues['escenarios'])):
+        a = antes['escenarios'].get(nombre)
+        d = despues['escenarios'].get(nombre)
+        if a is None or d is None:
+            print(f"{nombre:<28}{'(solo en ' + ('después' if a is None else 'antes') + ')':>20}")
+            continue
+        var_p50 = _variacion(a['p50_ms'], d['p50_ms'])
+        var_p95 = _variacion(a['p95_ms'], d['p95_ms'])
+        var_mem = _variacion(a['memoria_pico_kb'], d['memoria_pico_kb'])
+        motivos = []
+        if var_p50 > args.umbral:
+            motivos.append(f'p50 +{var_p50:.0f}%')
+        if var_p95 > args.umbral:
+            motivos.append(f'p95 +{var_p95:.0f}%')
+        if d['sql'] > a['sql']:
+            motivos.append(f"SQL {a['sql']}→{d['sql']}")
+        if var_mem > args.umbral:
+            motivos.append(f'memoria +{var_mem:.0f}%')
+        if motivos:
+            regresiones.append((nombre, motivos))
+        print(f"{nombre:<28}"
+              f"{a['p50_ms']:>8.1f}→{d['p50_ms']:<7.1f}{var_p50:>+4.0f}%"
+              f"{a['p95_ms']:>8.1f}→{d['p95_ms']:<7.1f}{var_p95:>+4.0f}%"
+              f"{a['sql']:>5}→{d['sql']:<4}"
+              f"{a['memoria_pico_kb']:>8.0f}→{d['memoria_pico_kb']:<7.0f}"
+              f"{' <-- regresión' if motivos else ''}")
+
+    if regresiones:
+        print(f"\nERROR: {len(regresiones)} regresión(es) por encima del {args.umbral:.0f}%:")
+        for nombre, motivos in regresiones:
+            print(f"  - {nombre}: {', '.join(motivos)}")
+        return 1
+    print("\nOK: Sin regresiones")
+    return 0
+
+
+def main(argumentos=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='orden', required=True)
+
+    run = subparsers.add_parser('run', help='Ejecuta los escenarios y guarda los resultados en JSON')
+    run.add_argument('--escala', default='pequena', help='Escala de generate_bulk_data.py (pequena, media, cadena)')
+    run.add_argument('--semilla', type=int, default=42)
+    run.add_argument('--hasta', type=date.fromisoformat, default=None,
+                     help='Fecha "actual" de los datos y de las consultas (AAAA-MM-DD); por defecto, hoy')
+    run.add_argument('--database-url', default=None,
+                     help='Base de datos ya poblada; por defecto, una SQLite temporal por escala y semilla')
+    run.add_argument('--regenerar', action='store_true', help='Vuelve a generar los datos aunque ya existan')
+    run.add_argument('--iteraciones', type=int, default=20)
+    run.add_argument('--calentamiento', type=int, default=2)
+    run.add_argument('--solo', nargs='+', metavar='ESCENARIO', help='Ejecuta solo estos escenarios')
+    run.add_argument('--con-cache', action='store_true', help='Mantiene la caché de vistas (por defecto, desactivada)')
+    run.add_argument('--salida', default=None, help='Fichero JSON de resultados')
+    run.set_defaults(funcion=ejecutar)
+
+    diff = subparsers.add_parser('diff', help='Compara dos ficheros de resultados')
+    diff.add_argument('antes')
+    diff.add_argument('despues')
+    diff.add_argument('--umbral', type=float, default=10.0, help='Porcentaje de empeoramiento tolerado')
+    diff.set_defaults(funcion=comparar)
+
+    args = parser.parse_args(argumentos)
+    return args.funcion(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""
+Escenarios del benchmark: endpoint, usuario con el que se lanza y URL.
+"""
+from app import db
+from app.models import User, Patient, Honorario
+from datetime import timedelta
+from flask import request
+from flask_login import login_user
+from werkzeug.security import generate_password_hash
+
+# (nombre, sesión, endpoint, función que construye los parámetros a partir del contexto)
+ESCENARIOS = [
+    ('calendario_citas_semana', 'admin', 'panel.calendario_citas_semana',
+     lambda c: {'fecha': c['fecha'].isoformat()}),
+    ('calendario_disponibilidad', 'paciente', 'patient.calendario_disponibilidad',
+     lambda c: {'fecha': c['fecha_disponibilidad'].isoformat(), 'dentist_id': c['dentista_id']}),
+    ('api_pacientes_buscar', 'admin', 'panel.api_pacientes_buscar',
+     lambda c: {'q': c['busqueda']}),
+    ('dashboard', 'admin', 'panel.dashboard',
+     lambda c: {}),
+    ('invoices_list', 'admin', 'panel.invoices_list',
+     lambda c: {}),
+    ('gestoria_dashboard', 'admin', 'panel.gestoria_dashboard',
+     lambda c: {'fecha_inicio': c['inicio_mes'].isoformat(), 'fecha_fin': c['fecha'].isoformat()}),
+    ('honorarios_list', 'admin', 'panel.honorarios_list',
+     lambda c: {'fecha_desde': c['inicio_mes'].isoformat(), 'fecha_hasta': c['fecha'].isoformat()}),
+    ('honorarios_pdf', 'admin', 'panel.honorarios_pdf',
+     lambda c: {'doctor_id': c['dentista_id']}),
+]
+
+
+def preparar_contexto(fecha):
+    """
+    Datos de los que dependen las URLs: un administrador para el benchmark, el
+    dentista con más honorarios, un paciente y un texto de búsqueda.
+    """
+    admin = User.query.filter_by(email='benchmark@sintetico.local').first()
+    if admin is None:
+        admin = User(nombre='Benchmark', email='benchmark@sintetico.local', rol='admin', activo=True,
+                     password_hash=generate_password_hash('benchmark'))
+        db.session.add(admin)
+        db.session.commit()
+
+    dentista_id = db.session.query(Honorario.doctor_id).group_by(Honorario.doctor_id) \
+        .order_by(db.func.count().desc(), Honorario.doctor_id).limit(1).scalar()
+    if dentista_id is None:
+        dentista_id = db.session.query(User.id).filter_by(rol='dentista').order_by(User.id).limit(1).scalar()
+    paciente = Patient.query.order_by(Patient.id).first()
+    if dentista_id is None or paciente is None:
+        raise RuntimeError('La base de datos no tiene dentistas o pacientes: genera los datos primero')
+
+    # Siguiente día laborable: la disponibilidad de un día pasado o festivo no calcula nada
+    fecha_disponibilidad = fecha + timedelta(days=1)
+    while fecha_disponibilidad.weekday() >= 5:
+        fecha_disponibilidad += timedelta(days=1)
+
+    return {
+        'admin_id': admin.id,
+        'paciente_id': paciente.id,
+        'dentista_id': dentista_id,
+        'busqueda': paciente.apellidos.split()[0][:4].lower(),
+        'fecha': fecha,
+        'fecha_disponibilidad': fecha_disponibilidad,
+        'inicio_mes': fecha.replace(day=1),
+    }
+
+
+def cliente_admin(app, contexto):
+    """Cliente de pruebas con la sesión del administrador del benchmark."""
+    cliente = app.test_client()
+    with cliente.session_transaction() as sesion:
+        sesion['_user_id'] = str(contexto['admin_id'])
+        sesion['_fresh'] = True
+    return cliente
+
+
+def cliente_paciente(app, contexto):
+    """
+    Cliente de pruebas con sesión de paciente.
+
+    Patient no implementa la interfaz de Flask-Login y load_user solo carga
+    usuarios internos, así que un paciente no puede iniciar sesión por la vía
+    normal. Para medir el endpoint real, un before_request de esta app (solo en
+    el benchmark) inicia sesión en cada petición marcada con la cabecera
+    X-Benchmark-Paciente con una copia desacoplada del paciente, a la que se le
+    añaden los atributos de Flask-Login. No lanza consultas.
+    """
+    paciente = db.session.get(Patient, contexto['paciente_id'])
+    db.session.expunge(paciente)
+    paciente.is_authenticated = True
+    paciente.is_active = True
+    paciente.is_anonymous = False
+    paciente.get_id = lambda: str(contexto['paciente_id'])
+
+    @app.before_request
+    def _sesion_paciente():
+        if request.headers.get('X-Benchmark-Paciente'):
+            login_user(paciente)
+
+    cliente = app.test_client()
+    cliente.environ_base['HTTP_X_BENCHMARK_PACIENTE'] = '1'
+    return cliente
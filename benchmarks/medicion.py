@@ -0,0 +1,76 @@
+"""
+Medición de un escenario: latencia, consultas SQL y memoria.
+"""
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import statistics
+import time
+import tracemalloc
+
+_contador = {'activo': False, 'consultas': 0}
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _contar_consulta(conn, cursor, statement, parameters, context, executemany):
+    if _contador['activo']:
+        _contador['consultas'] += 1
+
+
+def percentil(valores, p):
+    """Percentil por rango más cercano (p entre 0 y 100)."""
+    ordenados = sorted(valores)
+    indice = max(0, min(len(ordenados) - 1, round(p / 100 * len(ordenados) + 0.5) - 1))
+    return ordenados[indice]
+
+
+def peticion(cliente, url):
+    """Lanza una petición GET y devuelve (respuesta, segundos, consultas SQL)."""
+    _contador['consultas'] = 0
+    _contador['activo'] = True
+    try:
+        inicio = time.perf_counter()
+        respuesta = cliente.get(url)
+        respuesta.get_data()
+        segundos = time.perf_counter() - inicio
+    finally:
+        _contador['activo'] = False
+    return respuesta, segundos, _contador['consultas']
+
+
+def medir(cliente, url, iteraciones=20, calentamiento=2):
+    """
+    Mide un endpoint. Tras `calentamiento` peticiones descartadas, cronometra
+    `iteraciones` peticiones y hace una más bajo tracemalloc para el pico de
+    memoria (se mide aparte porque tracemalloc ralentiza la ejecución).
+    """
+    for _ in range(calentamiento):
+        peticion(cliente, url)
+
+    tiempos = []
+    consultas = []
+    estado = None
+    for _ in range(iteraciones):
+        respuesta, segundos, num_consultas = peticion(cliente, url)
+        tiempos.append(segundos * 1000)
+        consultas.append(num_consultas)
+        estado = respuesta.status_code
+
+    tracemalloc.start()
+    try:
+        peticion(cliente, url)
+        _, pico = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'url': url,
+        'estado': estado,
+        'iteraciones': iteraciones,
+        'p50_ms': round(percentil(tiempos, 50), 2),
+        'p95_ms': round(percentil(tiempos, 95), 2),
+        'media_ms': round(statistics.fmean(tiempos), 2),
+        'max_ms': round(max(tiempos), 2),
+        'sql': statistics.median_low(consultas),
+        'sql_max': max(consultas),
+        'memoria_pico_kb': round(pico / 1024, 1),
+    }
@@ -0,0 +1,431 @@
+"""
+Generador de datos sintéticos masivos para pruebas de rendimiento.
+
+A diferencia de generate_test_data.py, inserta con Core `insert()` en lotes
+grandes (executemany) y usa una semilla fija: con la misma semilla, escala y
+fecha final se obtienen siempre los mismos datos.
+
+Ejecutar:
+    python generate_bulk_data.py --escala pequena
+    python generate_bulk_data.py --escala cadena --semilla 7 --hasta 2025-06-30
+    python generate_bulk_data.py --escala media --pacientes 50000 --citas 1000000
+
+Escalas predefinidas (ver ESCALAS); cualquier volumen se puede ajustar con su
+opción. Las citas llenan la agenda de cada dentista hacia atrás desde un mes
+después de --hasta, así que el periodo cubierto depende de citas/dentistas.
+"""
+import argparse
+import math
+import random
+import sys
+import time as reloj
+from datetime import datetime, timedelta, date, time
+from decimal import Decimal
+
+from app import create_app, db
+from app.models import (
+    User, Patient, Appointment, TreatmentPlan, TreatmentItem, Invoice, Payment,
+    Room, DoctorSchedule, TimeClock, Honorario, normalizar_texto
+)
+from app.scheduling import DURACION_TRAMO
+from werkzeug.security import generate_password_hash
+
+ESCALAS = {
+    'pequena': dict(dentistas=5, empleados=5, pacientes=2000, citas=20000,
+                    facturas=5000, planes=2000, dias_fichaje=90),
+    'media': dict(dentistas=20, empleados=20, pacientes=20000, citas=300000,
+                  facturas=100000, planes=20000, dias_fichaje=365),
+    'cadena': dict(dentistas=50, empleados=100, pacientes=200000, citas=5000000,
+                   facturas=1000000, planes=200000, dias_fichaje=730),
+}
+
+NOMBRES = ['María', 'José', 'Ana', 'Carlos', 'Laura', 'Miguel', 'Carmen', 'David', 'Sofía', 'Juan',
+           'Lucía', 'Javier', 'Paula', 'Daniel', 'Elena', 'Pablo', 'Marta', 'Sergio', 'Irene', 'Álvaro']
+APELLIDOS = ['García', 'Rodríguez', 'González', 'Fernández', 'López', 'Martínez', 'Sánchez', 'Pérez',
+             'Gómez', 'Martín', 'Jiménez', 'Ruiz', 'Hernández', 'Díaz', 'Moreno', 'Muñoz', 'Álvarez',
+             'Romero', 'Alonso', 'Gutiérrez', 'Navarro', 'Torres', 'Domínguez', 'Vázquez', 'Ramos']
+TRATAMIENTOS = {
+    'Limpieza dental profesional': 60,
+    'Empaste pieza': 80,
+    'Endodoncia': 250,
+    'Corona cerámica': 450,
+    'Blanqueamiento dental': 300,
+    'Extracción': 70,
+    'Ortodoncia brackets metálicos': 2500,
+    'Implante dental': 1200,
+    'Carilla dental': 400,
+    'Revisión y diagnóstico': 40,
+}
+METODOS_PAGO = ['efectivo', 'tarjeta', 'transferencia', 'financiación']
+LETRAS_DNI = 'TRWAGMYFPDXBNJZSQVHLCKE'
+
+# Jornada de los dentistas: lunes a viernes de 9:00 a 20:00
+HORA_APERTURA = time(9, 0)
+HORA_CIERRE = time(20, 0)
+OCUPACION_AGENDA = 0.8  # fracción de tramos ocupados cada día
+
+
+def siguiente_id(conexion, modelo):
+    """Primer id libre de la tabla: los ids se asignan aquí para enlazar las FK sin consultas."""
+    return (conexion.execute(db.select(db.func.max(modelo.id))).scalar() or 0) + 1
+
+
+def insertar(conexion, modelo, filas, lote):
+    """Inserta un iterable de filas (dicts) en lotes de `lote` con executemany."""
+    total = 0
+    pendientes = []
+    for fila in filas:
+        pendientes.append(fila)
+        if len(pendientes) >= lote:
+            conexion.execute(db.insert(modelo), pendientes)
+            total += len(pendientes)
+            pendientes = []
+    if pendientes:
+        conexion.execute(db.insert(modelo), pendientes)
+        total += len(pendientes)
+    return total
+
+
+def dias_laborables(desde, hasta):
+    """Días de lunes a viernes entre dos fechas (incluidas)."""
+    dia = desde
+    while dia <= hasta:
+        if dia.weekday() < 5:
+            yield dia
+        dia += timedelta(days=1)
+
+
+class Generador:
+    """Genera cada tabla a partir de un random.Random con semilla fija."""
+
+    def __init__(self, conexion, volumenes, semilla, hasta, lote):
+        self.conexion = conexion
+        self.v = volumenes
+        self.semilla = semilla
+        self.hasta = hasta
+        self.lote = lote
+        self.ahora = datetime.combine(hasta, time(12, 0))
+        # Un password hash para todos: generarlo por fila es lo más lento del proceso
+        self.password_hash = generate_password_hash('sintetico')
+
+    def rng(self, tabla):
+        """Generador aleatorio propio de cada tabla: cambiar un volumen no altera las demás."""
+        return random.Random(f'{self.semilla}:{tabla}')
+
+    def paso(self, titulo, modelo, filas):
+        inicio = reloj.perf_counter()
+        print(f"  {titulo}...", end=' ', flush=True)
+        total = insertar(self.conexion, modelo, filas, self.lote)
+        print(f"{total} filas en {reloj.perf_counter() - inicio:.1f}s")
+        return total
+
+    # ---------- Personal, salas y horarios ----------
+
+    def usuarios(self):
+        rng = self.rng('usuarios')
+        primer_id = siguiente_id(self.conexion, User)
+        roles = ['dentista'] * self.v['dentistas'] + \
+            [rng.choice(['recepcionista', 'auxiliar', 'comercial']) for _ in range(self.v['empleados'])]
+        self.dentistas = list(range(primer_id, primer_id + self.v['dentistas']))
+        self.empleados = list(range(primer_id, primer_id + len(roles)))
+
+        def filas():
+            for i, rol in enumerate(roles):
+                user_id = primer_id + i
+                yield {
+                    'id': user_id,
+                    'nombre': f"{'Dr. ' if rol == 'dentista' else ''}{rng.choice(NOMBRES)} {rng.choice(APELLIDOS)}",
+                    'email': f'{rol}{user_id}@sintetico.local',
+                    'password_hash': self.password_hash,
+                    'rol': rol,
+                    'activo': True,
+                    'fecha_creacion': self.ahora - timedelta(days=3 * 365),
+                }
+        return self.paso('Usuarios', User, filas())
+
+    def salas(self):
+        # Una sala por dentista: así las citas de un dentista nunca chocan con otro por la sala
+        primer_id = siguiente_id(self.conexion, Room)
+        self.sala_de = {dentista: primer_id + i for i, dentista in enumerate(self.dentistas)}
+        filas = ({
+            'id': sala_id,
+            'nombre': f'Sillón sintético {sala_id}',
+            'descripcion': 'Generado por generate_bulk_data.py',
+            'activo': True,
+        } for sala_id in self.sala_de.values())
+        return self.paso('Salas', Room, filas)
+
+    def horarios(self):
+        filas = ({
+            'doctor_id': dentista,
+            'dia_semana': dia,
+            'hora_inicio': HORA_APERTURA,
+            'hora_fin': HORA_CIERRE,
+            'activo': True,
+        } for dentista in self.dentistas for dia in range(5))
+        return self.paso('Horarios', DoctorSchedule, filas)
+
+    # ---------- Pacientes ----------
+
+    def pacientes(self):
+        rng = self.rng('pacientes')
+        primer_id = siguiente_id(self.conexion, Patient)
+        self.pacientes_ids = (primer_id, primer_id + self.v['pacientes'] - 1)
+
+        def filas():
+            for paciente_id in range(primer_id, primer_id + self.v['pacientes']):
+                nombre = rng.choice(NOMBRES)
+                apellidos = f'{rng.choice(APELLIDOS)} {rng.choice(APELLIDOS)}'
+                email = f'paciente{paciente_id}@sintetico.local'
+                numero = 10000000 + paciente_id
+                dni = f'{numero}{LETRAS_DNI[numero % 23]}'
+                yield {
+                    'id': paciente_id,
+                    'nombre': nombre,
+                    'apellidos': apellidos,
+                    'email': email,
+                    'telefono': f'6{rng.randrange(10 ** 8):08d}',
+                    'fecha_nacimiento': date(1940, 1, 1) + timedelta(days=rng.randrange(80 * 365)),
+                    'dni': dni,
+                    'fecha_alta': self.ahora - timedelta(days=rng.randrange(5 * 365)),
+                    'activo': rng.random() > 0.03,
+                    'busqueda': normalizar_texto(f'{apellidos} {nombre} {email} {dni}'),
+                }
+        return self.paso('Pacientes', Patient, filas())
+
+    def paciente_aleatorio(self, rng):
+        return rng.randint(*self.pacientes_ids)
+
+    # ---------- Citas ----------
+
+    def citas(self):
+        rng = self.rng('citas')
+        tramos_dia = int((datetime.combine(date.min, HORA_CIERRE) - datetime.combine(date.min, HORA_APERTURA))
+                         .total_seconds() // 60 // DURACION_TRAMO)
+        por_dia = max(1, round(tramos_dia * OCUPACION_AGENDA))
+        dias_necesarios = math.ceil(self.v['citas'] / (len(self.dentistas) * por_dia))
+        print(f"    (agenda de {dias_necesarios} días laborables por dentista)")
+
+        def filas():
+            restantes = self.v['citas']
+            # Del futuro hacia el pasado: las citas activas (futuras) se insertan con la tabla
+            # aún pequeña, y la comprobación de solapes de SQLite solo actúa sobre ellas
+            dia = self.hasta + timedelta(days=30)
+            while restantes > 0:
+                if dia.weekday() < 5:
+                    inicio_dia = datetime.combine(dia, HORA_APERTURA)
+                    for dentista in self.dentistas:
+                        for tramo in sorted(rng.sample(range(tramos_dia), por_dia)):
+                            if restantes == 0:
+                                return
+                            inicio = inicio_dia + timedelta(minutes=tramo * DURACION_TRAMO)
+                            if inicio > self.ahora:
+                                estado = 'confirmada' if rng.random() < 0.4 else 'programada'
+                            else:
+                                estado = 'cancelada' if rng.random() < 0.12 else 'realizada'
+                            creada = inicio - timedelta(days=rng.randint(1, 60))
+                            yield {
+                                'patient_id': self.paciente_aleatorio(rng),
+                                'dentist_id': dentista,
+                                'room_id': self.sala_de[dentista],
+                                'fecha_hora_inicio': inicio,
+                                'fecha_hora_fin': inicio + timedelta(minutes=DURACION_TRAMO),
+                                'motivo': rng.choice(list(TRATAMIENTOS)),
+                                'estado': estado,
+                                'fecha_creacion': creada,
+                                'fecha_actualizacion': creada,
+                            }
+                            restantes -= 1
+                dia -= timedelta(days=1)
+        return self.paso('Citas', Appointment, filas())
+
+    # ---------- Tratamientos y honorarios ----------
+
+    def tratamientos(self):
+        rng = self.rng('tratamientos')
+        primer_id = siguiente_id(self.conexion, TreatmentPlan)
+        items = []
+
+        def planes():
+            for plan_id in range(primer_id, primer_id + self.v['planes']):
+                creado = self.ahora - timedelta(days=rng.randrange(2 * 365), minutes=rng.randrange(600))
+                estado = rng.choices(['finalizado', 'en_curso', 'propuesto', 'cancelado'], [50, 25, 20, 5])[0]
+                coste = 0
+                for _ in range(rng.randint(1, 4)):
+                    nombre, precio = rng.choice(list(TRATAMIENTOS.items()))
+                    realizado = estado == 'finalizado' or (estado == 'en_curso' and rng.random() < 0.5)
+                    fecha_realizacion = min(creado.date() + timedelta(days=rng.randint(0, 90)), self.hasta)
+                    items.append({
+                        'treatment_plan_id': plan_id,
+                        'nombre_tratamiento': nombre,
+                        'pieza_dental': f'{rng.randint(1, 4)}.{rng.randint(1, 8)}',
+                        'fecha_prevista': fecha_realizacion,
+                        'fecha_realizacion': fecha_realizacion if realizado else None,
+                        'estado': 'realizado' if realizado else 'pendiente',
+                        'precio': Decimal(precio),
+                    })
+                    coste += precio
+                yield {
+                    'id': plan_id,
+                    'patient_id': self.paciente_aleatorio(rng),
+                    'dentist_id': rng.choice(self.dentistas),
+                    'fecha_creacion': creado,
+                    'descripcion_general': 'Plan de tratamiento sintético',
+                    'estado': estado,
+                    'coste_estimado': Decimal(coste),
+                }
+        # Los planes se generan (y llenan `items`) antes de insertar sus líneas
+        total = self.paso('Planes de tratamiento', TreatmentPlan, planes())
+        self.paso('Líneas de tratamiento', TreatmentItem, items)
+        return total
+
+    def honorarios(self):
+        rng = self.rng('honorarios')
+        filas = ({
+            'doctor_id': dentista,
+            'nombre_tratamiento': nombre,
+            'precio': (Decimal(precio) * Decimal(rng.choice(['0.30', '0.35', '0.40']))).quantize(Decimal('0.01')),
+            'fecha_creacion': self.ahora - timedelta(days=365),
+            'fecha_actualizacion': self.ahora - timedelta(days=365),
+        } for dentista in self.dentistas for nombre, precio in TRATAMIENTOS.items())
+        return self.paso('Honorarios', Honorario, filas)
+
+    # ---------- Facturación ----------
+
+    def facturas(self):
+        rng = self.rng('facturas')
+        primer_id = siguiente_id(self.conexion, Invoice)
+        inicio = reloj.perf_counter()
+        print("  Facturas y pagos...", end=' ', flush=True)
+        facturas, pagos = [], []
+        total_facturas = total_pagos = 0
+        for factura_id in range(primer_id, primer_id + self.v['facturas']):
+            emision = self.ahora - timedelta(days=rng.randrange(2 * 365), minutes=rng.randrange(600))
+            total = Decimal(sum(rng.choice(list(TRATAMIENTOS.values())) for _ in range(rng.randint(1, 3))))
+            # Las facturas antiguas están casi todas cobradas
+            antigua = (self.ahora - emision).days > 60
+            estado = rng.choices(['pagado', 'parcial', 'pendiente'], [90, 5, 5] if antigua else [50, 20, 30])[0]
+            metodo = rng.choice(METODOS_PAGO)
+            if estado == 'pagado':
+                importes = [total] if rng.random() < 0.8 else [(total / 2).quantize(Decimal('0.01'))] * 2
+                importes[-1] = total - sum(importes[:-1])
+            elif estado == 'parcial':
+                importes = [(total * Decimal(rng.choice(['0.25', '0.5']))).quantize(Decimal('0.01'))]
+            else:
+                importes = []
+            facturas.append({
+                'id': factura_id,
+                'patient_id': self.paciente_aleatorio(rng),
+                'fecha_emision': emision,
+                'total': total,
+                'estado_pago': estado,
+                'metodo_pago': metodo,
+                # Se fija directamente: los eventos de Payment no actúan con inserts de Core
+                'total_pagado': sum(importes, Decimal('0')),
+            })
+            for n, cantidad in enumerate(importes):
+                pagos.append({
+                    'invoice_id': factura_id,
+                    'fecha_pago': emision + timedelta(days=30 * n),
+                    'cantidad': cantidad,
+                    'metodo_pago': metodo,
+                })
+            # Cada lote de facturas se inserta antes que sus pagos (FK)
+            if len(facturas) >= self.lote:
+                total_facturas += insertar(self.conexion, Invoice, facturas, self.lote)
+                total_pagos += insertar(self.conexion, Payment, pagos, self.lote)
+                facturas, pagos = [], []
+        total_facturas += insertar(self.conexion, Invoice, facturas, self.lote)
+        total_pagos += insertar(self.conexion, Payment, pagos, self.lote)
+        print(f"{total_facturas} facturas y {total_pagos} pagos en {reloj.perf_counter() - inicio:.1f}s")
+        return total_facturas
+
+    # ---------- Fichajes ----------
+
+    def fichajes(self):
+        rng = self.rng('fichajes')
+        desde = self.hasta - timedelta(days=self.v['dias_fichaje'])
+
+        def filas():
+            for dia in dias_laborables(desde, self.hasta):
+                for empleado in self.empleados:
+                    if rng.random() < 0.05:  # ausencias
+                        continue
+                    entrada = datetime.combine(dia, time(8, 0)) + timedelta(minutes=rng.randrange(0, 91, 5))
+                    horas = rng.choice([7.5, 8.0, 8.0, 8.0, 8.5, 9.0, 9.5])
+                    salida = entrada + timedelta(hours=horas)
+                    yield {
+                        'user_id': empleado,
+                        'fecha': dia,
+                        'hora_entrada': entrada.time(),
+                        'hora_salida': salida.time(),
+                        'horas_trabajadas': horas,
+                        'horas_extras': max(0.0, horas - 8.0),
+                        'fecha_creacion': entrada,
+                    }
+        return self.paso('Fichajes', TimeClock, filas())
+
+
+def ajustar_secuencias(conexion):
+    """En Postgres, avanza las secuencias de id tras insertar ids explícitos."""
+    if conexion.dialect.name != 'postgresql':
+        return
+    for modelo in (User, Room, Patient, Appointment, TreatmentPlan, TreatmentItem, Invoice, Payment,
+                   DoctorSchedule, TimeClock, Honorario):
+        tabla = modelo.__tablename__
+        conexion.exec_driver_sql(
+            f"SELECT setval(pg_get_serial_sequence('{tabla}', 'id'), COALESCE(MAX(id), 1)) FROM {tabla}"
+        )
+
+
+def generar(volumenes, semilla=42, hasta=None, lote=10000):
+    """Genera todos los datos en la base de datos de la app actual (requiere app_context)."""
+    from app.reporting import recalcular_todo
+
+    hasta = hasta or date.today()
+    inicio = reloj.perf_counter()
+    with db.engine.connect() as conexion:
+        if conexion.dialect.name == 'sqlite':
+            # Carga masiva: menos fsync; el fichero se puede regenerar si algo falla
+            conexion.exec_driver_sql('PRAGMA synchronous=OFF')
+            conexion.commit()
+        generador = Generador(conexion, volumenes, semilla, hasta, lote)
+        # Cada paso en su propia transacción para no acumular todo en una sola
+        for paso in (generador.usuarios, generador.salas, generador.horarios, generador.pacientes,
+                     generador.citas, generador.tratamientos, generador.honorarios,
+                     generador.facturas, generador.fichajes):
+            with conexion.begin():
+                paso()
+        with conexion.begin():
+            ajustar_secuencias(conexion)
+
+    print("  Resúmenes financieros mensuales...", end=' ', flush=True)
+    recalcular_todo(db.session)
+    db.session.commit()
+    print("OK")
+    print(f"\nOK: Datos generados en {reloj.perf_counter() - inicio:.1f}s")
+
+
+def main(argumentos=None):
+    parser = argparse.ArgumentParser(description='Genera datos sintéticos masivos para pruebas de rendimiento.')
+    parser.add_argument('--escala', choices=sorted(ESCALAS), default='pequena')
+    parser.add_argument('--semilla', type=int, default=42)
+    parser.add_argument('--hasta', type=date.fromisoformat, default=None,
+                        help='Fecha "actual" de los datos (AAAA-MM-DD); por defecto, hoy')
+    parser.add_argument('--lote', type=int, default=10000, help='Filas por executemany')
+    for volumen in ESCALAS['pequena']:
+        parser.add_argument(f'--{volumen.replace("_", "-")}', dest=volumen, type=int, default=None)
+    args = parser.parse_args(argumentos)
+
+    volumenes = dict(ESCALAS[args.escala])
+    volumenes.update({k: getattr(args, k) for k in volumenes if getattr(args, k) is not None})
+    print("Generando datos sintéticos:", ', '.join(f'{k}={v}' for k, v in volumenes.items()))
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        generar(volumenes, semilla=args.semilla, hasta=args.hasta, lote=args.lote)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
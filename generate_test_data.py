@@ -6,6 +6,7 @@ import io
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 
 from app import create_app, db
+from app.dinero import importe, redondear
 from app.models import (
     User, Patient, Appointment, ClinicalRecord, Odontogram,
     TreatmentPlan, TreatmentItem, Invoice, Payment, Notification,
@@ -298,7 +299,7 @@ def generar_datos_prueba():
                     factura = Invoice(
                         patient_id=random.choice(pacientes).id,
                         fecha_emision=datetime.now() - timedelta(days=random.randint(0, 90)),
-                        total=random.uniform(100, 1500),
+                        total=importe(random.uniform(100, 1500)),
                         estado_pago=random.choice(['pendiente', 'pagado', 'parcial']),
                         metodo_pago=random.choice(['efectivo', 'tarjeta', 'transferencia']) if random.choice([True, False]) else None
                     )
@@ -307,7 +308,7 @@ def generar_datos_prueba():
                     
                     # Añadir pagos si está pagado o parcial
                     if factura.estado_pago in ['pagado', 'parcial']:
-                        cantidad_pago = float(factura.total) if factura.estado_pago == 'pagado' else float(factura.total) * 0.5
+                        cantidad_pago = factura.total if factura.estado_pago == 'pagado' else redondear(factura.total / 2)
                         pago = Payment(
                             invoice_id=factura.id,
                             fecha_pago=factura.fecha_emision + timedelta(days=random.randint(1, 30)),
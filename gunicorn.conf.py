@@ -0,0 +1,106 @@
+"""
+Configuración de gunicorn para producción.
+
+Ejecutar: gunicorn -c gunicorn.conf.py wsgi:app
+
+Workers gthread: cada worker atiende varias peticiones a la vez con hilos, así
+que un PDF lento no bloquea al resto de usuarios. El número de workers sale de
+las CPUs y de la memoria disponible (contenedor incluido); los hilos, de
+GUNICORN_THREADS. Ambos se exportan como WEB_CONCURRENCY y GUNICORN_THREADS
+para que app/database.py dimensione el pool de conexiones con los mismos
+valores. Con varios workers la caché es la compartida (CACHE_TYPE=sqlite);
+si se fuerza CACHE_TYPE=local se usa un solo worker con los mismos hilos en
+total.
+
+Variables de entorno (todas opcionales):
+- PORT: puerto de escucha (por defecto 5000).
+- WEB_CONCURRENCY: fuerza el número de workers.
+- GUNICORN_THREADS: hilos por worker (por defecto 4).
+- GUNICORN_MEMORIA_WORKER_MB: memoria estimada por worker (por defecto 200).
+- GUNICORN_MAX_REQUESTS: peticiones antes de reciclar un worker (por defecto 1000).
+- GUNICORN_TIMEOUT: segundos máximos por petición (por defecto 60).
+"""
+import multiprocessing
+import os
+
+
+def _memoria_disponible():
+    """Memoria disponible en bytes: límite del cgroup si lo hay, si no la memoria física."""
+    for ruta in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(ruta) as f:
+                valor = f.read().strip()
+        except OSError:
+            continue
+        # 'max' o un número enorme significan sin límite
+        if valor.isdigit() and int(valor) < 1 << 50:
+            return int(valor)
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def calcular_workers():
+    """2 × CPU + 1, limitado por la memoria que cabe para cada worker."""
+    if os.environ.get('WEB_CONCURRENCY'):
+        return max(1, int(os.environ['WEB_CONCURRENCY']))
+    por_cpu = multiprocessing.cpu_count() * 2 + 1
+    memoria = _memoria_disponible()
+    if memoria is None:
+        return por_cpu
+    memoria_worker = int(os.environ.get('GUNICORN_MEMORIA_WORKER_MB', 200)) * 1024 * 1024
+    return max(1, min(por_cpu, memoria // memoria_worker))
+
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+worker_class = 'gthread'
+workers = calcular_workers()
+threads = max(1, int(os.environ.get('GUNICORN_THREADS', 4)))
+
+# La caché de vistas y la de usuarios con sesión (app/cache.py, app/sesiones.py)
+# solo se invalidan entre workers con un backend compartido. Con caché en
+# memoria de cada proceso se sirve todo desde un worker con más hilos.
+if workers > 1:
+    if os.environ.get('CACHE_TYPE', 'sqlite') == 'local':
+        threads *= workers
+        workers = 1
+    else:
+        os.environ.setdefault('CACHE_TYPE', 'sqlite')
+
+# Los límites de tiempo de las sentencias solo se aplican al proceso web (app/database.py)
+os.environ.setdefault('APP_PROCESO', 'web')
+
+# El pool de conexiones por worker se calcula con estos valores (app/database.py)
+os.environ['WEB_CONCURRENCY'] = str(workers)
+os.environ['GUNICORN_THREADS'] = str(threads)
+
+# La app se carga una vez en el master y los workers la heredan al hacer fork
+preload_app = True
+
+# Reciclar workers cada cierto número de peticiones (con jitter para que no
+# se reinicien todos a la vez) limita el crecimiento de memoria
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = max_requests // 10
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    """Cada worker abre sus propias conexiones: las del master no se comparten tras el fork."""
+    from wsgi import app
+    from app import db
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+
+def when_ready(server):
+    server.log.info('Workers: %s (gthread, %s hilos cada uno), caché: %s', workers, threads,
+                    os.environ.get('CACHE_TYPE', 'local'))
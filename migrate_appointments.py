@@ -0,0 +1,37 @@
+"""
+Script de migración para añadir la columna fecha_actualizacion a appointments.
+El calendario la usa para calcular el ETag de cada semana.
+Ejecutar: python migrate_appointments.py
+"""
+from app import create_app, db
+from sqlalchemy import inspect
+
+
+def migrate_appointments():
+    """Añade appointments.fecha_actualizacion y la rellena con la fecha de creación."""
+    app = create_app()
+
+    with app.app_context():
+        try:
+            columnas = [c['name'] for c in inspect(db.engine).get_columns('appointments')]
+
+            if 'fecha_actualizacion' not in columnas:
+                print("Añadiendo columna fecha_actualizacion a la tabla appointments...")
+                with db.engine.begin() as conexion:
+                    conexion.exec_driver_sql("ALTER TABLE appointments ADD COLUMN fecha_actualizacion TIMESTAMP")
+                    conexion.exec_driver_sql(
+                        "UPDATE appointments SET fecha_actualizacion = COALESCE(fecha_creacion, CURRENT_TIMESTAMP)"
+                    )
+                print("OK: Columna fecha_actualizacion añadida correctamente.")
+            else:
+                print("OK: La columna fecha_actualizacion ya existe.")
+
+            print("\nOK: Migracion completada correctamente.")
+
+        except Exception as e:
+            print(f"\nERROR: Error durante la migracion: {e}")
+            import traceback
+            traceback.print_exc()
+
+if __name__ == '__main__':
+    migrate_appointments()
@@ -0,0 +1,46 @@
+"""
+Script de migración para guardar el logo de la clínica en la base de datos.
+Añade la columna clinic_settings.logo_datos y descarga el logo de logo_url:
+los PDF usan esa copia en lugar de descargarlo mientras se generan.
+Ejecutar: python migrate_clinic_logo.py
+"""
+from app import create_app, db
+from app.models import ClinicSettings
+from app.pdf import descargar_logo
+from sqlalchemy import inspect
+
+
+def migrate_clinic_logo():
+    """Añade clinic_settings.logo_datos y la rellena a partir de logo_url."""
+    app = create_app()
+
+    with app.app_context():
+        try:
+            columnas = [c['name'] for c in inspect(db.engine).get_columns('clinic_settings')]
+
+            if 'logo_datos' not in columnas:
+                print("Añadiendo columna logo_datos a la tabla clinic_settings...")
+                tipo = db.LargeBinary().compile(dialect=db.engine.dialect)
+                with db.engine.begin() as conexion:
+                    conexion.exec_driver_sql(f"ALTER TABLE clinic_settings ADD COLUMN logo_datos {tipo}")
+                print("OK: Columna logo_datos añadida correctamente.")
+            else:
+                print("OK: La columna logo_datos ya existe.")
+
+            for settings in ClinicSettings.query.filter(ClinicSettings.logo_url.isnot(None)).all():
+                print(f"Descargando el logo {settings.logo_url}...")
+                settings.logo_datos = descargar_logo(settings.logo_url)
+                if settings.logo_datos is None:
+                    print("AVISO: No se pudo leer el logo; vuelve a guardarlo desde Configuración.")
+            db.session.commit()
+
+            print("\nOK: Migracion completada correctamente.")
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"\nERROR: Error durante la migracion: {e}")
+            import traceback
+            traceback.print_exc()
+
+if __name__ == '__main__':
+    migrate_clinic_logo()
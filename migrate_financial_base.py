@@ -0,0 +1,43 @@
+"""
+Script de migración para añadir la columna base_imponible a financial_summary.
+Guarda la suma de la base imponible de cada factura del mes (ver app/dinero.py).
+Ejecutar: python migrate_financial_base.py
+"""
+from app import create_app, db
+from app.reporting import recalcular_todo
+from sqlalchemy import inspect
+
+
+def migrate_financial_base():
+    """Añade financial_summary.base_imponible y regenera la tabla."""
+    app = create_app()
+
+    with app.app_context():
+        try:
+            columnas = [c['name'] for c in inspect(db.engine).get_columns('financial_summary')]
+
+            if 'base_imponible' not in columnas:
+                print("Añadiendo columna base_imponible a la tabla financial_summary...")
+                with db.engine.begin() as conexion:
+                    conexion.exec_driver_sql(
+                        "ALTER TABLE financial_summary ADD COLUMN base_imponible NUMERIC(12, 2) NOT NULL DEFAULT 0"
+                    )
+                print("OK: Columna base_imponible añadida correctamente.")
+            else:
+                print("OK: La columna base_imponible ya existe.")
+
+            print("Regenerando financial_summary...")
+            recalcular_todo(db.session)
+            db.session.commit()
+            print("OK: financial_summary regenerada.")
+
+            print("\nOK: Migracion completada correctamente.")
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"\nERROR: Error durante la migracion: {e}")
+            import traceback
+            traceback.print_exc()
+
+if __name__ == '__main__':
+    migrate_financial_base()
@@ -0,0 +1,34 @@
+"""
+Script de migración para crear y rellenar la tabla financial_summary.
+También sirve para regenerarla si los resúmenes se desajustan.
+Ejecutar: python migrate_financial_summary.py
+"""
+from app import create_app, db
+from app.models import FinancialSummary
+from app.reporting import recalcular_todo
+
+
+def migrate_financial_summary():
+    """Crea la tabla de resúmenes mensuales y la calcula desde las facturas."""
+    app = create_app()
+
+    with app.app_context():
+        try:
+            print("Creando tabla financial_summary...")
+            db.create_all()
+
+            print("Calculando resúmenes mensuales...")
+            recalcular_todo(db.session)
+            db.session.commit()
+            print(f"OK: {FinancialSummary.query.count()} filas de resumen generadas.")
+
+            print("\nOK: Migracion completada correctamente.")
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"\nERROR: Error durante la migracion: {e}")
+            import traceback
+            traceback.print_exc()
+
+if __name__ == '__main__':
+    migrate_financial_summary()
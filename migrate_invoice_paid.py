@@ -0,0 +1,44 @@
+"""
+Script de migración para añadir la columna total_pagado a invoices.
+Guarda la suma de los pagos de cada factura para no recalcularla en los listados.
+Ejecutar: python migrate_invoice_paid.py
+"""
+from app import create_app, db
+from app.models import Invoice
+from sqlalchemy import inspect
+
+
+def migrate_invoice_paid():
+    """Añade invoices.total_pagado y la rellena a partir de los pagos existentes."""
+    app = create_app()
+
+    with app.app_context():
+        try:
+            columnas = [c['name'] for c in inspect(db.engine).get_columns('invoices')]
+
+            if 'total_pagado' not in columnas:
+                print("Añadiendo columna total_pagado a la tabla invoices...")
+                with db.engine.begin() as conexion:
+                    conexion.exec_driver_sql(
+                        "ALTER TABLE invoices ADD COLUMN total_pagado NUMERIC(10, 2) NOT NULL DEFAULT 0"
+                    )
+                print("OK: Columna total_pagado añadida correctamente.")
+            else:
+                print("OK: La columna total_pagado ya existe.")
+
+            # Se recalcula siempre: sirve también para reparar valores desajustados
+            print("Recalculando total_pagado desde los pagos...")
+            Invoice.recalcular_total_pagado()
+            db.session.commit()
+            print("OK: total_pagado recalculado.")
+
+            print("\nOK: Migracion completada correctamente.")
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"\nERROR: Error durante la migracion: {e}")
+            import traceback
+            traceback.print_exc()
+
+if __name__ == '__main__':
+    migrate_invoice_paid()
@@ -0,0 +1,37 @@
+"""
+Script de migración para crear la tabla de la cola de trabajos en segundo plano.
+En bases de datos donde ya existía, añade la columna contenido (JOBS_EN_BD).
+Ejecutar: python migrate_jobs.py
+"""
+from app import create_app, db
+from app.models import Job
+from sqlalchemy import inspect
+
+
+def migrate_jobs():
+    """Crea la tabla jobs y su índice si no existen y añade jobs.contenido."""
+    app = create_app()
+
+    with app.app_context():
+        try:
+            Job.__table__.create(db.engine, checkfirst=True)
+            print("OK: Tabla jobs creada.")
+
+            columnas = [c['name'] for c in inspect(db.engine).get_columns('jobs')]
+            if 'contenido' not in columnas:
+                print("Añadiendo columna contenido a la tabla jobs...")
+                tipo = db.LargeBinary().compile(dialect=db.engine.dialect)
+                with db.engine.begin() as conexion:
+                    conexion.exec_driver_sql(f"ALTER TABLE jobs ADD COLUMN contenido {tipo}")
+                print("OK: Columna contenido añadida correctamente.")
+            else:
+                print("OK: La columna contenido ya existe.")
+            print("\nOK: Migracion completada correctamente.")
+
+        except Exception as e:
+            print(f"\nERROR: Error durante la migracion: {e}")
+            import traceback
+            traceback.print_exc()
+
+if __name__ == '__main__':
+    migrate_jobs()
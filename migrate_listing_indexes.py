@@ -0,0 +1,31 @@
+"""
+Script de migración para crear los índices que usan los listados paginados por cursor.
+Ejecutar: python migrate_listing_indexes.py
+"""
+from app import create_app, db
+
+INDICES = [
+    'CREATE INDEX IF NOT EXISTS ix_invoices_fecha_emision ON invoices (fecha_emision)',
+    'CREATE INDEX IF NOT EXISTS ix_treatment_plans_fecha_creacion ON treatment_plans (fecha_creacion)',
+]
+
+
+def migrate_listing_indexes():
+    """Crea los índices de ordenación de facturas y planes de tratamiento."""
+    app = create_app()
+
+    with app.app_context():
+        try:
+            with db.engine.begin() as conexion:
+                for sentencia in INDICES:
+                    conexion.exec_driver_sql(sentencia)
+            print("OK: Índices de listados creados.")
+            print("\nOK: Migracion completada correctamente.")
+
+        except Exception as e:
+            print(f"\nERROR: Error durante la migracion: {e}")
+            import traceback
+            traceback.print_exc()
+
+if __name__ == '__main__':
+    migrate_listing_indexes()
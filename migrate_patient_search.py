@@ -0,0 +1,54 @@
+"""
+Script de migración para el buscador de pacientes.
+Añade la columna patients.busqueda, la rellena (NOT NULL en Postgres) y crea los índices de texto
+(trigramas en Postgres, FTS5 en SQLite).
+Ejecutar: python migrate_patient_search.py
+"""
+from app import create_app, db
+from app.search import instalar_indices_busqueda, recalcular_busqueda_pacientes
+from sqlalchemy import inspect
+
+
+def migrate_patient_search():
+    """Migra la base de datos añadiendo el índice de búsqueda de pacientes."""
+    app = create_app()
+
+    with app.app_context():
+        try:
+            columnas = [c['name'] for c in inspect(db.engine).get_columns('patients')]
+
+            if 'busqueda' not in columnas:
+                print("Añadiendo columna busqueda a la tabla patients...")
+                with db.engine.begin() as conexion:
+                    conexion.exec_driver_sql("ALTER TABLE patients ADD COLUMN busqueda TEXT")
+                    conexion.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_patients_busqueda ON patients (busqueda)")
+                print("OK: Columna busqueda añadida correctamente.")
+            else:
+                print("OK: La columna busqueda ya existe.")
+
+            print("Rellenando el texto de búsqueda de los pacientes...")
+            recalcular_busqueda_pacientes()
+
+            # Las filas con busqueda NULL se saldrían de la paginación por cursor
+            with db.engine.begin() as conexion:
+                conexion.exec_driver_sql("UPDATE patients SET busqueda = '' WHERE busqueda IS NULL")
+                if conexion.dialect.name == 'postgresql':
+                    conexion.exec_driver_sql(
+                        "ALTER TABLE patients ALTER COLUMN busqueda SET DEFAULT '', ALTER COLUMN busqueda SET NOT NULL"
+                    )
+            print("OK: Columna busqueda sin valores nulos.")
+
+            print("Creando índices de texto...")
+            with db.engine.begin() as conexion:
+                instalar_indices_busqueda(conexion)
+            print("OK: Índices de búsqueda creados.")
+
+            print("\nOK: Migracion completada correctamente.")
+
+        except Exception as e:
+            print(f"\nERROR: Error durante la migracion: {e}")
+            import traceback
+            traceback.print_exc()
+
+if __name__ == '__main__':
+    migrate_patient_search()
@@ -0,0 +1,38 @@
+"""
+Script de migración para impedir citas solapadas a nivel de base de datos.
+En Postgres crea restricciones de exclusión (dentista y sala); en SQLite, triggers
+(volver a ejecutarlo los reemplaza por la versión actual).
+Ejecutar: python migrate_scheduling.py
+"""
+from app import create_app, db
+from app.scheduling import instalar_restriccion_solapes
+
+
+def migrate_scheduling():
+    """Instala la restricción de no solapamiento de citas."""
+    app = create_app()
+
+    with app.app_context():
+        try:
+            with db.engine.begin() as conexion:
+                if conexion.dialect.name == 'postgresql':
+                    existente = conexion.exec_driver_sql(
+                        "SELECT 1 FROM pg_constraint WHERE conname = 'appointments_dentista_sin_solape'"
+                    ).first()
+                    if existente:
+                        print("OK: La restricción de solapamiento ya existe.")
+                        return
+
+                instalar_restriccion_solapes(conexion)
+
+            print("OK: Restricción de no solapamiento de citas instalada.")
+            print("\nOK: Migracion completada correctamente.")
+
+        except Exception as e:
+            print(f"\nERROR: Error durante la migracion: {e}")
+            print("Revisa que no existan citas activas solapadas antes de volver a ejecutar.")
+            import traceback
+            traceback.print_exc()
+
+if __name__ == '__main__':
+    migrate_scheduling()
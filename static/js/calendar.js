@@ -56,8 +56,8 @@ function loadCalendar() {
         }
     }
     
-    // Cargar citas de la semana
-    fetch(`/panel/calendario/citas-semana?fecha=${fechaStr}`)
+    // Cargar citas de la semana (revalidando con ETag: si no hay cambios el servidor responde 304)
+    fetch(`/panel/calendario/citas-semana?fecha=${fechaStr}`, {cache: 'no-cache'})
         .then(response => response.json())
         .then(data => {
             citas = data.citas;
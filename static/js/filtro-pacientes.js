@@ -0,0 +1,49 @@
+// Filtro de paciente con carga bajo demanda.
+// Los <select data-filtro-pacientes> solo traen la opción "Todos" y el paciente
+// seleccionado; las demás opciones se buscan en el servidor mientras se escribe.
+
+document.addEventListener('DOMContentLoaded', function() {
+    document.querySelectorAll('select[data-filtro-pacientes]').forEach(function(select) {
+        const buscador = document.createElement('input');
+        buscador.type = 'search';
+        buscador.className = 'form-control form-control-sm mb-1';
+        buscador.placeholder = 'Buscar paciente...';
+        select.parentNode.insertBefore(buscador, select);
+
+        const opcionTodos = select.options[0];
+        let temporizador;
+
+        buscador.addEventListener('input', function() {
+            const query = buscador.value.trim();
+            clearTimeout(temporizador);
+            if (query.length < 2) {
+                return;
+            }
+
+            temporizador = setTimeout(() => {
+                fetch(`/panel/api/pacientes/buscar?q=${encodeURIComponent(query)}`)
+                    .then(response => response.json())
+                    .then(data => {
+                        const seleccionado = select.selectedOptions[0];
+                        select.innerHTML = '';
+                        select.appendChild(opcionTodos);
+                        if (seleccionado && seleccionado !== opcionTodos) {
+                            select.appendChild(seleccionado);
+                        }
+                        (data.pacientes || []).forEach(paciente => {
+                            if (seleccionado && seleccionado.value === String(paciente.id)) {
+                                return;
+                            }
+                            const opcion = document.createElement('option');
+                            opcion.value = paciente.id;
+                            opcion.textContent = paciente.nombre_completo;
+                            select.appendChild(opcion);
+                        });
+                    })
+                    .catch(error => {
+                        console.error('Error al buscar pacientes:', error);
+                    });
+            }, 300);
+        });
+    });
+});
@@ -25,23 +25,13 @@ function loadAvailability() {
     selectedDentist = dentistId;
     const fechaStr = formatDate(currentWeekStart);
     
-    // Cargar disponibilidad para cada día de la semana
-    const promises = [];
-    for (let i = 0; i < 7; i++) {
-        const fecha = new Date(currentWeekStart);
-        fecha.setDate(fecha.getDate() + i);
-        const fechaStr = formatDate(fecha);
-        
-        promises.push(
-            fetch(`/paciente/calendario/disponibilidad?fecha=${fechaStr}&dentist_id=${dentistId}`)
-                .then(response => response.json())
-        );
-    }
-    
-    Promise.all(promises).then(results => {
-        disponibilidad = results.flatMap(r => r.tramos);
-        renderPatientCalendar();
-    });
+    // Cargar la disponibilidad de toda la semana en una sola petición
+    fetch(`/paciente/calendario/disponibilidad-semana?fecha=${fechaStr}&dentist_id=${dentistId}`)
+        .then(response => response.json())
+        .then(data => {
+            disponibilidad = data.tramos || [];
+            renderPatientCalendar();
+        });
 }
 
 function renderPatientCalendar() {